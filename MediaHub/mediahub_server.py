@@ -2,17 +2,2729 @@
 # -*- coding: utf-8 -*-
 import os
 import io
+import sys
+import re
 import json
 import uuid
+import wave
+import array
+import base64
+import ctypes
+import select
+import struct
+import hashlib
 import time
+import atexit
+import stat
 import shutil
+import sqlite3
+import subprocess
+import logging
+import threading
 import mimetypes
+import ctypes.util
+import importlib.util
+import multiprocessing
+import unicodedata
+import zipfile
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from datetime import datetime
+from urllib.parse import quote
 from typing import List, Dict, Any, Optional
 
 from flask import (
     Flask, app, request, jsonify, send_from_directory, send_file, Response, make_response
     )
+from werkzeug.http import http_date, parse_date, parse_etags
+
+try:
+    import mutagen  # необязательно: без него фоновое извлечение метаданных выключено
+except ImportError:
+    mutagen = None
+
+def _entry_key(it: Dict[str, Any]) -> str:
+    """Ключ записи индекса: stored, либо хвост url (/media/<stored>) у старых записей."""
+    stored = it.get("stored")
+    if stored:
+        return stored
+    url = it.get("url") or ""
+    return url.split("/media/", 1)[1] if url.startswith("/media/") else url
+
+
+class MediaCatalog:
+    """
+    Хранилище индекса в SQLite (media/catalog.db, режим WAL).
+
+    Полная запись хранится JSON-ом в колонке data — ответы API не меняются.
+    stored/name/kind/mtime/size вынесены в отдельные колонки с индексами;
+    сброс из MediaIndex правит только изменённые строки одной транзакцией.
+    При первом открытии один раз переносит записи из старого index.json.
+    """
+
+    _SCHEMA = """
+    CREATE TABLE IF NOT EXISTS files (
+        seq      INTEGER PRIMARY KEY AUTOINCREMENT,
+        stored   TEXT NOT NULL UNIQUE,
+        name     TEXT NOT NULL DEFAULT '',
+        name_key TEXT NOT NULL DEFAULT '',
+        kind     TEXT NOT NULL DEFAULT 'file',
+        mtime    TEXT NOT NULL DEFAULT '',
+        size     INTEGER NOT NULL DEFAULT 0,
+        search   TEXT NOT NULL DEFAULT '',
+        data     TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS meta (
+        key   TEXT PRIMARY KEY,
+        value TEXT
+    );
+    """
+
+    _INDEXES = """
+    CREATE INDEX IF NOT EXISTS files_name  ON files(name_key);
+    CREATE INDEX IF NOT EXISTS files_kind  ON files(kind);
+    CREATE INDEX IF NOT EXISTS files_mtime ON files(mtime);
+    CREATE INDEX IF NOT EXISTS files_size  ON files(size);
+    """
+
+    # колонки выборок из _SCHEMA: если в каталоге их нет, они добавляются и заполняются из data
+    _COLUMNS = (
+        ("name", "TEXT NOT NULL DEFAULT ''"),
+        ("name_key", "TEXT NOT NULL DEFAULT ''"),
+        ("kind", "TEXT NOT NULL DEFAULT 'file'"),
+        ("mtime", "TEXT NOT NULL DEFAULT ''"),
+        ("size", "INTEGER NOT NULL DEFAULT 0"),
+        ("search", "TEXT NOT NULL DEFAULT ''"),
+    )
+
+    # MediaIndex пишет в хранилище только изменения, а не весь список
+    incremental = True
+
+    def __init__(self, db_path: str, legacy_index_path: Optional[str] = None):
+        self.DB_PATH = db_path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.executescript(self._SCHEMA)
+        self._restore_columns()
+        with self._conn:
+            self._conn.executescript(self._INDEXES)
+        if legacy_index_path:
+            self._migrate_from_json(legacy_index_path)
+
+    # ---- служебное ----
+
+    def _restore_columns(self) -> None:
+        """Недостающие колонки выборок — ADD COLUMN (данные не удаляются) и заполнение из data."""
+        cols = {row[1] for row in self._conn.execute("PRAGMA table_info(files)")}
+        missing = [(col, decl) for col, decl in self._COLUMNS if col not in cols]
+        if not missing:
+            return
+        with self._lock, self._conn:
+            for col, decl in missing:
+                self._conn.execute(f"ALTER TABLE files ADD COLUMN {col} {decl}")
+            rows = self._conn.execute("SELECT data FROM files").fetchall()
+            self._upsert([json.loads(r[0]) for r in rows])
+
+    @staticmethod
+    def _row_values(it: Dict[str, Any]) -> tuple:
+        name = it.get("name") or ""
+        search = "\x1f".join([name.lower()] + [(t or "").lower() for t in it.get("tags", []) or []])
+        return (
+            _entry_key(it), name, name.lower(), it.get("kind") or "file",
+            it.get("mtime") or "", int(it.get("size") or 0), search,
+            json.dumps(it, ensure_ascii=False),
+        )
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        row = self._conn.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value: Any) -> None:
+        self._conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES (?, ?)", (key, str(value)))
+
+    def _migrate_from_json(self, path: str) -> None:
+        """Однократный перенос media/index.json в каталог."""
+        with self._lock:
+            if self._get_meta("migrated_from_json"):
+                return
+            items: List[Dict[str, Any]] = []
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if isinstance(data, dict): items = data.get("files", []) or []
+                elif isinstance(data, list): items = data
+            except Exception:
+                items = []
+            with self._conn:
+                self._upsert(items)
+                self._set_meta("migrated_from_json", datetime.now().isoformat(timespec="seconds"))
+
+    def _upsert(self, items: List[Dict[str, Any]]) -> None:
+        # ON CONFLICT сохраняет seq — порядок записей как в прежнем index.json
+        self._conn.executemany(
+            """INSERT INTO files(stored, name, name_key, kind, mtime, size, search, data)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(stored) DO UPDATE SET
+                 name=excluded.name, name_key=excluded.name_key, kind=excluded.kind,
+                 mtime=excluded.mtime, size=excluded.size, search=excluded.search, data=excluded.data""",
+            [self._row_values(it) for it in items if _entry_key(it)],
+        )
+
+    # ---- интерфейс хранилища для MediaIndex ----
+
+    def load(self) -> tuple:
+        """(сохранённая версия, записи в порядке добавления)."""
+        with self._lock:
+            version = int(self._get_meta("version") or 0)
+            rows = self._conn.execute("SELECT data FROM files ORDER BY seq").fetchall()
+        return version, [json.loads(r[0]) for r in rows]
+
+    def write(self, version: int, ops: List[list], files: Optional[List[Dict[str, Any]]] = None) -> None:
+        """Применяет пачку операций журнала одной транзакцией."""
+        with self._lock, self._conn:
+            for op in ops:
+                kind = op[0]
+                if kind == "put":
+                    self._upsert([op[2]])
+                elif kind == "del":
+                    self._conn.execute("DELETE FROM files WHERE stored=?", (op[1],))
+                elif kind == "ren":
+                    # переименование сохраняет seq (место записи)
+                    self._conn.execute("DELETE FROM files WHERE stored=?", (op[2],))
+                    self._conn.execute(
+                        """UPDATE files SET stored=?, name=?, name_key=?, kind=?, mtime=?, size=?, search=?, data=?
+                           WHERE stored=?""", self._row_values(op[3]) + (op[1],))
+                elif kind == "clear":
+                    self._conn.execute("DELETE FROM files")
+            self._set_meta("version", version)
+
+    def close(self) -> None:
+        with self._lock:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+
+
+class JsonIndexStore:
+    """
+    Хранилище индекса в media/index.json (формат {"version": n, "files": [...]}).
+    Файл всегда переписывается целиком через переданный atomic-writer,
+    поэтому MediaIndex вызывает write() не чаще раза в flush_interval.
+    """
+
+    incremental = False
+
+    def __init__(self, path: str, atomic_write):
+        self.PATH = path
+        self._atomic_write = atomic_write
+
+    def load(self) -> tuple:
+        try:
+            with open(self.PATH, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data, dict): return int(data.get("version") or 0), data.get("files", []) or []
+            if isinstance(data, list): return 0, data
+        except Exception:
+            pass
+        return 0, []
+
+    def write(self, version: int, ops: List[list], files: Optional[List[Dict[str, Any]]] = None) -> None:
+        self._atomic_write(self.PATH, {"version": version, "files": files or []})
+
+    def close(self) -> None:
+        pass
+
+
+class AlbumStore:
+    """
+    Альбомы в SQLite (media/albums.db, режим WAL): таблица albums и таблица
+    членства album_items (альбом, позиция, stored). Индекс (album, pos) даёт
+    страницу альбома без чтения остальных элементов, индекс по stored —
+    каскадное удаление/переименование файла во всех альбомах сразу.
+    При первом открытии один раз переносит альбомы из старого albums.json.
+    """
+
+    _SCHEMA = """
+    CREATE TABLE IF NOT EXISTS albums (
+        id      INTEGER PRIMARY KEY AUTOINCREMENT,
+        name    TEXT NOT NULL UNIQUE,
+        created TEXT NOT NULL DEFAULT '',
+        updated TEXT NOT NULL DEFAULT '',
+        tags    TEXT NOT NULL DEFAULT '[]'
+    );
+    CREATE TABLE IF NOT EXISTS album_items (
+        album  INTEGER NOT NULL REFERENCES albums(id) ON DELETE CASCADE,
+        pos    INTEGER NOT NULL,
+        stored TEXT NOT NULL,
+        PRIMARY KEY (album, stored)
+    );
+    CREATE INDEX IF NOT EXISTS album_items_pos    ON album_items(album, pos);
+    CREATE INDEX IF NOT EXISTS album_items_stored ON album_items(stored);
+    CREATE TABLE IF NOT EXISTS meta (
+        key   TEXT PRIMARY KEY,
+        value TEXT
+    );
+    """
+
+    def __init__(self, db_path: str, legacy_json_path: Optional[str] = None):
+        self.DB_PATH = db_path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        with self._conn:
+            self._conn.executescript(self._SCHEMA)
+        if legacy_json_path:
+            self._migrate_from_json(legacy_json_path)
+
+    # ---- служебное ----
+
+    @staticmethod
+    def _now() -> str:
+        return datetime.now().isoformat(timespec="seconds")
+
+    def _migrate_from_json(self, path: str) -> None:
+        """Однократный перенос media/albums.json (сам файл остаётся на месте)."""
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM meta WHERE key='migrated_from_json'").fetchone():
+                return
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                albums = data.get("albums", []) if isinstance(data, dict) else data
+            except Exception:
+                albums = []
+            with self._conn:
+                for a in albums if isinstance(albums, list) else []:
+                    if isinstance(a, dict) and a.get("name"):
+                        self._insert(a["name"], a.get("items") or [], a.get("tags") or [],
+                                     a.get("created") or "", a.get("updated") or "")
+                self._conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('migrated_from_json', ?)",
+                                   (self._now(),))
+
+    def _insert(self, name: str, items: List[str], tags: List[str], created: str, updated: str) -> None:
+        cur = self._conn.execute("INSERT OR IGNORE INTO albums(name, created, updated, tags) VALUES (?, ?, ?, ?)",
+                                 (name, created, updated, json.dumps(tags, ensure_ascii=False)))
+        if cur.rowcount:
+            self._put_items(cur.lastrowid, items, 0)
+
+    def _put_items(self, album_id: int, items: List[str], start: int) -> int:
+        cur = self._conn.executemany(
+            "INSERT OR IGNORE INTO album_items(album, pos, stored) VALUES (?, ?, ?)",
+            [(album_id, start + i, st) for i, st in enumerate(dict.fromkeys(items))])
+        return cur.rowcount
+
+    def _id(self, name: str) -> Optional[int]:
+        row = self._conn.execute("SELECT id FROM albums WHERE name=?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def _touch(self, album_id: int) -> None:
+        self._conn.execute("UPDATE albums SET updated=? WHERE id=?", (self._now(), album_id))
+
+    @staticmethod
+    def _album(row: tuple) -> Dict[str, Any]:
+        return {"name": row[1], "created": row[2], "updated": row[3], "tags": json.loads(row[4] or "[]")}
+
+    # ---- чтение ----
+
+    def list(self) -> List[Dict[str, Any]]:
+        """Все альбомы с items (по порядку позиций)."""
+        with self._lock:
+            rows = self._conn.execute("SELECT id, name, created, updated, tags FROM albums ORDER BY id").fetchall()
+            items: Dict[int, List[str]] = {}
+            for album_id, stored in self._conn.execute("SELECT album, stored FROM album_items ORDER BY album, pos"):
+                items.setdefault(album_id, []).append(stored)
+        return [dict(self._album(r), items=items.get(r[0], [])) for r in rows]
+
+    def get(self, name: str) -> Optional[Dict[str, Any]]:
+        """Альбом без items (их — через items()) или None."""
+        with self._lock:
+            row = self._conn.execute("SELECT id, name, created, updated, tags FROM albums WHERE name=?",
+                                     (name,)).fetchone()
+        return self._album(row) if row else None
+
+    def items(self, name: str, limit: int = 0, offset: int = 0) -> Optional[tuple]:
+        """(всего в альбоме, [stored] страницы по позиции) или None — нет альбома."""
+        with self._lock:
+            album_id = self._id(name)
+            if album_id is None:
+                return None
+            total = self._conn.execute("SELECT COUNT(*) FROM album_items WHERE album=?", (album_id,)).fetchone()[0]
+            rows = self._conn.execute(
+                "SELECT stored FROM album_items WHERE album=? ORDER BY pos LIMIT ? OFFSET ?",
+                (album_id, limit if limit > 0 else -1, max(0, offset))).fetchall()
+        return total, [r[0] for r in rows]
+
+    # ---- запись ----
+
+    def create(self, name: str, items: List[str], tags: List[str]) -> bool:
+        """False — альбом с таким именем уже есть."""
+        with self._lock, self._conn:
+            if self._id(name) is not None:
+                return False
+            now = self._now()
+            self._insert(name, items, tags, now, now)
+            return True
+
+    def drop(self, name: str) -> bool:
+        with self._lock, self._conn:
+            return self._conn.execute("DELETE FROM albums WHERE name=?", (name,)).rowcount > 0
+
+    def add_items(self, name: str, items: List[str]) -> Optional[int]:
+        """Дописывает в конец (уже входящие пропускаются) → сколько добавлено; None — нет альбома."""
+        with self._lock, self._conn:
+            album_id = self._id(name)
+            if album_id is None:
+                return None
+            last = self._conn.execute("SELECT MAX(pos) FROM album_items WHERE album=?", (album_id,)).fetchone()[0]
+            added = self._put_items(album_id, items, (last if last is not None else -1) + 1)
+            self._touch(album_id)
+            return added
+
+    def remove_items(self, name: str, items: List[str]) -> bool:
+        with self._lock, self._conn:
+            album_id = self._id(name)
+            if album_id is None:
+                return False
+            self._conn.executemany("DELETE FROM album_items WHERE album=? AND stored=?",
+                                   [(album_id, st) for st in items])
+            self._touch(album_id)
+            return True
+
+    def set_items(self, name: str, items: List[str]) -> bool:
+        with self._lock, self._conn:
+            album_id = self._id(name)
+            if album_id is None:
+                return False
+            self._conn.execute("DELETE FROM album_items WHERE album=?", (album_id,))
+            self._put_items(album_id, items, 0)
+            self._touch(album_id)
+            return True
+
+    def rename(self, name: str, new_name: str) -> Optional[bool]:
+        """None — нет альбома, False — new_name занято."""
+        with self._lock, self._conn:
+            album_id = self._id(name)
+            if album_id is None:
+                return None
+            other = self._id(new_name)
+            if other is not None and other != album_id:
+                return False
+            self._conn.execute("UPDATE albums SET name=?, updated=? WHERE id=?", (new_name, self._now(), album_id))
+            return True
+
+    def set_tags(self, name: str, tags: List[str]) -> bool:
+        with self._lock, self._conn:
+            cur = self._conn.execute("UPDATE albums SET tags=?, updated=? WHERE name=?",
+                                     (json.dumps(tags, ensure_ascii=False), self._now(), name))
+            return cur.rowcount > 0
+
+    def replace_items(self, gone: set, keep: str) -> List[str]:
+        """Элементы из gone → keep (на месте первого из них, без повторов). → имена изменённых альбомов."""
+        with self._lock, self._conn:
+            marks = ",".join("?" * len(gone))
+            ids = [r[0] for r in self._conn.execute(
+                f"SELECT DISTINCT album FROM album_items WHERE stored IN ({marks})", tuple(gone))] if gone else []
+            changed = []
+            for album_id in ids:
+                out = []
+                for (st,) in self._conn.execute("SELECT stored FROM album_items WHERE album=? ORDER BY pos",
+                                                (album_id,)).fetchall():
+                    out.append(keep if st in gone else st)
+                self._conn.execute("DELETE FROM album_items WHERE album=?", (album_id,))
+                self._put_items(album_id, out, 0)
+                self._touch(album_id)
+                changed.append(self._conn.execute("SELECT name FROM albums WHERE id=?", (album_id,)).fetchone()[0])
+            return changed
+
+    # ---- каскад от операций над файлами ----
+
+    def forget(self, stored: str) -> None:
+        """Файл удалён — убрать его из всех альбомов."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM album_items WHERE stored=?", (stored,))
+
+    def rename_item(self, old: str, new: str) -> None:
+        """Файл переименован — в альбомах тот же элемент под новым stored (где new уже был — просто убрать old)."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM album_items WHERE stored=? AND album IN "
+                               "(SELECT album FROM album_items WHERE stored=?)", (old, new))
+            self._conn.execute("UPDATE album_items SET stored=? WHERE stored=?", (new, old))
+
+    def close(self) -> None:
+        with self._lock:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+
+
+_GONE = object()  # надгробие удалённой записи в слое среза
+
+
+class _LayeredEntries(Mapping):
+    """
+    stored → запись поверх стопки неизменяемых слоёв (новые первыми, внизу — база).
+    Слой — словарь изменений одной серии записей; удаление — надгробие _GONE.
+    """
+
+    __slots__ = ("_layers", "_len")
+
+    def __init__(self, layers: tuple, length: int):
+        self._layers = layers
+        self._len = length
+
+    def __getitem__(self, stored: str) -> Dict[str, Any]:
+        for layer in self._layers:
+            it = layer.get(stored, None)
+            if it is not None:
+                if it is _GONE:
+                    break
+                return it
+        raise KeyError(stored)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self):
+        layers = self._layers
+        for i in range(len(layers) - 1, -1, -1):
+            upper = layers[:i]
+            for stored, it in layers[i].items():
+                if it is not _GONE and not any(stored in layer for layer in upper):
+                    yield stored
+
+
+class IndexSnapshot:
+    """
+    Неизменяемый срез индекса: версия, словарь по stored и записи (files, от
+    давно не менявшихся к свежим). Делит слои с соседними срезами — новый срез
+    стоит O(изменений с прошлого), а не O(библиотеки), см. MediaIndex.snapshot.
+    """
+
+    __slots__ = ("version", "by_stored", "_files")
+
+    def __init__(self, version: int, layers: tuple, length: int):
+        self.version = version
+        self.by_stored = _LayeredEntries(layers, length)
+        self._files: Optional[tuple] = None
+
+    @property
+    def files(self) -> tuple:
+        if self._files is None:
+            self._files = tuple(self.by_stored.values())
+        return self._files
+
+
+class _IndexTxn:
+    """
+    Транзакция MediaIndex: держит блокировку писателя, изменения сразу видны
+    внутри транзакции, в журнал уходят одной строкой при выходе из with.
+    """
+
+    def __init__(self, index: "MediaIndex"):
+        self._index = index
+        self.ops: List[list] = []
+        self.changed: Dict[str, str] = {}  # stored → added|updated|removed — итог транзакции для ленты изменений
+        self.reset = False
+
+    def _mark(self, stored: str, existed: bool, present: bool) -> None:
+        prev = self.changed.pop(stored, None)
+        existed = prev in ("updated", "removed") if prev is not None else existed  # до транзакции
+        if present:
+            self.changed[stored] = "updated" if existed else "added"
+        elif existed:
+            self.changed[stored] = "removed"
+
+    def get(self, stored: str) -> Optional[Dict[str, Any]]:
+        return self._index._entries.get(stored)
+
+    def keys(self):
+        return self._index._entries.keys()
+
+    def put(self, item: Dict[str, Any]) -> None:
+        item = dict(item)
+        key = _entry_key(item)
+        old = self._index._entries.get(key)
+        self._index._entries[key] = item
+        self._index._delta[key] = item
+        for view in self._index._views:
+            if old is not None:
+                view.discard(key, old)
+            view.add(key, item)
+        self.ops.append(["put", key, item])
+        self._mark(key, old is not None, True)
+
+    def delete(self, stored: str) -> Optional[Dict[str, Any]]:
+        old = self._index._entries.pop(stored, None)
+        if old is not None:
+            self._index._delta[stored] = _GONE
+            for view in self._index._views:
+                view.discard(stored, old)
+            self.ops.append(["del", stored])
+            self._mark(stored, True, False)
+        return old
+
+    def rename(self, old_stored: str, item: Dict[str, Any]) -> bool:
+        entries = self._index._entries
+        if old_stored not in entries:
+            return False
+        item = dict(item)
+        new_stored = _entry_key(item)
+        # занятое new_stored перезаписывается — прежняя запись уходит и из вторичных индексов
+        replaced = entries.get(new_stored) if new_stored != old_stored else None
+        old = entries.pop(old_stored)
+        entries[new_stored] = item
+        self._index._delta[old_stored] = _GONE
+        self._index._delta[new_stored] = item
+        for view in self._index._views:
+            if replaced is not None:
+                view.discard(new_stored, replaced)
+            view.discard(old_stored, old)
+            view.add(new_stored, item)
+        self.ops.append(["ren", old_stored, new_stored, item])
+        self._mark(old_stored, True, False)
+        self._mark(new_stored, replaced is not None, True)
+        return True
+
+    def clear(self) -> None:
+        self._index._entries.clear()
+        self._index._layers, self._index._delta = (), {}
+        for view in self._index._views:
+            view.reset()
+        self.ops.append(["clear"])
+        self.changed.clear()
+        self.reset = True
+
+
+class IndexView:
+    """
+    Вторичный индекс над MediaIndex. Методы вызываются под блокировкой
+    писателя при каждом изменении: правка записи = discard(старой) + add(новой).
+    Запросы к view тоже делаются под MediaIndex.locked().
+    """
+
+    def add(self, stored: str, entry: Dict[str, Any]) -> None:
+        pass
+
+    def discard(self, stored: str, entry: Dict[str, Any]) -> None:
+        pass
+
+    def reset(self) -> None:
+        pass
+
+    def bulk_add(self, items) -> None:
+        """Начальное заполнение из пар (stored, entry); view может сделать это быстрее поштучного add."""
+        for stored, entry in items:
+            self.add(stored, entry)
+
+
+_TOKEN_RE = re.compile(r"[^\W_]+")
+
+
+def _fold(text: str) -> str:
+    """Свёртка регистра для поиска (кириллица/казахский): NFKC + casefold, ё → е."""
+    return unicodedata.normalize("NFKC", text or "").casefold().replace("ё", "е")
+
+
+def _tokens(text: str) -> List[str]:
+    return _TOKEN_RE.findall(_fold(text))
+
+
+class TextIndex(IndexView):
+    """
+    Инвертированный индекс для /api/files?q= по имени, тегам и значениям props/media.
+
+    token → три множества stored (по полю, где токен встретился: props/теги/имя).
+    Словарь токенов держится отсортированным — префиксный поиск это диапазон
+    bisect, а объединение постингов идёт операциями над множествами.
+    Релевантность: вес поля (имя 3, тег 2, props и media 1), точное совпадение токена
+    вдвое выше префиксного; несколько слов — пересечение (AND) с суммой весов.
+    """
+
+    FIELD_WEIGHTS = (("name", 3), ("tags", 2), ("props", 1), ("media", 1))
+    CACHE_SIZE = 32
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self._postings: Dict[str, tuple] = {}
+        self._vocab: List[str] = []
+        self._doc_tokens: Dict[str, Dict[str, int]] = {}
+        self._bulk = False
+        # короткие префиксы дают десятки тысяч совпадений — повтор запроса (листание) берём из кэша
+        self._cache: "OrderedDict[str, Dict[str, int]]" = OrderedDict()
+
+    @classmethod
+    def _entry_tokens(cls, entry: Dict[str, Any]) -> Dict[str, int]:
+        out: Dict[str, int] = {}
+        for field, weight in cls.FIELD_WEIGHTS:
+            value = entry.get(field)
+            if field == "tags":
+                texts = [str(t) for t in (value or [])]
+            elif field in ("props", "media"):
+                texts = [str(v) for v in (value or {}).values()] if isinstance(value, dict) else []
+            else:
+                texts = [str(value or "")]
+            for text in texts:
+                for tok in _tokens(text):
+                    out[tok] = max(out.get(tok, 0), weight)
+        return out
+
+    def add(self, stored: str, entry: Dict[str, Any]) -> None:
+        toks = self._entry_tokens(entry)
+        self._cache.clear()
+        self._doc_tokens[stored] = toks
+        for tok, weight in toks.items():
+            posting = self._postings.get(tok)
+            if posting is None:
+                posting = self._postings[tok] = (set(), set(), set())
+                if not self._bulk:
+                    self._vocab.insert(bisect_left(self._vocab, tok), tok)
+            posting[weight - 1].add(stored)
+
+    def bulk_add(self, items) -> None:
+        # словарь не держим отсортированным по ходу — сортируем один раз в конце
+        self._bulk = True
+        try:
+            for stored, entry in items:
+                self.add(stored, entry)
+        finally:
+            self._bulk = False
+        self._vocab = sorted(self._postings)
+
+    def discard(self, stored: str, entry: Dict[str, Any]) -> None:
+        self._cache.clear()
+        for tok, weight in self._doc_tokens.pop(stored, {}).items():
+            posting = self._postings.get(tok)
+            if posting is None:
+                continue
+            posting[weight - 1].discard(stored)
+            if not any(posting):
+                del self._postings[tok]
+                i = bisect_left(self._vocab, tok)
+                if i < len(self._vocab) and self._vocab[i] == tok:
+                    del self._vocab[i]
+
+    def _term_scores(self, term: str) -> Dict[str, int]:
+        lo = bisect_left(self._vocab, term)
+        hi = bisect_left(self._vocab, term + "\U0010ffff", lo)
+        prefix = (set(), set(), set())
+        exact = self._postings.get(term) or (set(), set(), set())
+        for i in range(lo, hi):
+            posting = self._postings[self._vocab[i]]
+            for w in range(3):
+                prefix[w].update(posting[w])
+        # обновляем по возрастанию итогового веса — в словаре остаётся максимальный
+        scores: Dict[str, int] = dict.fromkeys(prefix[0], 1)
+        scores.update(dict.fromkeys(exact[0], 2))
+        scores.update(dict.fromkeys(prefix[1], 2))
+        scores.update(dict.fromkeys(prefix[2], 3))
+        scores.update(dict.fromkeys(exact[1], 4))
+        scores.update(dict.fromkeys(exact[2], 6))
+        return scores
+
+    def _doc_term_score(self, stored: str, term: str) -> int:
+        best = 0
+        for tok, weight in self._doc_tokens.get(stored, {}).items():
+            if tok.startswith(term):
+                best = max(best, weight * (2 if tok == term else 1))
+        return best
+
+    def search(self, query: str) -> Optional[Dict[str, int]]:
+        """{stored: релевантность} для документов со всеми словами запроса; None — пустой запрос."""
+        terms = sorted(set(_tokens(query)), key=len, reverse=True)
+        if not terms:
+            return None
+        cache_key = " ".join(terms)
+        cached = self._cache.get(cache_key)
+        if cached is not None:
+            self._cache.move_to_end(cache_key)
+            return cached
+        # самое длинное слово обычно самое избирательное — с него и начинаем
+        scores = self._term_scores(terms[0])
+        for term in terms[1:]:
+            if not scores:
+                break
+            if len(scores) <= 256:
+                # мало кандидатов — проверяем их токены напрямую, без разворота префикса
+                nxt = {}
+                for stored, sc in scores.items():
+                    s = self._doc_term_score(stored, term)
+                    if s:
+                        nxt[stored] = sc + s
+            else:
+                other = self._term_scores(term)
+                if len(other) < len(scores):
+                    scores, other = other, scores
+                nxt = {st: sc + other[st] for st, sc in scores.items() if st in other}
+            scores = nxt
+        self._cache[cache_key] = scores
+        if len(self._cache) > self.CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return scores
+
+
+class SortedOrderings(IndexView):
+    """
+    Предсортированные порядки для /api/files: name/date/size — по всей
+    библиотеке и отдельно по каждому kind. Элемент — кортеж (ключ, stored),
+    stored делает порядок полным, поэтому по нему же работает keyset-курсор.
+    Вставка/удаление — bisect, страница — срез списка: O(limit).
+    """
+
+    KEYS = {
+        "name": lambda it: (it.get("name") or "").lower(),
+        "date": lambda it: it.get("mtime") or "",
+        "size": lambda it: int(it.get("size") or 0),
+    }
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self._lists: Dict[tuple, List[tuple]] = {}
+
+    def _targets(self, entry: Dict[str, Any]):
+        kind = (entry.get("kind") or "file").lower()
+        for sort, keyfn in self.KEYS.items():
+            row = (keyfn(entry), _entry_key(entry))
+            yield (sort, ""), row
+            yield (sort, kind), row
+
+    def add(self, stored: str, entry: Dict[str, Any]) -> None:
+        for target, row in self._targets(entry):
+            insort(self._lists.setdefault(target, []), row)
+
+    def discard(self, stored: str, entry: Dict[str, Any]) -> None:
+        for target, row in self._targets(entry):
+            rows = self._lists.get(target)
+            if not rows:
+                continue
+            i = bisect_left(rows, row)
+            if i < len(rows) and rows[i] == row:
+                del rows[i]
+
+    def bulk_add(self, items) -> None:
+        for stored, entry in items:
+            for target, row in self._targets(entry):
+                self._lists.setdefault(target, []).append(row)
+        for rows in self._lists.values():
+            rows.sort()
+
+    def rows(self, sort: str, kind: str = "") -> List[tuple]:
+        """Отсортированный по возрастанию список (ключ, stored); не изменять."""
+        return self._lists.get((sort, kind), [])
+
+    @staticmethod
+    def row_of(sort: str, entry: Dict[str, Any]) -> tuple:
+        return (SortedOrderings.KEYS[sort](entry), _entry_key(entry))
+
+
+def _page(rows: List[tuple], reverse: bool, limit: int, offset: int, after: Optional[tuple]) -> tuple:
+    """
+    Страница из отсортированного по возрастанию rows: курсор after (keyset)
+    или offset. reverse — идти с конца. Возвращает (строки, есть_ещё).
+    """
+    n = len(rows)
+    if after is not None:
+        if reverse:
+            stop = bisect_left(rows, after)
+            start = max(0, stop - limit) if limit > 0 else 0
+            return rows[start:stop][::-1], start > 0
+        start = bisect_right(rows, after)
+    else:
+        start = max(offset, 0) if limit > 0 else 0
+        if reverse:
+            stop = n - start
+            begin = max(0, stop - limit) if limit > 0 else 0
+            return rows[begin:max(stop, 0)][::-1], begin > 0
+    stop = start + limit if limit > 0 else n
+    return rows[start:stop], stop < n
+
+
+def _encode_cursor(payload: list) -> str:
+    raw = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> list:
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+    payload = json.loads(raw.decode("utf-8"))
+    if not isinstance(payload, list):
+        raise ValueError("bad cursor")
+    return payload
+
+
+class FacetIndex(IndexView):
+    """
+    Инвертированные индексы тег → {stored} и kind → {stored}:
+    фильтр по тегам — пересечение/объединение множеств, счётчики фасетов
+    без полного прохода по библиотеке.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.by_tag: Dict[str, set] = {}
+        self.by_kind: Dict[str, set] = {}
+
+    @staticmethod
+    def _tags_of(entry: Dict[str, Any]) -> set:
+        return {str(t).strip() for t in (entry.get("tags") or []) if str(t).strip()}
+
+    def add(self, stored: str, entry: Dict[str, Any]) -> None:
+        for tag in self._tags_of(entry):
+            self.by_tag.setdefault(tag, set()).add(stored)
+        self.by_kind.setdefault((entry.get("kind") or "file").lower(), set()).add(stored)
+
+    def discard(self, stored: str, entry: Dict[str, Any]) -> None:
+        for tag in self._tags_of(entry):
+            members = self.by_tag.get(tag)
+            if members is not None:
+                members.discard(stored)
+                if not members:
+                    del self.by_tag[tag]
+        kind = (entry.get("kind") or "file").lower()
+        members = self.by_kind.get(kind)
+        if members is not None:
+            members.discard(stored)
+            if not members:
+                del self.by_kind[kind]
+
+    def with_tags(self, tags: List[str], mode: str = "and") -> set:
+        """stored с тегами: mode=and — со всеми, or — хотя бы с одним."""
+        sets = [self.by_tag.get(t, set()) for t in tags]
+        if not sets:
+            return set()
+        if mode == "or":
+            return set().union(*sets)
+        sets.sort(key=len)  # пересекаем начиная с самого маленького
+        return sets[0].intersection(*sets[1:])
+
+
+_SHARD_RE = re.compile(r"[0-9a-f]{2}")
+
+
+def _blob_name(sha256: str, ext: str) -> str:
+    """Путь блоба относительно media: два уровня каталогов по префиксу хэша — "ab/cd/abcd…<ext>"."""
+    return f"{sha256[:2]}/{sha256[2:4]}/{sha256}{ext.lower()}"
+
+
+class BlobRefs(IndexView):
+    """
+    Счётчики ссылок на блобы хранилища по содержимому: blob → {stored}.
+    Загрузка одинакового содержимого даёт новую запись с тем же blob;
+    файл блоба удаляется, только когда на него не осталось ссылок.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.refs: Dict[str, set] = {}
+        self.by_sha: Dict[str, str] = {}
+        self.keys: set = set()  # stored записей, лежащих в блобах (на диске под именем blob, а не stored)
+
+    def add(self, stored: str, entry: Dict[str, Any]) -> None:
+        blob = entry.get("blob")
+        if not blob:
+            return
+        self.refs.setdefault(blob, set()).add(stored)
+        self.keys.add(stored)
+        if entry.get("sha256"):
+            self.by_sha.setdefault(entry["sha256"], blob)
+
+    def discard(self, stored: str, entry: Dict[str, Any]) -> None:
+        blob = entry.get("blob")
+        if not blob:
+            return
+        self.keys.discard(stored)
+        members = self.refs.get(blob)
+        if members is not None:
+            members.discard(stored)
+            if not members:
+                del self.refs[blob]
+                if self.by_sha.get(entry.get("sha256")) == blob:
+                    del self.by_sha[entry["sha256"]]
+
+
+class LibraryStats(IndexView):
+    """
+    Сводка по библиотеке для /api/stats, которая ведётся на каждой правке:
+    число и объём файлов (всего и по kind), счётчики тегов, самый свежий mtime.
+    Запрос — копия нескольких словарей, без прохода по записям.
+
+    Альбомы: set_albums() запоминает состав (stored → альбомы), дальше число
+    и объём найденных в индексе файлов альбома ведут те же add/discard;
+    для пересчёта при смене состава view помнит размер каждой записи.
+
+    local_bytes — сколько занято в самой media (для квоты): блоб считается один
+    раз, сколько бы записей на него ни ссылалось, внешние файлы (import-dir) — нет.
+    """
+
+    def __init__(self):
+        self._member_of: Dict[str, set] = {}  # stored → имена альбомов
+        self.albums: Dict[str, list] = {}  # имя → [файлов, байт]
+        self.reset()
+
+    def reset(self) -> None:
+        self.count = 0
+        self.bytes = 0
+        self.kinds: Dict[str, list] = {}  # kind → [файлов, байт]
+        self.tags: Dict[str, int] = {}
+        self.local_bytes = 0
+        self._blob_refs: Dict[str, int] = {}  # blob → число записей
+        self._sizes: Dict[str, int] = {}  # stored → size
+        self._mtimes: Dict[str, int] = {}  # mtime → сколько файлов с ним
+        self._newest: Optional[str] = None  # None при непустом _mtimes — пересчитать лениво
+        for totals in self.albums.values():
+            totals[0] = totals[1] = 0
+
+    def _apply(self, stored: str, entry: Dict[str, Any], sign: int) -> None:
+        size = int(entry.get("size") or 0) * sign
+        self.count += sign
+        self.bytes += size
+        kind = (entry.get("kind") or "file").lower()
+        totals = self.kinds.setdefault(kind, [0, 0])
+        totals[0] += sign
+        totals[1] += size
+        if not totals[0]:
+            del self.kinds[kind]
+        for tag in FacetIndex._tags_of(entry):
+            n = self.tags.get(tag, 0) + sign
+            if n:
+                self.tags[tag] = n
+            else:
+                self.tags.pop(tag, None)
+        for name in self._member_of.get(stored, ()):
+            totals = self.albums[name]
+            totals[0] += sign
+            totals[1] += size
+        if entry.get("path"):
+            return
+        blob = entry.get("blob")
+        if blob:
+            n = self._blob_refs.get(blob, 0) + sign
+            if n:
+                self._blob_refs[blob] = n
+            else:
+                del self._blob_refs[blob]
+            if n != (1 if sign > 0 else 0):
+                return  # блоб уже посчитан (или ещё нужен другим записям)
+        self.local_bytes += size
+
+    def add(self, stored: str, entry: Dict[str, Any]) -> None:
+        self._apply(stored, entry, 1)
+        self._sizes[stored] = int(entry.get("size") or 0)
+        mtime = entry.get("mtime") or ""
+        self._mtimes[mtime] = self._mtimes.get(mtime, 0) + 1
+        if self._newest is not None and mtime > self._newest or len(self._mtimes) == 1:
+            self._newest = mtime
+
+    def discard(self, stored: str, entry: Dict[str, Any]) -> None:
+        self._apply(stored, entry, -1)
+        self._sizes.pop(stored, None)
+        mtime = entry.get("mtime") or ""
+        n = self._mtimes.get(mtime, 0) - 1
+        if n > 0:
+            self._mtimes[mtime] = n
+            return
+        self._mtimes.pop(mtime, None)
+        if mtime == self._newest:
+            self._newest = None  # ушёл самый свежий — max() при следующем запросе
+
+    def newest(self) -> Optional[str]:
+        if self._newest is None and self._mtimes:
+            self._newest = max(self._mtimes)
+        return self._newest or None
+
+    def set_albums(self, albums: List[Dict[str, Any]]) -> None:
+        """Весь состав альбомов заново: O(суммарного числа элементов)."""
+        self._member_of = {}
+        self.albums = {}
+        for album in albums:
+            self.album_add(album.get("name") or "", album.get("items") or [])
+
+    # правки одного альбома — O(числа затронутых элементов)
+
+    def album_add(self, name: str, items: List[str]) -> None:
+        totals = self.albums.setdefault(name, [0, 0])
+        for stored in items:
+            names = self._member_of.setdefault(stored, set())
+            if name in names:
+                continue
+            names.add(name)
+            size = self._sizes.get(stored)
+            if size is not None:
+                totals[0] += 1
+                totals[1] += size
+
+    def album_remove(self, name: str, items: List[str]) -> None:
+        totals = self.albums.get(name)
+        for stored in items:
+            names = self._member_of.get(stored)
+            if not names or name not in names:
+                continue
+            names.discard(name)
+            if not names:
+                del self._member_of[stored]
+            size = self._sizes.get(stored)
+            if size is not None and totals is not None:
+                totals[0] -= 1
+                totals[1] -= size
+
+    def album_drop(self, name: str, items: List[str]) -> None:
+        self.album_remove(name, items)
+        self.albums.pop(name, None)
+
+    def album_rename(self, name: str, new_name: str, items: List[str]) -> None:
+        self.albums[new_name] = self.albums.pop(name, [0, 0])
+        for stored in items:
+            names = self._member_of.get(stored)
+            if names is not None and name in names:
+                names.discard(name)
+                names.add(new_name)
+
+    def drop_member(self, stored: str) -> None:
+        """Запись убрана из всех альбомов (каскад удаления); её размер уже вычтен в discard()."""
+        self._member_of.pop(stored, None)
+
+    def move_member(self, old: str, new: str) -> None:
+        """Каскад переименования: альбомы old теперь содержат new (new уже в индексе)."""
+        names = self._member_of.pop(old, set())
+        mine = self._member_of.setdefault(new, set())
+        size = self._sizes.get(new)
+        for name in names - mine:
+            mine.add(name)
+            if size is not None:
+                self.albums[name][0] += 1
+                self.albums[name][1] += size
+        if not mine:
+            del self._member_of[new]
+
+    def album(self, name: str) -> Dict[str, int]:
+        count, size = self.albums.get(name, (0, 0))
+        return {"count": count, "size": size}
+
+
+class AccessLog:
+    """
+    Время последнего обращения к записям (отдачи /media) — для вытеснения по LRU.
+    touch() только обновляет словарь в памяти; на диск (сайдкар media/access.json)
+    накопленное уходит фоновым потоком не чаще раза в flush_interval секунд и при
+    close(). Записи, которых уже нет в индексе (known()), при сбросе выбрасываются.
+    """
+
+    def __init__(self, path: str, atomic_write, known, flush_interval: float = 30.0):
+        self.path = path
+        self._write = atomic_write
+        self._known = known
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self.last: Dict[str, int] = {k: int(v) for k, v in (json.load(f).get("files") or {}).items()}
+        except Exception:
+            self.last = {}
+
+    def start(self) -> "AccessLog":
+        self._thread = threading.Thread(target=self._run, name="MediaAccessLog", daemon=True)
+        self._thread.start()
+        return self
+
+    def touch(self, stored: str) -> None:
+        with self._lock:
+            self.last[stored] = int(time.time())
+            self._dirty = True
+
+    def get(self, stored: str) -> Optional[int]:
+        return self.last.get(stored)
+
+    def flush(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            known = self._known()
+            self.last = {k: v for k, v in self.last.items() if k in known}
+            data = dict(self.last)
+            self._dirty = False
+        try:
+            self._write(self.path, {"files": data})
+        except Exception as e:
+            self._dirty = True
+            logging.getLogger("mediahub").warning("access log save failed: %s", e)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+        self.flush()
+
+
+class MediaIndex:
+    """
+    Индекс медиатеки в памяти поверх хранилища (MediaCatalog или JsonIndexStore).
+
+    Чтение — snapshot(): неизменяемый срез с номером версии, без разбора файлов.
+    Срез не копирует индекс: изменения с прошлого среза замораживаются новым
+    слоем поверх прежних, слои сливаются, когда верхний дорастает до половины
+    нижнего (см. _merge_layers), — O(изменений) на срез, O(log n) слоёв.
+    Запись — только через transaction() (единственный писатель под блокировкой):
+    изменения сразу видны в памяти и дописываются в журнал media/index.journal
+    (одна строка на транзакцию, fsync), а фоновый поток сбрасывает накопленную
+    пачку в хранилище не чаще раза в flush_interval секунд. После падения
+    журнал доигрывается при старте; close() делает финальный сброс.
+
+    Записи индекса не изменяются на месте: правка = put() новой копии.
+
+    Лента изменений: итог каждой транзакции (added/updated/removed по stored)
+    с её версией хранится в памяти, последние CHANGE_LOG записей — для /api/events
+    и /api/changes. changes_since(v) отдаёт всё после версии v или None, если
+    лента этот промежуток уже не покрывает (вытеснено, очистка индекса, перезапуск).
+    """
+
+    CHANGE_LOG = 20000
+
+    def __init__(self, store, journal_path: str, flush_interval: float = 2.0):
+        self._store = store
+        self.JOURNAL_PATH = journal_path
+        self.flush_interval = max(0.0, float(flush_interval))
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._closed = threading.Event()
+        self._pending: List[list] = []
+        self._views: List[IndexView] = []
+        self._journal_tail: List[tuple] = []  # (version, line) ещё не сброшенных транзакций
+
+        version, files = store.load()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        for it in files:
+            key = _entry_key(it)
+            if key:
+                self._entries[key] = it
+        self._version = version
+        self._flushed_version = version
+        self._layers: tuple = ()  # неизменяемые слои последнего среза, новые первыми
+        self._delta: Dict[str, Any] = {}  # изменения после последнего среза (_GONE — удалена)
+
+        self._replay_journal()
+        self._layers, self._delta = (dict(self._entries),), {}
+        self._snap = IndexSnapshot(self._version, self._layers, len(self._entries))
+        self._feed = threading.Condition()
+        self._changes: "deque[tuple]" = deque()  # (версия, вид, stored, запись или None)
+        self._feed_version = self._version  # последняя версия, уже попавшая в ленту
+        self._changes_floor = self._version  # после этой версии лента полная
+        self._journal = open(self.JOURNAL_PATH, "a", encoding="utf-8")
+        self._flusher = threading.Thread(target=self._flush_loop, name="MediaIndexFlusher", daemon=True)
+        self._flusher.start()
+
+    # ---- чтение ----
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @property
+    def closed(self) -> bool:
+        return self._closed.is_set()
+
+    def snapshot(self) -> IndexSnapshot:
+        snap = self._snap
+        if snap.version == self._version:
+            return snap
+        with self._lock:
+            if self._snap.version != self._version:
+                if self._delta:
+                    self._layers = self._merge_layers((self._delta,) + self._layers)
+                    self._delta = {}
+                self._snap = IndexSnapshot(self._version, self._layers, len(self._entries))
+            return self._snap
+
+    @staticmethod
+    def _merge_layers(layers: tuple) -> tuple:
+        """Сливает верхний слой с нижним, пока верхний не меньше половины нижнего (в среднем O(1) на запись)."""
+        layers = list(layers)
+        while len(layers) > 1 and 2 * len(layers[0]) >= len(layers[1]):
+            top = layers.pop(0)
+            merged = dict(layers[0])
+            merged.update(top)
+            if len(layers) == 1:
+                merged = {k: v for k, v in merged.items() if v is not _GONE}  # под базой ничего нет
+            layers[0] = merged
+        return tuple(layers)
+
+    def get(self, stored: str) -> Optional[Dict[str, Any]]:
+        """Текущая запись (записи не изменяются на месте, поэтому без блокировки)."""
+        return self._entries.get(stored)
+
+    def locked(self):
+        """Блокировка писателя — для запросов к вторичным индексам (IndexView)."""
+        return self._lock
+
+    def attach(self, view: "IndexView") -> "IndexView":
+        """Подключает вторичный индекс: заполняет его текущими записями и дальше ведёт инкрементально."""
+        with self._lock:
+            view.reset()
+            view.bulk_add(self._entries.items())
+            self._views.append(view)
+        return view
+
+    # ---- запись ----
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            txn = _IndexTxn(self)
+            try:
+                yield txn
+            finally:
+                # что уже применено в памяти — фиксируем, иначе память разойдётся с журналом
+                if txn.ops:
+                    self._commit(txn.ops)
+                    self._publish(txn)
+
+    def put(self, item: Dict[str, Any]) -> None:
+        with self.transaction() as tx:
+            tx.put(item)
+
+    def delete(self, stored: str) -> Optional[Dict[str, Any]]:
+        with self.transaction() as tx:
+            return tx.delete(stored)
+
+    def clear(self) -> None:
+        with self.transaction() as tx:
+            tx.clear()
+
+    def _commit(self, ops: List[list]) -> None:
+        self._version += 1
+        line = json.dumps({"v": self._version, "ops": ops}, ensure_ascii=False)
+        try:
+            self._journal.write(line + "\n")
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+        except Exception as e:
+            logging.getLogger("mediahub").warning("index journal write failed: %s", e)
+        self._journal_tail.append((self._version, line))
+        self._pending.extend(ops)
+        self._dirty.set()
+
+    # ---- лента изменений ----
+
+    def _publish(self, txn: "_IndexTxn") -> None:
+        with self._feed:
+            version = self._version
+            if txn.reset:
+                # после очистки клиентам нужен полный список
+                self._changes.clear()
+                self._changes_floor = version
+            else:
+                for stored, kind in txn.changed.items():
+                    self._changes.append((version, kind, stored, None if kind == "removed" else self._entries.get(stored)))
+                while len(self._changes) > self.CHANGE_LOG:
+                    self._changes_floor = self._changes.popleft()[0]
+            self._feed_version = version
+            self._feed.notify_all()
+
+    def changes_since(self, since: int) -> tuple:
+        """(текущая версия, [(версия, вид, stored, запись)] после since) или (версия, None) — нужен полный список."""
+        with self._feed:
+            current = self._feed_version
+            if since > current or since < self._changes_floor:
+                return current, None
+            out = []
+            for rec in reversed(self._changes):
+                if rec[0] <= since:
+                    break
+                out.append(rec)
+            out.reverse()
+            return current, out
+
+    def wait_changes(self, since: int, timeout: float) -> bool:
+        """Ждёт версию новее since не дольше timeout; False — не дождались (или индекс закрыт)."""
+        with self._feed:
+            return self._feed.wait_for(lambda: self._feed_version != since or self._closed.is_set(), timeout) \
+                and not self._closed.is_set()
+
+    # ---- журнал и сброс ----
+
+    def _replay_journal(self) -> None:
+        try:
+            with open(self.JOURNAL_PATH, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        replayed = False
+        for line in lines:
+            try:
+                rec = json.loads(line)
+                v, ops = int(rec["v"]), rec["ops"]
+            except Exception:
+                break  # оборванная последняя строка — транзакция не состоялась
+            if v <= self._version:
+                continue
+            txn = _IndexTxn(self)
+            for op in ops:
+                if op[0] == "put": txn.put(op[2])
+                elif op[0] == "del": txn.delete(op[1])
+                elif op[0] == "ren": txn.rename(op[1], op[3])
+                elif op[0] == "clear": txn.clear()
+            self._version = v
+            self._pending.extend(txn.ops)
+            self._journal_tail.append((v, line.rstrip("\n")))
+            replayed = True
+        if replayed and not self._write_store():
+            # хранилище недоступно — доигранное есть только в памяти и в журнале: журнал остаётся
+            # (без оборванного хвоста, чтобы новые строки не легли за ним), его сократит следующий сброс
+            self._rewrite_journal()
+            return
+        # журнал уже отражён в хранилище
+        open(self.JOURNAL_PATH, "w", encoding="utf-8").close()
+        self._journal_tail = []
+
+    def _write_store(self) -> bool:
+        with self._lock:
+            if not self._pending and self._flushed_version == self._version:
+                return True
+            ops, self._pending = self._pending, []
+            version = self._version
+            files = None if self._store.incremental else list(self._entries.values())
+        try:
+            self._store.write(version, ops, files)
+        except Exception as e:
+            logging.getLogger("mediahub").warning("index flush failed: %s", e)
+            with self._lock:
+                self._pending[:0] = ops
+                self._dirty.set()
+            return False
+        with self._lock:
+            self._flushed_version = version
+            self._compact_journal(version)
+        return True
+
+    def _compact_journal(self, flushed_version: int) -> None:
+        """Оставляет в журнале только транзакции новее сброшенной версии."""
+        self._journal_tail = [(v, line) for v, line in self._journal_tail if v > flushed_version]
+        if not hasattr(self, "_journal"):
+            return
+        self._journal.close()
+        self._rewrite_journal()
+        self._journal = open(self.JOURNAL_PATH, "a", encoding="utf-8")
+
+    def _rewrite_journal(self) -> None:
+        """Журнал = строки _journal_tail (атомарно, через .tmp)."""
+        try:
+            tmp = self.JOURNAL_PATH + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.writelines(line + "\n" for _, line in self._journal_tail)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.JOURNAL_PATH)
+        except Exception as e:
+            logging.getLogger("mediahub").warning("index journal compaction failed: %s", e)
+
+    def flush(self) -> bool:
+        """Синхронно сбрасывает накопленные изменения в хранилище."""
+        with self._flush_lock:
+            return self._write_store()
+
+    def _flush_loop(self) -> None:
+        last = 0.0
+        while not self._closed.is_set():
+            self._dirty.wait()
+            if self._closed.is_set():
+                break
+            delay = last + self.flush_interval - time.monotonic()
+            if delay > 0 and self._closed.wait(delay):
+                break
+            self._dirty.clear()
+            self.flush()
+            last = time.monotonic()
+
+    def close(self) -> None:
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._dirty.set()
+        with self._feed:
+            self._feed.notify_all()
+        self.flush()
+        with self._lock:
+            try:
+                self._journal.close()
+            except Exception:
+                pass
+        self._store.close()
+
+
+class MediaWatcher:
+    """
+    Фоновое слежение за каталогом: inotify (Linux, через ctypes — без
+    зависимостей) или опрос (переносимый запасной вариант): mtime каталога —
+    дешёвый признак, а изменения — по сравнению списка файлов (имя → размер,
+    mtime) без игнорируемых, так что служебные файлы самого сервера
+    (журнал индекса, access.json, ...) перескан не вызывают.
+
+    События копятся и отдаются пачкой в on_changes(names) после debounce
+    секунд тишины (но не позже max_delay от первого события). names=None —
+    «что-то изменилось, имён нет» (переполнение очереди inotify).
+    inotify слушает только завершённую запись/переименование/удаление, так что
+    долгое копирование большого файла даёт одно событие, а не тысячи.
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self, directory: str, on_changes, ignore=None,
+                 debounce: float = 1.0, max_delay: float = 10.0, poll_interval: float = 2.0):
+        self.directory = directory
+        self.on_changes = on_changes
+        self.ignore = ignore or (lambda name: False)
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.backend = "none"
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "MediaWatcher":
+        fd = self._inotify_open()
+        if fd is not None:
+            self.backend = "inotify"
+            target, args = self._run_inotify, (fd,)
+        else:
+            self.backend = "polling"
+            target, args = self._run_polling, ()
+        self._thread = threading.Thread(target=target, args=args, name="MediaWatcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=2.0)
+
+    def _emit(self, names: Optional[set]) -> None:
+        try:
+            self.on_changes(names)
+        except Exception as e:
+            logging.getLogger("mediahub").warning("watcher callback failed: %s", e)
+
+    # ---- inotify ----
+
+    def _inotify_open(self) -> Optional[int]:
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return None
+            mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_DELETE
+            if libc.inotify_add_watch(fd, os.fsencode(self.directory), mask) < 0:
+                os.close(fd)
+                return None
+            return fd
+        except (OSError, AttributeError):
+            return None
+
+    def _run_inotify(self, fd: int) -> None:
+        pending: set = set()
+        overflow = False
+        first = last = 0.0
+        try:
+            while not self._stop.is_set():
+                ready, _, _ = select.select([fd], [], [], 0.25)
+                now = time.monotonic()
+                if ready:
+                    try:
+                        buf = os.read(fd, 64 * 1024)
+                    except BlockingIOError:
+                        buf = b""
+                    pos = 0
+                    while pos + self._EVENT.size <= len(buf):
+                        _wd, mask, _cookie, length = self._EVENT.unpack_from(buf, pos)
+                        pos += self._EVENT.size
+                        name = buf[pos:pos + length].rstrip(b"\0").decode("utf-8", "surrogateescape")
+                        pos += length
+                        if mask & self.IN_Q_OVERFLOW:
+                            overflow = True
+                        elif name and not mask & self.IN_ISDIR and not self.ignore(name):
+                            pending.add(name)
+                        else:
+                            continue
+                        if not first:
+                            first = now
+                        last = now
+                if first and (now - last >= self.debounce or now - first >= self.max_delay):
+                    self._emit(None if overflow else pending)
+                    pending, overflow, first, last = set(), False, 0.0, 0.0
+        finally:
+            os.close(fd)
+
+    # ---- опрос ----
+
+    def _run_polling(self) -> None:
+        def dir_mtime() -> int:
+            try:
+                return os.stat(self.directory).st_mtime_ns
+            except OSError:
+                return 0
+
+        def listing() -> Dict[str, tuple]:
+            found: Dict[str, tuple] = {}
+            try:
+                with os.scandir(self.directory) as it:
+                    for entry in it:
+                        if self.ignore(entry.name):
+                            continue
+                        try:
+                            if entry.is_file(follow_symlinks=False):
+                                st = entry.stat(follow_symlinks=False)
+                                found[entry.name] = (st.st_size, st.st_mtime_ns)
+                        except OSError:
+                            continue
+            except OSError:
+                pass
+            return found
+
+        seen_mtime = dir_mtime()
+        base = seen = listing()  # base — список до начала текущей серии изменений
+        changed_at = 0.0
+        while not self._stop.wait(self.poll_interval if not changed_at else min(self.poll_interval, self.debounce)):
+            current_mtime = dir_mtime()
+            now = time.monotonic()
+            if current_mtime != seen_mtime or changed_at:
+                # пока серия идёт, перечитываем и без смены mtime: копирование дописывает уже созданный файл
+                seen_mtime = current_mtime
+                current = listing()
+                if current != seen:
+                    # каталог меняется — ждём, пока успокоится
+                    seen = current
+                    changed_at = changed_at or now
+                    if now - changed_at < self.max_delay:
+                        continue
+            if changed_at:
+                changed_at = 0.0
+                names = {n for n in base.keys() | seen.keys() if base.get(n) != seen.get(n)}
+                base = seen
+                if names:
+                    self._emit(names)
+
+
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _exif_orientation(data: bytes) -> int:
+    """Тег Orientation (0x0112) из IFD0 сегмента APP1 «Exif»; 1 — если его нет."""
+    if not data.startswith(b"Exif\0\0") or len(data) < 14:
+        return 1
+    tiff = data[6:]
+    order = {b"II": "<", b"MM": ">"}.get(tiff[:2])
+    if order is None:
+        return 1
+    try:
+        ifd = struct.unpack_from(order + "I", tiff, 4)[0]
+        count = struct.unpack_from(order + "H", tiff, ifd)[0]
+        for i in range(count):
+            tag, _type, _n, value = struct.unpack_from(order + "HHIH", tiff, ifd + 2 + 12 * i)
+            if tag == 0x0112:
+                return value if 1 <= value <= 8 else 1
+    except struct.error:
+        pass
+    return 1
+
+
+def _image_size(path: str) -> Optional[tuple]:
+    """
+    (ширина, высота, orientation) картинки по заголовку — PNG, JPEG, GIF, WebP, BMP.
+    Читаются первые байты файла (у JPEG — только заголовки сегментов до SOF),
+    размеры — как при показе, т. е. с учётом поворота EXIF (orientation 5–8 меняют
+    стороны местами). None — формат не распознан или файл повреждён.
+    """
+    try:
+        with open(path, "rb") as f:
+            head = f.read(32)
+            if head[:8] == b"\x89PNG\r\n\x1a\n" and head[12:16] == b"IHDR":
+                w, h = struct.unpack(">II", head[16:24])
+                return w, h, 1
+            if head[:6] in (b"GIF87a", b"GIF89a"):
+                w, h = struct.unpack("<HH", head[6:10])
+                return w, h, 1
+            if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+                chunk = head[12:16]
+                if chunk == b"VP8X":
+                    w = int.from_bytes(head[24:27], "little") + 1
+                    h = int.from_bytes(head[27:30], "little") + 1
+                    return w, h, 1
+                if chunk == b"VP8 " and head[23:26] == b"\x9d\x01\x2a":
+                    w, h = struct.unpack("<HH", head[26:30])
+                    return w & 0x3FFF, h & 0x3FFF, 1
+                if chunk == b"VP8L" and head[20] == 0x2F:
+                    bits = int.from_bytes(head[21:25], "little")
+                    return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1, 1
+                return None
+            if head[:2] == b"BM":
+                if int.from_bytes(head[14:18], "little") == 12:  # OS/2 BITMAPCOREHEADER
+                    w, h = struct.unpack("<HH", head[18:22])
+                else:
+                    w, h = struct.unpack("<ii", head[18:26])
+                return abs(w), abs(h), 1
+            if head[:2] != b"\xff\xd8":
+                return None
+            # JPEG: идём по сегментам, не читая их содержимое (кроме APP1 с EXIF)
+            pos, orientation = 2, 1
+            while True:
+                f.seek(pos)
+                marker = f.read(2)
+                while len(marker) == 2 and marker[0] == 0xFF and marker[1] == 0xFF:
+                    marker = marker[1:] + f.read(1)  # байты-заполнители
+                    pos += 1
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    return None
+                code = marker[1]
+                if code == 0x01 or 0xD0 <= code <= 0xD8:
+                    pos += 2
+                    continue
+                if code in (0xD9, 0xDA):  # конец или данные скана до SOF — битый файл
+                    return None
+                seg = f.read(2)
+                if len(seg) < 2:
+                    return None
+                length = int.from_bytes(seg, "big")
+                if code in _JPEG_SOF:
+                    body = f.read(5)
+                    if len(body) < 5:
+                        return None
+                    h, w = struct.unpack(">HH", body[1:5])
+                    return (h, w, orientation) if orientation >= 5 else (w, h, orientation)
+                if code == 0xE1 and orientation == 1:
+                    orientation = _exif_orientation(f.read(min(length - 2, 4096)))
+                pos += 2 + length
+    except (OSError, struct.error, IndexError):
+        return None
+
+
+def _render_thumb(src: str, dst: str, w: int, h: int, fmt: str, quality: int = 82) -> bool:
+    """
+    Превью src в dst (вписано в w×h, пропорции сохраняются) через QImage.
+    Выполняется в пуле ThumbCache (потоки или процессы) — поэтому функция модульного уровня.
+    """
+    from PyQt5.QtCore import Qt
+    from PyQt5.QtGui import QColor, QImage, QImageReader, QPainter
+
+    reader = QImageReader(src)
+    reader.setAutoTransform(True)  # поворот по EXIF
+    size = reader.size()
+    if size.isValid() and (size.width() > 2 * w or size.height() > 2 * h):
+        # JPEG декодируется сразу в уменьшенном масштабе — 20-мегапиксельный снимок не разворачивается целиком
+        reader.setScaledSize(size.scaled(2 * w, 2 * h, Qt.KeepAspectRatio))
+    img = reader.read()
+    if img.isNull():
+        return False
+    if img.width() > w or img.height() > h:
+        img = img.scaled(w, h, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    if fmt == "jpg" and img.hasAlphaChannel():
+        flat = QImage(img.size(), QImage.Format_RGB32)
+        flat.fill(QColor("white"))
+        painter = QPainter(flat)
+        painter.drawImage(0, 0, img)
+        painter.end()
+        img = flat
+    tmp = f"{dst}.{os.getpid()}.tmp"
+    if not img.save(tmp, ThumbCache.FORMATS[fmt][0], quality):
+        return False
+    os.replace(tmp, dst)
+    return True
+
+
+def _dhash(src: str) -> Optional[str]:
+    """
+    Разностный хэш картинки (dHash, 64 бита → 16 hex): яркость 9×8, бит — «левый
+    пиксель ярче правого». Декодируется сразу в малом масштабе; функция
+    модульного уровня — выполняется в пуле ThumbCache.
+    """
+    from PyQt5.QtCore import QSize, Qt
+    from PyQt5.QtGui import QImage, QImageReader
+
+    reader = QImageReader(src)
+    reader.setAutoTransform(True)
+    size = reader.size()
+    if size.isValid() and (size.width() > 64 or size.height() > 64):
+        reader.setScaledSize(QSize(64, 64))  # пропорции не важны — хэш всё равно 9×8
+    img = reader.read()
+    if img.isNull():
+        return None
+    img = img.scaled(9, 8, Qt.IgnoreAspectRatio, Qt.SmoothTransformation).convertToFormat(QImage.Format_Grayscale8)
+    bits = 0
+    for y in range(8):
+        row = [img.pixel(x, y) & 0xFF for x in range(9)]
+        for x in range(8):
+            bits = (bits << 1) | (row[x] > row[x + 1])
+    return f"{bits:016x}"
+
+
+class ThumbCache:
+    """
+    Дисковый кэш превью: имя файла — хэш (содержимое, размер, формат), так что
+    одинаковые файлы делят превью, а изменённый файл получает новое.
+
+    Генерация — в пуле потоков (QImage в _render_thumb отпускает GIL), запросы
+    одного и того же превью ждут общий Future. Объём ограничен max_bytes:
+    вытесняются давно не запрошенные (LRU, порядок переживает перезапуск через mtime).
+
+    processes=True — пул процессов (spawn). Его включает только точка входа под
+    if __name__ == "__main__": spawn заново импортирует главный модуль в каждом
+    воркере, а в замороженной сборке (PyInstaller) без freeze_support — запускает
+    всё приложение; поэтому при sys.frozen всегда потоки. Если процессы не
+    стартуют — тот же рендер в потоках.
+    """
+
+    FORMATS = {"jpg": ("JPG", "image/jpeg"), "png": ("PNG", "image/png"), "webp": ("WEBP", "image/webp")}
+
+    def __init__(self, directory: str, max_bytes: int = 512 << 20, workers: Optional[int] = None,
+                 processes: bool = False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.workers = workers or max(1, min(4, (os.cpu_count() or 2) - 1))
+        self.processes = processes and not getattr(sys, "frozen", False)
+        self.available = importlib.util.find_spec("PyQt5") is not None
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pending: Dict[str, Any] = {}
+        self._lru: "OrderedDict[str, int]" = OrderedDict()  # имя → размер, от давних к свежим
+        self._bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        found = []
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    st = entry.stat()
+                    found.append((st.st_mtime, entry.name, st.st_size))
+        for _, name, size in sorted(found):
+            self._lru[name] = size
+            self._bytes += size
+
+    @staticmethod
+    def key(content: str, w: int, h: int, fmt: str) -> str:
+        return f"{hashlib.sha1(f'{content}:{w}x{h}'.encode('utf-8')).hexdigest()}.{fmt}"
+
+    def _executor(self):
+        if self._pool is None:
+            if self.processes:
+                try:
+                    self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+                except (OSError, ValueError, NotImplementedError):
+                    self.processes = False
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="MediaThumb")
+        return self._pool
+
+    def _submit(self, fn, *args):
+        """Вызывать под self._lock."""
+        pool = self._executor()
+        try:
+            return pool.submit(fn, *args)
+        except (RuntimeError, OSError, BrokenProcessPool):
+            if not isinstance(pool, ProcessPoolExecutor):
+                raise
+            # spawn не может стартовать — потоки
+            self.processes = False
+            if self._pool is pool:
+                self._pool = None
+            pool.shutdown(wait=False, cancel_futures=True)
+            return self._executor().submit(fn, *args)
+
+    def run(self, fn, *args):
+        """Другая работа с картинками (fn модульного уровня) в том же пуле → Future."""
+        with self._lock:
+            return self._submit(fn, *args)
+
+    def lookup(self, name: str) -> Optional[str]:
+        with self._lock:
+            if name not in self._lru:
+                return None
+            self._lru.move_to_end(name)
+        path = os.path.join(self.directory, name)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def get(self, src: str, content: str, w: int, h: int, fmt: str, wait: bool = True,
+            timeout: float = 60.0) -> Optional[str]:
+        """Путь готового превью; wait=False — только поставить в очередь (после загрузки)."""
+        name = self.key(content, w, h, fmt)
+        path = self.lookup(name)
+        if path is not None or not self.available:
+            return path
+        with self._lock:
+            fut = self._pending.get(name)
+            created = fut is None
+            if created:
+                fut = self._submit(_render_thumb, src, os.path.join(self.directory, name), w, h, fmt)
+                self._pending[name] = fut
+        if created:
+            # вне блокировки: у уже готового Future колбэк вызывается сразу в этом потоке
+            fut.add_done_callback(lambda f, n=name: self._done(n, f))
+        if not wait:
+            return None
+        try:
+            ok = fut.result(timeout=timeout)
+        except BrokenProcessPool:
+            # процесс-воркер упал (или spawn недоступен) — дальше рендерим в потоках
+            with self._lock:
+                if self.processes:
+                    self.processes = False
+                    self._pool = None
+            return self.get(src, content, w, h, fmt, wait, timeout)
+        except Exception as e:
+            logging.getLogger("mediahub").warning("thumbnail failed for %s: %s", src, e)
+            return None
+        return os.path.join(self.directory, name) if ok else None
+
+    def _done(self, name: str, fut) -> None:
+        evict: List[str] = []
+        with self._lock:
+            self._pending.pop(name, None)
+            if fut.cancelled() or fut.exception() is not None or not fut.result():
+                return
+            try:
+                size = os.path.getsize(os.path.join(self.directory, name))
+            except OSError:
+                return
+            self._bytes += size - self._lru.pop(name, 0)
+            self._lru[name] = size
+            while self._bytes > self.max_bytes and len(self._lru) > 1:
+                old, old_size = self._lru.popitem(last=False)
+                self._bytes -= old_size
+                evict.append(old)
+        for old in evict:
+            try:
+                os.remove(os.path.join(self.directory, old))
+            except OSError:
+                pass
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class MetadataExtractor(IndexView):
+    """
+    Фоновое извлечение метаданных аудио/видео (mutagen) в поле media записи:
+    duration, bitrate, sample_rate, channels, artist, album, title; встроенная
+    обложка сохраняется в covers_dir (имя — хэш картинки) и отдаётся через /api/thumb.
+    Пользовательские props (/api/meta) — отдельно: правка одних не трогает другие.
+
+    Как view индекса видит каждую новую или изменённую запись и ставит её в
+    очередь, если у записи нет отметки meta_v для текущих (версия, размер, mtime):
+    загрузка, перескан и import-dir ничего не ждут, а после перезапуска
+    необработанные записи снова попадают в очередь при загрузке индекса.
+    Пока идут отдачи /media (busy()), между файлами делается пауза.
+    """
+
+    VERSION = 2  # 1 — извлечённое лежало в props
+    KINDS = ("audio", "video")
+    BATCH = 64
+    BUSY_PAUSE = 0.25
+
+    def __init__(self, index: "MediaIndex", resolve, covers_dir: str, busy=None, on_cover=None):
+        self.index = index
+        self.resolve = resolve  # stored → абсолютный путь
+        self.covers_dir = covers_dir
+        self.busy = busy or (lambda: False)
+        self.on_cover = on_cover
+        self._queue: "deque[str]" = deque()
+        self._queued: set = set()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def stamp(cls, entry: Dict[str, Any]) -> str:
+        return f"{cls.VERSION}:{entry.get('size')}:{entry.get('mtime')}"
+
+    def reset(self) -> None:
+        self._queue.clear()
+        self._queued.clear()
+
+    def add(self, stored: str, entry: Dict[str, Any]) -> None:
+        if entry.get("kind") in self.KINDS and entry.get("meta_v") != self.stamp(entry) and stored not in self._queued:
+            self._queued.add(stored)
+            self._queue.append(stored)
+            self._wake.set()
+
+    def start(self) -> "MetadataExtractor":
+        if mutagen is not None:
+            self._thread = threading.Thread(target=self._run, name="MediaMeta", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+
+    @property
+    def pending(self) -> int:
+        return len(self._queue)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            if not self._queue:
+                self._wake.wait(1.0)
+                self._wake.clear()
+                continue
+            results: Dict[str, tuple] = {}
+            while self._queue and len(results) < self.BATCH and not self._stop.is_set():
+                stored = self._queue.popleft()
+                self._queued.discard(stored)
+                entry = self.index.get(stored)
+                if entry is None or entry.get("meta_v") == self.stamp(entry):
+                    continue
+                path = self.resolve(stored)
+                results[stored] = (self.stamp(entry), self.extract(path) if path else ({}, None))
+                if self.busy():
+                    self._stop.wait(self.BUSY_PAUSE)
+            self._apply(results)
+
+    def _apply(self, results: Dict[str, tuple]) -> None:
+        """Пачка результатов — одна транзакция; запись, изменившаяся за время разбора, остаётся в очереди."""
+        covers = []
+        with self.index.transaction() as tx:
+            for stored, (stamp, (media, cover)) in results.items():
+                it = tx.get(stored)
+                if it is None or self.stamp(it) != stamp:
+                    continue
+                it = dict(it)
+                if str(it.get("meta_v") or "").startswith("1:") and it.get("props"):
+                    # версия 1 дописывала извлечённое в props — оттуда уходит то, что совпадает с извлечённым
+                    it["props"] = {k: v for k, v in it["props"].items() if media.get(k) != v}
+                it["media"] = media
+                if cover:
+                    it["cover"] = cover
+                it["meta_v"] = stamp
+                tx.put(it)
+                if cover:
+                    covers.append(it)
+        if self.on_cover is not None:
+            for it in covers:
+                self.on_cover(it)
+
+    # имена тегов по семействам форматов: ID3 (mp3/wav/aiff), MP4, ASF (wma); остальные — Vorbis-стиль
+    TAG_KEYS = {
+        "artist": ("TPE1", "\xa9ART", "Author", "artist"),
+        "album": ("TALB", "\xa9alb", "WM/AlbumTitle", "album"),
+        "title": ("TIT2", "\xa9nam", "Title", "title"),
+    }
+
+    def extract(self, path: str) -> tuple:
+        """(поля для media, имя файла обложки или None); ошибки разбора — пустой результат."""
+        try:
+            raw = mutagen.File(path)
+        except Exception:
+            raw = None
+        if raw is None:
+            return {}, None
+        media: Dict[str, Any] = {}
+        info = getattr(raw, "info", None)
+        for key, attr, conv in (("duration", "length", lambda v: round(float(v), 3)),
+                                ("bitrate", "bitrate", lambda v: int(v) // 1000),
+                                ("sample_rate", "sample_rate", int),
+                                ("channels", "channels", int)):
+            value = getattr(info, attr, None)
+            if value:
+                media[key] = conv(value)
+        tags = getattr(raw, "tags", None)
+        if tags:
+            for key, names in self.TAG_KEYS.items():
+                for name in names:
+                    try:
+                        value = tags.get(name)
+                    except Exception:
+                        value = None
+                    if hasattr(value, "text"):  # кадр ID3
+                        value = value.text
+                    if isinstance(value, list):
+                        value = value[0] if value else None
+                    if value:
+                        media[key] = str(value)[:1024]
+                        break
+        try:
+            cover = self._save_cover(raw)
+        except Exception:
+            cover = None
+        return media, cover
+
+    def _save_cover(self, raw) -> Optional[str]:
+        data, mime = self._find_picture(raw)
+        if not data:
+            return None
+        name = f"{hashlib.sha1(data).hexdigest()}.{'png' if 'png' in (mime or '') else 'jpg'}"
+        dst = os.path.join(self.covers_dir, name)
+        if not os.path.exists(dst):  # у треков одного альбома обложка общая
+            os.makedirs(self.covers_dir, exist_ok=True)
+            tmp = f"{dst}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, dst)
+        return name
+
+    @staticmethod
+    def _find_picture(raw) -> tuple:
+        """Встроенная картинка: ID3 APIC, FLAC picture, MP4 covr, Vorbis METADATA_BLOCK_PICTURE."""
+        if raw is None:
+            return None, None
+        pictures = getattr(raw, "pictures", None)
+        if pictures:
+            return pictures[0].data, pictures[0].mime
+        tags = getattr(raw, "tags", None)
+        if not tags:
+            return None, None
+        try:
+            for key in tags.keys():
+                if key.startswith("APIC"):
+                    frame = tags[key]
+                    return frame.data, frame.mime
+            if "covr" in tags and tags["covr"]:
+                cover = tags["covr"][0]
+                return bytes(cover), ("image/png" if getattr(cover, "imageformat", 0) == 14 else "image/jpeg")
+            if "metadata_block_picture" in tags:
+                from mutagen.flac import Picture
+                pic = Picture(base64.b64decode(tags["metadata_block_picture"][0]))
+                return pic.data, pic.mime
+        except Exception:
+            pass
+        return None, None
+
+
+class ImageHashes(IndexView):
+    """
+    Перцептивные хэши картинок (dHash, см. _dhash) и поиск почти-дубликатов:
+    один и тот же снимок с разных телефонов, пережатый или уменьшенный.
+
+    Хэши считаются в фоне в пуле ThumbCache и пишутся в запись: phash и отметка
+    phash_v (как meta_v у MetadataExtractor). Одинаковое содержимое (sha256)
+    повторно не декодируется. В пуле одновременно не больше CONCURRENCY задач —
+    превью не ждут за пачкой хэшей. Картинки без хэша, найденные при старте,
+    ждут STARTUP_DELAY секунд (или первого want() из /api/duplicates), чтобы
+    запуск не начинался с декодирования всей библиотеки; новые — сразу.
+
+    Соседи ищутся через multi-index hashing: 64 бита делятся на BANDS полос, у каждой
+    полосы таблица «значение полосы → {хэши}». Хэши, отличающиеся не больше чем на
+    MAX_THRESHOLD = BANDS - 1 бит, хотя бы в одной полосе совпадают, поэтому кандидаты —
+    хэши из тех же ячеек. Найденные пары с расстоянием хранятся как граф (near) и
+    ведутся при каждом добавлении, так что clusters() — компоненты связности по рёбрам
+    не длиннее порога, без перебора библиотеки. Граф для записей, загруженных
+    при старте, строится в фоне пачками.
+    """
+
+    VERSION = 1
+    BANDS = 5
+    MAX_THRESHOLD = BANDS - 1
+    BATCH = 32
+    LINK_BATCH = 500
+    BUSY_PAUSE = 0.25
+    CONCURRENCY = 2
+    STARTUP_DELAY = 60.0
+
+    def __init__(self, index: "MediaIndex", resolve, submit, busy=None):
+        self.index = index
+        self.resolve = resolve  # stored → абсолютный путь
+        self.submit = submit  # (fn, *args) → Future, см. ThumbCache.run
+        self.busy = busy or (lambda: False)
+        self._queue: "deque[str]" = deque()
+        self._deferred: "deque[str]" = deque()  # найденные при старте, см. STARTUP_DELAY
+        self._queued: set = set()
+        self._wake = threading.Event()
+        self._wanted = threading.Event()
+        self._stop = threading.Event()
+        self._slots = threading.BoundedSemaphore(self.CONCURRENCY)
+        self._thread: Optional[threading.Thread] = None
+        self._bulk = False
+        self.reset()
+
+    @classmethod
+    def stamp(cls, entry: Dict[str, Any]) -> str:
+        return f"{cls.VERSION}:{entry.get('size')}:{entry.get('mtime')}"
+
+    def reset(self) -> None:
+        self.hashes: Dict[str, int] = {}  # stored → хэш
+        self.members: Dict[int, set] = {}  # хэш → {stored}
+        self.bands: List[Dict[int, set]] = [{} for _ in range(self.BANDS)]  # значение полосы → {хэш}
+        self.near: Dict[int, Dict[int, int]] = {}  # хэш → {соседний хэш: расстояние}
+        self.by_sha: Dict[str, str] = {}
+        self._unlinked: set = set()  # хэши, соседи которых ещё не найдены (загружены при старте)
+        self._clusters: Optional[tuple] = None  # (поколение, порог, кластеры)
+        self._gen = 0
+        self._queue.clear()
+        self._deferred.clear()
+        self._queued.clear()
+
+    def _band_keys(self, value: int) -> List[int]:
+        # полосы по 13 бит (последняя — 12)
+        width = -(-64 // self.BANDS)
+        mask = (1 << width) - 1
+        return [(value >> (width * i)) & mask for i in range(self.BANDS)]
+
+    def bulk_add(self, items) -> None:
+        self._bulk = True
+        try:
+            super().bulk_add(items)
+        finally:
+            self._bulk = False
+
+    def add(self, stored: str, entry: Dict[str, Any]) -> None:
+        if entry.get("kind") != "images":
+            return
+        if entry.get("phash_v") != self.stamp(entry):
+            if stored not in self._queued:
+                self._queued.add(stored)
+                (self._deferred if self._bulk else self._queue).append(stored)
+                self._wake.set()
+            return
+        if not entry.get("phash"):
+            return  # не декодировалась
+        value = int(entry["phash"], 16)
+        self.hashes[stored] = value
+        same = self.members.setdefault(value, set())
+        if not same:
+            for table, key in zip(self.bands, self._band_keys(value)):
+                table.setdefault(key, set()).add(value)
+            if self._bulk:
+                self._unlinked.add(value)
+            else:
+                self._link(value)
+        same.add(stored)
+        if entry.get("sha256"):
+            self.by_sha[entry["sha256"]] = entry["phash"]
+        self._gen += 1
+
+    def discard(self, stored: str, entry: Dict[str, Any]) -> None:
+        value = self.hashes.pop(stored, None)
+        if value is None:
+            return
+        same = self.members.get(value)
+        if same is not None:
+            same.discard(stored)
+            if not same:
+                del self.members[value]
+                for table, key in zip(self.bands, self._band_keys(value)):
+                    cell = table.get(key)
+                    if cell is not None:
+                        cell.discard(value)
+                        if not cell:
+                            del table[key]
+                self._unlinked.discard(value)
+                for other in self.near.pop(value, {}):
+                    edges = self.near.get(other)
+                    if edges is not None:
+                        edges.pop(value, None)
+                        if not edges:
+                            del self.near[other]
+        self._gen += 1
+
+    def _link(self, value: int) -> None:
+        """Рёбра от value ко всем хэшам не дальше MAX_THRESHOLD бит."""
+        near, limit = self.near, self.MAX_THRESHOLD
+        for table, key in zip(self.bands, self._band_keys(value)):
+            for other in table.get(key, ()):
+                d = (value ^ other).bit_count()
+                if d <= limit and other != value:
+                    near.setdefault(value, {})[other] = d
+                    near.setdefault(other, {})[value] = d
+
+    def _link_backlog(self, limit: Optional[int] = None) -> None:
+        """Соседи для хэшей из _unlinked (все или не больше limit); вызывать под MediaIndex.locked()."""
+        while self._unlinked and (limit is None or limit > 0):
+            self._link(self._unlinked.pop())
+            if limit is not None:
+                limit -= 1
+        self._clusters = None
+
+    def start(self) -> "ImageHashes":
+        if importlib.util.find_spec("PyQt5") is not None:
+            self._thread = threading.Thread(target=self._run, name="MediaPHash", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+
+    @property
+    def pending(self) -> int:
+        return len(self._queue) + len(self._deferred)
+
+    def want(self) -> None:
+        """Хэши нужны сейчас (открыт поиск дубликатов) — отложенные с запуска идут в работу без ожидания."""
+        if not self._wanted.is_set():
+            self._wanted.set()
+            self._wake.set()
+
+    def _submit(self, path: str):
+        """_dhash в пул, не больше CONCURRENCY одновременно; None — остановлены."""
+        while not self._slots.acquire(timeout=0.5):
+            if self._stop.is_set():
+                return None
+        try:
+            fut = self.submit(_dhash, path)
+        except BaseException:
+            self._slots.release()
+            raise
+        fut.add_done_callback(lambda f: self._slots.release())
+        return fut
+
+    def _run(self) -> None:
+        log = logging.getLogger("mediahub")
+        started = time.monotonic()
+        while self._unlinked and not self._stop.is_set():
+            # граф для записей, загруженных при старте, — пачками, чтобы не держать писателей
+            with self.index.locked():
+                self._link_backlog(self.LINK_BATCH)
+        while not self._stop.is_set():
+            if self._deferred and (self._wanted.is_set() or time.monotonic() - started >= self.STARTUP_DELAY):
+                with self.index.locked():
+                    self._queue.extend(self._deferred)
+                    self._deferred.clear()
+            if not self._queue:
+                self._wake.wait(1.0)
+                self._wake.clear()
+                continue
+            jobs: Dict[str, tuple] = {}
+            inflight: Dict[str, Any] = {}  # sha256 → Future: одинаковое содержимое в пачке — одно декодирование
+            while self._queue and len(jobs) < self.BATCH and not self._stop.is_set():
+                stored = self._queue.popleft()
+                self._queued.discard(stored)
+                entry = self.index.get(stored)
+                if entry is None or entry.get("kind") != "images" or entry.get("phash_v") == self.stamp(entry):
+                    continue
+                sha = entry.get("sha256")
+                if sha and sha in self.by_sha:
+                    jobs[stored] = (self.stamp(entry), self.by_sha[sha])
+                    continue
+                path = self.resolve(stored)
+                if not path:
+                    continue
+                fut = inflight.get(sha) if sha else None
+                if fut is None:
+                    try:
+                        fut = self._submit(path)
+                    except Exception as e:
+                        log.warning("phash failed for %s: %s", path, e)
+                        continue
+                    if fut is None:
+                        break
+                    if sha:
+                        inflight[sha] = fut
+                jobs[stored] = (self.stamp(entry), fut)
+            results: Dict[str, tuple] = {}
+            for stored, (stamp, res) in jobs.items():
+                if not isinstance(res, str):
+                    try:
+                        res = res.result(timeout=60.0)
+                    except Exception as e:
+                        # сбой пула, а не картинки — запись останется без отметки и попадёт в очередь снова
+                        log.warning("phash failed for %s: %s", stored, e)
+                        continue
+                results[stored] = (stamp, res)
+            self._apply(results)
+            if self.busy():
+                self._stop.wait(self.BUSY_PAUSE)
+
+    def _apply(self, results: Dict[str, tuple]) -> None:
+        """Пачка хэшей — одна транзакция; запись, изменившаяся за время расчёта, снова в очереди (через add)."""
+        with self.index.transaction() as tx:
+            for stored, (stamp, phash) in results.items():
+                it = tx.get(stored)
+                if it is None or self.stamp(it) != stamp:
+                    continue
+                it = dict(it)
+                it["phash"] = phash
+                it["phash_v"] = stamp
+                tx.put(it)
+
+    def clusters(self, threshold: int, within: Optional[set] = None) -> List[List[str]]:
+        """
+        Группы stored, связанные цепочками «не больше threshold отличающихся бит»
+        (0..MAX_THRESHOLD), от больших групп к меньшим; within — искать только среди
+        этих stored. Вызывать под MediaIndex.locked().
+        """
+        threshold = max(0, min(int(threshold), self.MAX_THRESHOLD))
+        if self._unlinked:
+            self._link_backlog()
+        if within is None and self._clusters is not None and self._clusters[:2] == (self._gen, threshold):
+            return self._clusters[2]
+        if within is None:
+            members = self.members
+        else:
+            members = {}
+            for stored in within:
+                value = self.hashes.get(stored)
+                if value is not None:
+                    members.setdefault(value, set()).add(stored)
+
+        parent: Dict[int, int] = {}
+
+        def find(v: int) -> int:
+            while parent.get(v, v) != v:
+                parent[v] = parent.get(parent[v], parent[v])
+                v = parent[v]
+            return v
+
+        for a in members:
+            for b, d in self.near.get(a, {}).items():
+                if d <= threshold and b > a and b in members:
+                    ra, rb = find(a), find(b)
+                    if ra != rb:
+                        parent[ra] = rb
+                        parent.setdefault(rb, rb)
+
+        groups: Dict[int, List[str]] = {}
+        for value, same in members.items():
+            if len(same) > 1 or value in parent:
+                groups.setdefault(find(value), []).extend(same)
+        out = sorted((sorted(g) for g in groups.values() if len(g) > 1), key=lambda g: (-len(g), g[0]))
+        if within is None:
+            self._clusters = (self._gen, threshold, out)
+        return out
+
+
+class WaveformPeaks:
+    """
+    Пики волны для скраббера плеера: min/max по BASE корзинам на файл, считаются
+    один раз и лежат бинарными сайдкарами <хэш>.pk (заголовок + int16 min[] + int16 max[]),
+    так что повторный запрос — одно чтение ~8 КБ; нужное число корзин — прореживание.
+
+    WAV (PCM 8/16/24/32 бит) разбирается модулем wave и array без внешних программ;
+    остальные форматы — потоково через ffmpeg (если он есть в PATH): моно 8 кГц s16le.
+    """
+
+    BASE = 2048
+    HEADER = struct.Struct("<4sBBHII")  # magic, версия, резерв, резерв, корзин, длительность (мс)
+    MAGIC = b"MHPK"
+    FFMPEG_RATE = 8000
+    BLOCK = 1 << 16  # кадров за одно чтение
+    U8_TO_S8 = bytes(b ^ 0x80 for b in range(256))
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.ffmpeg = shutil.which("ffmpeg")
+        self._locks: Dict[str, threading.Lock] = {}
+        self._guard = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def can_decode(self, path: str) -> bool:
+        return path.lower().endswith(".wav") or self.ffmpeg is not None
+
+    def get(self, src: str, content: str, buckets: int) -> Optional[Dict[str, Any]]:
+        """{"buckets", "duration", "min", "max"} (значения -1..1) или None, если декодировать нечем."""
+        name = hashlib.sha1(content.encode("utf-8")).hexdigest() + ".pk"
+        path = os.path.join(self.directory, name)
+        data = self._read(path)
+        if data is None:
+            with self._guard:
+                lock = self._locks.setdefault(name, threading.Lock())
+            with lock:  # один расчёт на файл, параллельные запросы ждут его
+                data = self._read(path)
+                if data is None:
+                    data = self._compute(src)
+                    if data is None:
+                        return None
+                    self._write(path, *data)
+            with self._guard:
+                self._locks.pop(name, None)
+        mins, maxs, duration_ms = data
+        mins, maxs = self.downsample(mins, maxs, buckets)
+        return {"buckets": len(mins), "duration": duration_ms / 1000,
+                "min": [round(v / 32768, 4) for v in mins], "max": [round(v / 32768, 4) for v in maxs]}
+
+    @staticmethod
+    def downsample(mins, maxs, buckets: int) -> tuple:
+        n = len(mins)
+        if buckets >= n:
+            return list(mins), list(maxs)
+        out_min, out_max = [], []
+        for i in range(buckets):
+            a, b = i * n // buckets, (i + 1) * n // buckets
+            out_min.append(min(mins[a:b]))
+            out_max.append(max(maxs[a:b]))
+        return out_min, out_max
+
+    def _read(self, path: str) -> Optional[tuple]:
+        try:
+            with open(path, "rb") as f:
+                raw = f.read()
+        except OSError:
+            return None
+        if len(raw) < self.HEADER.size:
+            return None
+        magic, version, _, _, count, duration_ms = self.HEADER.unpack_from(raw)
+        if magic != self.MAGIC or version != 1 or len(raw) != self.HEADER.size + 4 * count:
+            return None
+        values = array.array("h")
+        values.frombytes(raw[self.HEADER.size:])
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values[:count], values[count:], duration_ms
+
+    def _write(self, path: str, mins, maxs, duration_ms: int) -> None:
+        values = array.array("h", mins)
+        values.extend(maxs)
+        if sys.byteorder == "big":
+            values.byteswap()
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.HEADER.pack(self.MAGIC, 1, 0, 0, len(mins), int(duration_ms)))
+            f.write(values.tobytes())
+        os.replace(tmp, path)
+
+    def _compute(self, src: str) -> Optional[tuple]:
+        if src.lower().endswith(".wav"):
+            try:
+                return self._from_wav(src)
+            except (wave.Error, EOFError):
+                pass  # не PCM (float, ADPCM…) — пробуем ffmpeg
+        if self.ffmpeg is not None:
+            return self._from_ffmpeg(src)
+        return None
+
+    @staticmethod
+    def _to_int16(raw: bytes, width: int) -> array.array:
+        """PCM little-endian любой разрядности → int16 (старшие байты сэмпла), срезами без цикла."""
+        samples = array.array("h")
+        if width == 2:
+            samples.frombytes(raw)
+        elif width == 1:
+            buf = bytearray(2 * len(raw))
+            buf[1::2] = raw.translate(WaveformPeaks.U8_TO_S8)  # 8 бит в WAV — беззнаковые
+            samples.frombytes(bytes(buf))
+        else:
+            n = len(raw) // width
+            buf = bytearray(2 * n)
+            buf[0::2] = raw[width - 2::width]
+            buf[1::2] = raw[width - 1::width]
+            samples.frombytes(bytes(buf))
+        if sys.byteorder == "big":
+            samples.byteswap()
+        return samples
+
+    def _from_wav(self, src: str) -> tuple:
+        with wave.open(src, "rb") as w:
+            channels, width, rate, frames = w.getnchannels(), w.getsampwidth(), w.getframerate(), w.getnframes()
+            count = min(self.BASE, frames) or 1
+            per_bucket = -(-frames // count) if frames else 1  # ceil
+            step = max(1, self.BLOCK // per_bucket) * per_bucket  # читаем целыми корзинами
+            mins, maxs = [], []
+            while True:
+                raw = w.readframes(step)
+                if not raw:
+                    break
+                samples = self._to_int16(raw, width)
+                span = per_bucket * channels
+                for a in range(0, len(samples), span):
+                    chunk = samples[a:a + span]
+                    mins.append(min(chunk))
+                    maxs.append(max(chunk))
+        return mins or [0], maxs or [0], int(frames * 1000 / rate) if rate else 0
+
+    def _from_ffmpeg(self, src: str) -> Optional[tuple]:
+        """Потоковое декодирование: мелкие окна по ходу чтения, в конце — прореживание до BASE."""
+        window = 256
+        cmd = [self.ffmpeg, "-v", "error", "-nostdin", "-i", src, "-vn", "-ac", "1",
+               "-ar", str(self.FFMPEG_RATE), "-f", "s16le", "-"]
+        mins, maxs = array.array("h"), array.array("h")
+        total = 0
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError:
+            return None
+        with proc:
+            tail = b""
+            while True:
+                raw = proc.stdout.read(window * 2 * 256)
+                if not raw:
+                    break
+                raw = tail + raw
+                cut = len(raw) - len(raw) % (window * 2)
+                raw, tail = raw[:cut], raw[cut:]
+                samples = self._to_int16(raw, 2)
+                total += len(samples)
+                for a in range(0, len(samples), window):
+                    chunk = samples[a:a + window]
+                    mins.append(min(chunk))
+                    maxs.append(max(chunk))
+            if len(tail) >= 2:
+                samples = self._to_int16(tail[:len(tail) - len(tail) % 2], 2)
+                total += len(samples)
+                mins.append(min(samples))
+                maxs.append(max(samples))
+        if proc.returncode != 0 or not mins:
+            return None
+        mins, maxs = self.downsample(mins, maxs, self.BASE)
+        return mins, maxs, int(total * 1000 / self.FFMPEG_RATE)
+
+
+class MediaStream:
+    """
+    Тело ответа /media: count байт файла начиная с offset, либо несколько
+    частей parts = [(заголовок части, offset, count)] + tail (multipart/byteranges).
+
+    Если WSGI-сервер отдаёт сокет соединения (werkzeug: environ["werkzeug.socket"]),
+    первым элементом уходит b"" — сервер отправляет заголовки, — а байты файла
+    пишутся socket.sendfile() прямо из page cache, без копирования в Python.
+    Иначе — обычный генератор кусками по CHUNK.
+    """
+
+    CHUNK = 256 * 1024
+
+    def __init__(self, file, offset: int = 0, count: int = 0, sock=None,
+                 parts: Optional[List[tuple]] = None, tail: bytes = b"", on_close=None):
+        self.file = file  # путь (открывается при первой итерации) или уже открытый файл
+        self.parts = parts if parts is not None else [(b"", offset, count)]
+        self.tail = tail
+        self.sock = sock
+        self.on_close = on_close
+
+    def __iter__(self):
+        if isinstance(self.file, str):
+            self.file = open(self.file, "rb")
+        if self.sock is not None:
+            yield b""
+        for head, offset, count in self.parts:
+            if head:
+                yield head
+            if self.sock is not None:
+                if count > 0:
+                    self.sock.sendfile(self.file, offset, count)
+                continue
+            self.file.seek(offset)
+            remaining = count
+            while remaining > 0:
+                data = self.file.read(min(self.CHUNK, remaining))
+                if not data:
+                    break
+                yield data
+                remaining -= len(data)
+        if self.tail:
+            yield self.tail
+
+    def close(self) -> None:
+        if not isinstance(self.file, str):
+            self.file.close()
+        if self.on_close is not None:
+            on_close, self.on_close = self.on_close, None
+            on_close()
+
+
+class _ZipSink:
+    """Несдвигаемый приёмник для zipfile: копит записанное до следующего take()."""
+
+    def __init__(self):
+        self.parts: List[bytes] = []
+        self.size = 0
+
+    def write(self, data) -> int:
+        self.parts.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts, self.size = [], 0
+        return data
+
+
+class ZipExport:
+    """
+    Тело ответа экспорта: ZIP пишется zipfile в несдвигаемый _ZipSink и уходит
+    кусками по мере чтения файлов — без временных файлов, память не зависит от
+    размера архива. Размеры и CRC каждого файла идут в data descriptor после его
+    данных; уже сжатые форматы кладутся как есть (ZIP_STORED), остальные — deflate;
+    файлы от 4 ГиБ и архивы больше 65535 файлов — zip64.
+    """
+
+    CHUNK = 1 << 20
+    STORED_EXTS = {
+        ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".avif",
+        ".mp3", ".m4a", ".aac", ".ogg", ".opus", ".flac", ".wma",
+        ".mp4", ".webm", ".mkv", ".avi", ".mov", ".m4v",
+        ".zip", ".gz", ".7z", ".rar", ".pdf", ".docx", ".xlsx", ".pptx", ".epub",
+    }
+
+    def __init__(self, files: List[tuple], on_close=None):
+        self.files = files  # [(имя в архиве, путь)]
+        self.on_close = on_close
+
+    @staticmethod
+    def _date_time(ts: float) -> tuple:
+        dt = time.localtime(ts)[:6]
+        return dt if dt[0] >= 1980 else (1980, 1, 1, 0, 0, 0)
+
+    def __iter__(self):
+        sink = _ZipSink()
+        with zipfile.ZipFile(sink, "w", allowZip64=True) as zf:
+            for arcname, path in self.files:
+                try:
+                    src = open(path, "rb")
+                except OSError as e:
+                    logging.getLogger("mediahub").warning("export skip %s: %s", path, e)
+                    continue
+                with src:
+                    st = os.fstat(src.fileno())
+                    zinfo = zipfile.ZipInfo(arcname, self._date_time(st.st_mtime))
+                    stored = os.path.splitext(arcname)[1].lower() in self.STORED_EXTS
+                    zinfo.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+                    zinfo.external_attr = 0o644 << 16
+                    with zf.open(zinfo, "w", force_zip64=st.st_size >= zipfile.ZIP64_LIMIT) as dst:
+                        while True:
+                            chunk = src.read(self.CHUNK)
+                            if not chunk:
+                                break
+                            dst.write(chunk)
+                            if sink.size >= self.CHUNK:
+                                yield sink.take()
+                if sink.size:
+                    yield sink.take()
+        yield sink.take()  # центральный каталог
+
+    def close(self) -> None:
+        if self.on_close is not None:
+            on_close, self.on_close = self.on_close, None
+            on_close()
+
 
 class SalemMediaServer:
     """
@@ -22,109 +2734,1381 @@ class SalemMediaServer:
       GET  /            → SalemMedia.html
       GET  /ui          → SalemMedia.html (алиас)
       GET  /health      → {"ok": true}
-      GET  /api/files   → список из index.json (+ простые фильтры)
-      POST /api/upload  → загрузка FormData('files')
-      GET  /media/<p>   → отдача файла, поддержка HTTP Range (перемотка)
+      GET  /api/files   → список из индекса (+ фильтры; q — полнотекстовый поиск, см. TextIndex;
+                          tag=a&tag=b + tag_mode=and|or — фильтр по индексу тегов;
+                          limit + cursor — keyset-страницы по предсортированным порядкам)
+      POST /api/upload  → загрузка FormData('files'); содержимое хранится блобом "<sha256><ext>",
+                          повторная загрузка того же файла — новая запись на тот же блоб;
+                          у картинок в записи width/height/orientation (по заголовку файла)
+      GET  /media/<p>   → отдача файла, HTTP Range по RFC 7233 (суффиксы, multipart/byteranges,
+                          If-Range), ETag/Last-Modified и 304 на If-None-Match/If-Modified-Since
+
+    Добавлено:
+      OPTIONS /api/*            → 204 для всех preflight
+      POST    /api/meta         → {stored, name?, tags?, pinned?} правка метаданных
+      POST    /api/rename       → {stored, new_name} переименование файла на диске (у внешних записей — только name)
+      POST    /api/delete       → {stored} удалить файл и запись индекса
+      POST    /api/clear        → {wipe:bool} очистить индекс; wipe=True — удалить файлы
+      POST    /api/batch        → {ops: [{op: delete|meta|rename|album_add, ...}]} одной транзакцией индекса
+      GET     /api/events       → SSE-лента изменений индекса (change/resync, Last-Event-ID = версия)
+      GET     /api/changes?since=N → изменения индекса после версии N или {resync: true}; версию даёт /api/files
+      POST    /api/import-dir   → {path, async?, all?} индексировать внешнюю папку на месте (без копии)
+      GET     /api/import-dir[/<job>] → корни и прогресс импорта
+      GET|POST /api/quota      → пробный прогон вытеснения по квоте / вытеснить сейчас
+      GET|POST /api/storage/migrate → прогресс / повторный запуск переноса файлов media в шарды ab/cd/
+      POST    /api/rescan       → инкрементальный перескан media (diff по inode/size/mtime);
+                                  фоновый MediaWatcher делает то же самое сам по событиям ФС
+      GET     /api/stats        → суммарная статистика (по типам, объём, теги, свежий mtime; ?albums=1 — по альбомам)
+      GET     /api/file/<stored>→ мета по одному файлу (или 404)
+      GET     /api/facets       → счётчики по тегам и типам для текущего запроса (q/kind/tag)
+      POST    /api/uploads      → {name, size, sha256?} сессия докачиваемой загрузки → {id, received}
+      PUT     /api/uploads/<id> → кусок файла: Content-Range: bytes a-b/size, X-Chunk-SHA256 (необяз.)
+      GET     /api/uploads/<id> → принятые диапазоны [начало, конец) — что осталось догрузить
+      POST    /api/uploads/<id>/complete → проверка SHA-256 и добавление файла (как /api/upload)
+      DELETE  /api/uploads/<id> → отмена сессии
+      GET     /api/thumb/<stored>?w=&h=&fmt= → превью изображения (jpg|png|webp) из кэша media/.cache/thumbs;
+                                  для аудио/видео — встроенная обложка (MetadataExtractor, если есть mutagen)
+      GET     /api/peaks/<stored>?buckets=N → min/max пиков волны (-1..1) для скраббера, сайдкар в .cache/peaks
+      GET     /api/duplicates?threshold=&album= → группы почти одинаковых картинок (dHash, ImageHashes)
+      POST    /api/duplicates/resolve → {keep, remove[]} удалить лишние, в альбомах заменить их на keep
+      GET     /api/albums/<name>/export.zip → альбом одним ZIP (потоком, см. ZipExport)
+      GET     /api/albums/<name>?limit=&offset=&resolve=1 → страница альбома (+ записи индекса её элементов)
+      POST    /api/export       → {items: [stored], name?} выбранные файлы одним ZIP (JSON или форма)
+
+    Все ответы — JSON. Индекс держится в памяти (MediaIndex) и сбрасывается
+    в хранилище не чаще раза в flush_interval секунд: storage="sqlite" —
+    media/catalog.db (старый index.json переносится туда один раз),
+    storage="json" — media/index.json. Ещё не сброшенные изменения лежат в index.journal.
+    """
+
+    # служебные файлы каталога media — не медиа, не сканируются и не удаляются при clear
+    SERVICE_FILES = {"index.json", "albums.json", "albums.db", "albums.db-wal", "albums.db-shm", "config.json",
+                     "catalog.db", "catalog.db-wal", "catalog.db-shm", "index.journal",
+                     "scan_cache.json", "roots.json", "access.json"}
+
+    # внешние папки индексируются на месте: stored = "ext/<id корня>/<относительный путь>"
+    EXT_PREFIX = "ext/"
+    IMPORT_BATCH = 2000
+    # загрузки лежат в media блобами "ab/cd/<sha256><ext>" (см. _blob_name), записи ссылаются на них полем blob;
+    # блобы прежней плоской раскладки и файлы под своим именем переносит туда фоновая миграция
+    HASH_CHUNK = 1 << 20
+    MIGRATE_BATCH = 200
+    # сессии докачиваемых загрузок: media/.uploads/<id>.part (файл полного размера) + <id>.json
+    UPLOAD_CHUNK = 8 << 20
+    UPLOAD_TTL = 7 * 24 * 3600
+    # /media отдаёт тело через socket.sendfile, когда WSGI-сервер даёт доступ к сокету
+    USE_SENDFILE = True
+    # превью: размер по умолчанию (его же готовим сразу после загрузки) и предел кэша
+    THUMB_SIZE = 320
+    THUMB_MAX_SIDE = 2048
+    THUMB_CACHE_BYTES = 512 << 20
+    # почти-дубликаты: сколько бит dHash могут отличаться по умолчанию (см. ImageHashes)
+    DUP_THRESHOLD = 3
+    # /api/batch: предел операций в одном запросе
+    BATCH_MAX = 10000
+    # /api/events: пинг при простое (заодно замечаем отвалившихся клиентов) и пауза переподключения
+    EVENTS_HEARTBEAT = 15.0
+    EVENTS_RETRY_MS = 3000
+    # квота на media (quota_bytes в /api/config): сверх неё вытесняются давно не открывавшиеся
+    # файлы без тегов и без pinned; время обращений из /media сбрасывается в access.json пачками
+    ACCESS_FLUSH = 30.0
+    EVICT_GRACE = 600  # открытое или добавленное за последние N секунд не вытесняется
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 7000, root_dir: Optional[str] = None,
+                 storage: str = "sqlite", flush_interval: float = 2.0, watch: bool = True,
+                 worker_processes: bool = False):
+        self.host = host
+        self.port = port
+        self.ROOT = os.path.abspath(root_dir or os.path.dirname(__file__))
+        self.MEDIA_DIR = os.path.join(self.ROOT, "media")
+        self.INDEX_PATH = os.path.join(self.MEDIA_DIR, "index.json")
+        self.CATALOG_PATH = os.path.join(self.MEDIA_DIR, "catalog.db")
+        self.JOURNAL_PATH = os.path.join(self.MEDIA_DIR, "index.journal")
+        self.SCAN_CACHE_PATH = os.path.join(self.MEDIA_DIR, "scan_cache.json")
+        self.ROOTS_PATH = os.path.join(self.MEDIA_DIR, "roots.json")
+        self.CONFIG_PATH = os.path.join(self.MEDIA_DIR, "config.json")
+        self.ACCESS_PATH = os.path.join(self.MEDIA_DIR, "access.json")
+        self.ALBUMS_PATH = os.path.join(self.MEDIA_DIR, "albums.json")  # прежний формат, переносится в albums.db
+        self.ALBUMS_DB_PATH = os.path.join(self.MEDIA_DIR, "albums.db")
+        self.UPLOADS_DIR = os.path.join(self.MEDIA_DIR, ".uploads")
+        self.THUMBS_DIR = os.path.join(self.MEDIA_DIR, ".cache", "thumbs")
+        self.COVERS_DIR = os.path.join(self.MEDIA_DIR, ".cache", "covers")
+        self.PEAKS_DIR = os.path.join(self.MEDIA_DIR, ".cache", "peaks")
+        os.makedirs(self.MEDIA_DIR, exist_ok=True)
+        if storage == "json":
+            store = JsonIndexStore(self.INDEX_PATH, self._atomic_write_json)
+        else:
+            store = MediaCatalog(self.CATALOG_PATH, legacy_index_path=self.INDEX_PATH)
+        self.index = MediaIndex(store, self.JOURNAL_PATH, flush_interval=flush_interval)
+        self.text_index = self.index.attach(TextIndex())
+        self.orderings = self.index.attach(SortedOrderings())
+        self.facets = self.index.attach(FacetIndex())
+        self.blobs = self.index.attach(BlobRefs())
+        self.stats = self.index.attach(LibraryStats())
+        self.albums = AlbumStore(self.ALBUMS_DB_PATH, legacy_json_path=self.ALBUMS_PATH)
+        self.stats.set_albums(self.albums.list())
+        self.access = AccessLog(self.ACCESS_PATH, self._atomic_write_json,
+                                known=lambda: self.index.snapshot().by_stored, flush_interval=self.ACCESS_FLUSH)
+        self._evict_lock = threading.Lock()
+        self.quota_bytes = self._config_quota(self._load_config())
+        self._scan_lock = threading.Lock()
+        self._fingerprints: Optional[Dict[str, tuple]] = None  # stored → (inode, size, mtime_ns), см. _rescan
+        self._jobs: Dict[str, Dict[str, Any]] = {}  # фоновые импорты /api/import-dir
+        self._migration: Optional[Dict[str, Any]] = None  # последний проход переноса в шарды
+        self._migrate_lock = threading.Lock()
+        self._migrate_stop = threading.Event()
+        self._migrate_thread: Optional[threading.Thread] = None
+        self._roots_lock = threading.Lock()
+        self._upload_locks: Dict[str, threading.Lock] = {}  # id сессии → блокировка её диапазонов
+        self._upload_locks_guard = threading.Lock()
+        self._purge_uploads()
+        # worker_processes=True — только из защищённой точки входа (см. ThumbCache)
+        self.thumbs = ThumbCache(self.THUMBS_DIR, max_bytes=self.THUMB_CACHE_BYTES, processes=worker_processes)
+        self.peaks = WaveformPeaks(self.PEAKS_DIR)
+        self._streams = 0  # активные отдачи /media — фоновые задачи уступают им
+        self._streams_lock = threading.Lock()
+        self.metadata = self.index.attach(MetadataExtractor(
+            self.index, self._entry_path, self.COVERS_DIR, busy=lambda: self._streams > 0,
+            on_cover=lambda it: self._thumb_for(it, self.THUMB_SIZE, self.THUMB_SIZE, "jpg", wait=False)))
+        self.phashes = self.index.attach(ImageHashes(
+            self.index, self._entry_path, self.thumbs.run, busy=lambda: self._streams > 0))
+        self.watcher: Optional[MediaWatcher] = None
+        if watch:
+            self.watcher = MediaWatcher(self.MEDIA_DIR, self._on_fs_changes, ignore=self._is_service_file).start()
+        self._closed = False
+        self._close_lock = threading.Lock()
+        atexit.register(self.close)
+        mimetypes.init()
+        self.app = Flask(__name__)
+        self._configure_routes()
+        self.metadata.start()
+        self.phashes.start()
+        threading.Thread(target=self._backfill_dimensions, name="MediaDimensions", daemon=True).start()
+        self._start_migration()
+        self.access.start()
+        self._maybe_evict()
+
+    # ------------------- helpers -------------------
+
+    @staticmethod
+    def _now_iso() -> str:
+        return datetime.fromtimestamp(time.time()).isoformat(timespec="seconds")
+
+    @staticmethod
+    def _safe_name(name: str) -> str:
+        # Сохраняем расширение; чистим опасные символы
+        name = (name or "file").replace("\\", "_").replace("/", "_")
+        table = str.maketrans({c: "_" for c in '<>:"|?*'})
+        name = name.translate(table).strip()
+        return name or "file"
+
+    @staticmethod
+    def _kind_by_ext(filename: str) -> str:
+        ext = (os.path.splitext(filename)[1] or "").lower().lstrip(".")
+        if ext in ("mp3", "wav", "flac", "ogg", "m4a", "aac"): return "audio"
+        if ext in ("mp4", "webm", "mkv", "avi", "mov", "m4v"): return "video"
+        if ext in ("jpg", "jpeg", "png", "gif", "bmp", "webp", "tiff", "svg"): return "images"
+        if ext in ("pdf", "doc", "docx", "xls", "xlsx", "ppt", "pptx", "txt", "md", "epub", "rtf", "csv"): return "docs"
+        return "file"
+
+    def _is_service_file(self, fname: str) -> bool:
+        return fname in self.SERVICE_FILES or fname.endswith(".tmp") or fname.startswith(".")
+
+    def _is_service_path(self, rel: str) -> bool:
+        """Путь внутри media ведёт к служебному файлу или в служебный каталог (.uploads, .cache)."""
+        return any(self._is_service_file(part) for part in rel.split("/") if part)
+
+    def _mime_of(self, filename: str) -> str:
+        return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+    def _atomic_write_json(self, path: str, data: Any) -> None:
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+
+    # ------------------- index IO -------------------
+
+    def _select_files(self, q: str, kind: str, tags: List[str], tag_mode: str) -> tuple:
+        """
+        Отбор записей по q/kind/tag из вторичных индексов; вызывать под index.locked().
+        Возвращает (множество stored или None — «вся библиотека», релевантность по q или None).
+        """
+        selected: Optional[set] = None
+        scores: Optional[Dict[str, int]] = None
+        if q:
+            scores = self.text_index.search(q) or {}
+            selected = set(scores)
+        if tags:
+            tagged = self.facets.with_tags(tags, tag_mode)
+            selected = tagged if selected is None else selected & tagged
+        if kind and selected is not None:
+            selected &= self.facets.by_kind.get(kind, set())
+        return selected, scores
+
+    @staticmethod
+    def _tag_args() -> tuple:
+        """tag=a&tag=b или tag=a,b; tag_mode=and|or."""
+        tags: List[str] = []
+        for raw in request.args.getlist("tag"):
+            tags.extend(t.strip() for t in raw.split(",") if t.strip())
+        mode = (request.args.get("tag_mode") or "and").lower()
+        return tags, ("or" if mode == "or" else "and")
+
+    def _entry_path(self, stored: str) -> Optional[str]:
+        """
+        Абсолютный путь файла записи: внешние записи (import-dir) указывают на
+        оригинал через path, загруженные — на блоб в media, остальные лежат
+        в media под своим именем. None — путь вне media.
+        """
+        it = self.index.get(stored)
+        if it is not None and it.get("path"):
+            return it["path"]
+        if it is not None and it.get("blob"):
+            return os.path.join(self.MEDIA_DIR, it["blob"])
+        abs_path = os.path.abspath(os.path.join(self.MEDIA_DIR, stored))
+        if not abs_path.startswith(self.MEDIA_DIR + os.sep):
+            return None
+        return abs_path
+
+    @staticmethod
+    def _set_dimensions(it: Dict[str, Any], path: str) -> Dict[str, Any]:
+        """width/height/orientation для картинок — по заголовку файла (см. _image_size)."""
+        if it.get("kind") == "images":
+            dims = _image_size(path)
+            if dims is not None:
+                it["width"], it["height"], it["orientation"] = dims
+            else:
+                for key in ("width", "height", "orientation"):
+                    it.pop(key, None)
+        return it
+
+    def _backfill_dimensions(self) -> None:
+        """Картинки, проиндексированные до появления width/height: один проход в фоне при старте."""
+        todo = [it["stored"] for it in self.index.snapshot().files
+                if it.get("kind") == "images" and "width" not in it]
+        for i in range(0, len(todo), self.IMPORT_BATCH):
+            found = {}
+            for stored in todo[i:i + self.IMPORT_BATCH]:
+                path = self._entry_path(stored)
+                dims = _image_size(path) if path else None
+                if dims is not None:
+                    found[stored] = dims
+            with self.index.transaction() as tx:
+                for stored, dims in found.items():
+                    it = tx.get(stored)
+                    if it is None or "width" in it:
+                        continue
+                    it = dict(it)
+                    it["width"], it["height"], it["orientation"] = dims
+                    tx.put(it)
+
+    def _make_entry(self, stored: str, st: os.stat_result, name: Optional[str] = None,
+                    path: Optional[str] = None) -> Dict[str, Any]:
+        """Новая запись индекса для файла stored в media (path — где он лежит, если не под своим именем)."""
+        return self._set_dimensions({
+            "id": uuid.uuid4().hex[:12],
+            "name": name or os.path.basename(stored),
+            "stored": stored,
+            "url": f"/media/{stored}",
+            "size": st.st_size,
+            "mtime": datetime.fromtimestamp(st.st_mtime).isoformat(timespec="seconds"),
+            "mime": self._mime_of(stored),
+            "kind": self._kind_by_ext(stored),
+            "tags": [],
+            "created": self._now_iso(),  # когда запись появилась в библиотеке (mtime у общего блоба — старый)
+        }, path or os.path.join(self.MEDIA_DIR, stored))
+
+    def _save_hashed(self, src, tmp_path: str) -> tuple:
+        """Копирует поток src в tmp_path, попутно считая SHA-256. → (sha256 hex, размер)."""
+        h = hashlib.sha256()
+        size = 0
+        with open(tmp_path, "wb") as out:
+            while True:
+                chunk = src.read(self.HASH_CHUNK)
+                if not chunk:
+                    break
+                h.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        return h.hexdigest(), size
+
+    def _ingest_file(self, tmp_path: str, orig_name: str, sha256: str) -> Dict[str, Any]:
+        """
+        Принимает готовый временный файл в media как блоб "<sha256><ext>" и
+        создаёт для него запись. Если такое содержимое уже хранится — временный
+        файл удаляется, а новая запись ссылается на существующий блоб.
+        """
+        orig_name = self._safe_name(orig_name)
+        base, ext = os.path.splitext(orig_name)
+        stored = self._safe_name(f"{uuid.uuid4().hex[:8]}_{base}{ext}")
+        # появление блоба и записи индекса — атомарно для _rescan и удаления
+        with self.index.transaction() as tx:
+            blob = self.blobs.by_sha.get(sha256) or _blob_name(sha256, ext)
+            blob_path = os.path.join(self.MEDIA_DIR, blob)
+            if os.path.isfile(blob_path):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(tmp_path, blob_path)
+            item = self._make_entry(stored, os.stat(blob_path), name=orig_name, path=blob_path)
+            item["blob"] = blob
+            item["sha256"] = sha256
+            tx.put(item)
+        if item["kind"] == "images":
+            # превью для сетки — сразу, в фоне; запрос загрузки его не ждёт
+            self._thumb_for(item, self.THUMB_SIZE, self.THUMB_SIZE, "jpg", wait=False)
+        self._maybe_evict()
+        return item
+
+    def _thumb_for(self, it: Dict[str, Any], w: int, h: int, fmt: str, wait: bool = True) -> Optional[str]:
+        """
+        Превью записи из ThumbCache: картинка — сам файл (ключ — sha256 содержимого
+        или inode/size/mtime), аудио/видео — извлечённая обложка (ключ — её имя-хэш).
+        """
+        if it.get("kind") != "images":
+            if not it.get("cover"):
+                return None
+            return self.thumbs.get(os.path.join(self.COVERS_DIR, it["cover"]), f"cover:{it['cover']}",
+                                   w, h, fmt, wait=wait)
+        src, content = self._content_key(it)
+        if src is None:
+            return None
+        return self.thumbs.get(src, content, w, h, fmt, wait=wait)
+
+    def _content_key(self, it: Dict[str, Any]) -> tuple:
+        """(путь файла, ключ содержимого для кэшей) — sha256 или inode/size/mtime; (None, None), если файла нет."""
+        src = self._entry_path(it["stored"])
+        if src is None:
+            return None, None
+        try:
+            st = os.stat(src)
+        except OSError:
+            return None, None
+        return src, it.get("sha256") or f"{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+
+    def _stream_started(self):
+        """Учёт активной отдачи (см. MetadataExtractor.busy) → колбэк её завершения."""
+        with self._streams_lock:
+            self._streams += 1
+
+        def done():
+            with self._streams_lock:
+                self._streams -= 1
+
+        return done
+
+    def _media_stream(self, *args, **kwargs) -> MediaStream:
+        return MediaStream(*args, on_close=self._stream_started(), **kwargs)
+
+    def _export_response(self, stored_list: List[str], filename: str) -> Response:
+        """Потоковый ZIP из файлов записей; одинаковые имена в архиве получают « (2)», « (3)»…"""
+        files, seen = [], set()
+        for stored in stored_list:
+            it = self.index.get(stored)  # только записи индекса — служебные файлы media не выгружаются
+            path = self._entry_path(stored) if it is not None else None
+            if path is None or not os.path.isfile(path):
+                continue
+            name = self._safe_name(it.get("name") or os.path.basename(stored))
+            base, ext = os.path.splitext(name)
+            n = 1
+            while name.lower() in seen:
+                n += 1
+                name = f"{base} ({n}){ext}"
+            seen.add(name.lower())
+            files.append((name, path))
+        resp = Response(ZipExport(files, on_close=self._stream_started()), mimetype="application/zip",
+                        direct_passthrough=True)
+        stem = os.path.splitext(filename)[0].encode("ascii", "ignore").decode("ascii").replace('"', "").strip()
+        ascii_name = f"{stem or 'export'}.zip"  # для клиентов без filename*
+        resp.headers["Accept-Ranges"] = "none"  # архив собирается на лету — докачка по Range невозможна
+        resp.headers["Content-Disposition"] = (f'attachment; filename="{ascii_name}"; '
+                                               f"filename*=UTF-8''{quote(filename)}")
+        resp.headers["X-Export-Files"] = str(len(files))
+        return resp
+
+    def _release_blob(self, entry: Optional[Dict[str, Any]]) -> None:
+        """Удаляет файл блоба, если на него больше не ссылается ни одна запись; вызывать в транзакции."""
+        blob = (entry or {}).get("blob")
+        if not blob or blob in self.blobs.refs:
+            return
+        try:
+            os.remove(os.path.join(self.MEDIA_DIR, blob))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.app.logger.warning(f"blob remove failed for {blob}: {e}")
+
+    # ---- операции над записями: отдельные маршруты и /api/batch ----
+    # Каждая получает транзакцию индекса и тело запроса, возвращает (тело ответа, HTTP-статус).
+
+    @staticmethod
+    def _bad_fields(data: Dict[str, Any], strings=(), lists=(), dicts=()) -> Optional[tuple]:
+        """Типы необязательных полей операции: (тело ошибки, 400) или None, если всё в порядке."""
+        for keys, types, what in ((strings, str, "a string"), (lists, list, "a list"), (dicts, dict, "an object")):
+            for key in keys:
+                if data.get(key) is not None and not isinstance(data[key], types):
+                    return {"error": f"{key} must be {what}"}, 400
+        return None
+
+    def _op_delete(self, tx, data: Dict[str, Any]) -> tuple:
+        """{stored} или {url: "/media/..."} — удалить файл и запись индекса."""
+        bad = self._bad_fields(data, strings=("stored", "url"))
+        if bad:
+            return bad
+        stored = data.get("stored")
+        url = data.get("url")
+        if (not stored) and url:
+            if url.startswith("/media/"): stored = url.split("/media/", 1)[1]
+            else: return {"error": "bad url"}, 400
+        if not stored or not isinstance(stored, str):
+            return {"error": "stored is required"}, 400
+
+        # защита от traversal
+        stored = stored.replace("\\", "/")
+        if ".." in stored:
+            return {"error": "forbidden"}, 403
+        # каталог, журнал, базы альбомов, сессии загрузок — не медиа (записи индекса удалять можно всегда)
+        if tx.get(stored) is None and self._is_service_path(stored):
+            return {"error": "forbidden"}, 403
+
+        path = os.path.join(self.MEDIA_DIR, stored)
+        old = tx.delete(stored)
+        if old is not None:
+            self._album_forget(stored)
+        # блоб удаляется вместе с последней ссылкой на него
+        self._release_blob(old)
+        removed = 1 if old is not None else 0
+        if old is not None and (old.get("path") or old.get("blob")):
+            # внешний файл (import-dir) — убираем только из индекса, оригинал не трогаем;
+            # блоб уже освобождён выше
+            return {"ok": True, "removed_from_index": removed}, 200
+        if old is None and stored in self.blobs.refs:
+            # прямой путь к блобу, на который ссылаются записи, — не удаляем
+            return {"error": "blob in use"}, 409
+
+        # удаляем с диска молча, даже если нет в индексе
+        try:
+            if os.path.isfile(path):
+                os.remove(path)
+        except Exception as e:
+            # не валим запрос, просто сообщим
+            self.app.logger.warning(f"delete failed for {path}: {e}")
+        return {"ok": True, "removed_from_index": removed}, 200
+
+    def _op_meta(self, tx, data: Dict[str, Any]) -> tuple:
+        """{stored, tags?, props?, pinned?} — теги, произвольные свойства и закрепление записи."""
+        bad = self._bad_fields(data, strings=("stored",), lists=("tags",), dicts=("props",))
+        if bad:
+            return bad
+        stored = (data.get("stored") or "").strip()
+        if not stored:
+            return {"error": "stored is required"}, 400
+
+        it = tx.get(stored)
+        if it is not None:
+            it = dict(it)
+            if isinstance(data.get("tags"), list):
+                # ограничим длину и приведём к строкам
+                it["tags"] = [str(t)[:128] for t in data["tags"]][:128]
+            if isinstance(data.get("props"), dict):
+                # лёгкая нормализация ключей/значений
+                it["props"] = {str(k)[:64]: (v if isinstance(v, (int, float, bool)) else str(v)[:1024])
+                               for k, v in data["props"].items()}
+            if "pinned" in data:
+                # закреплённые файлы квота не вытесняет
+                if data["pinned"]:
+                    it["pinned"] = True
+                else:
+                    it.pop("pinned", None)
+            tx.put(it)
+            return {"ok": True}, 200
+
+        # если в индексе нет, но файл на диске есть — создадим запись
+        path = os.path.join(self.MEDIA_DIR, stored)
+        if not os.path.isfile(path) or self._is_service_file(stored) or stored in self.blobs.refs or "/" in stored:
+            return {"error": "not found"}, 404
+        it = self._make_entry(stored, os.stat(path))
+        it["tags"] = [str(t) for t in (data.get("tags") or [])]
+        it["props"] = data.get("props") or {}
+        if data.get("pinned"):
+            it["pinned"] = True
+        tx.put(it)
+        return {"ok": True}, 200
+
+    def _op_rename(self, tx, data: Dict[str, Any]) -> tuple:
+        """
+        {stored, new_stored?, new_name?} — переименование файла на диске и записи.
+        Если new_stored не задан — безопасное имя из new_name или старого.
+        У внешних записей (import-dir) файл вне media не трогается: меняется только name.
+        """
+        bad = self._bad_fields(data, strings=("stored", "new_stored", "new_name"))
+        if bad:
+            return bad
+        stored_old = (data.get("stored") or "").strip()
+        if not stored_old:
+            return {"error":"stored is required"}, 400
+
+        new_stored = (data.get("new_stored") or "").strip()
+        new_name = (data.get("new_name") or "").strip()
+
+        if stored_old.startswith(self.EXT_PREFIX):
+            it = tx.get(stored_old)
+            if it is None:
+                return {"error": "not found"}, 404
+            if new_stored or not new_name:
+                return {"error": "external entries can only change new_name"}, 400
+            it = dict(it)
+            it["name"] = new_name
+            tx.put(it)
+            return {"ok": True, "stored": stored_old, "url": it.get("url"), "name": new_name}, 200
+
+        # нормализуем
+        if not new_stored:
+            base_old, ext = os.path.splitext(stored_old)
+            base = self._safe_name(new_name or base_old)
+            # не теряем расширение
+            if ext and not base.endswith(ext):
+                new_stored = f"{base}{ext}"
+            else:
+                new_stored = base
+
+        # защита от traversal
+        for v in (stored_old, new_stored):
+            if ".." in v or "/" in v or "\\" in v:
+                return {"error":"bad name"}, 400
+
+        src = os.path.join(self.MEDIA_DIR, stored_old)
+        dst = os.path.join(self.MEDIA_DIR, new_stored)
+        it = tx.get(stored_old)
+        blob = it.get("blob") if it is not None else None
+        if not blob and not os.path.isfile(src):
+            return {"error":"not found"}, 404
+        if os.path.exists(dst) or tx.get(new_stored) is not None:
+            # добавим уникальный хвост
+            uid = uuid.uuid4().hex[:6]
+            base, ext = os.path.splitext(new_stored)
+            new_stored = f"{base}_{uid}{ext}"
+            dst = os.path.join(self.MEDIA_DIR, new_stored)
+
+        # запись в блобе переименовывается только в индексе, файл блоба общий
+        if not blob:
+            os.rename(src, dst)
+
+        # обновляем индекс
+        if it is not None:
+            it = dict(it)
+            it["stored"] = new_stored
+            it["url"] = f"/media/{new_stored}"
+            if new_name:
+                it["name"] = new_name
+            # обновим mime/kind/mtime/size
+            st = os.stat(os.path.join(self.MEDIA_DIR, blob) if blob else dst)
+            it["size"] = st.st_size
+            it["mtime"] = datetime.fromtimestamp(st.st_mtime).isoformat(timespec="seconds")
+            it["mime"] = self._mime_of(new_stored)
+            it["kind"] = self._kind_by_ext(new_stored)
+            tx.rename(stored_old, it)
+        self._album_rename(stored_old, new_stored)
+        return {"ok": True, "stored": new_stored, "url": f"/media/{new_stored}"}, 200
+
+    def _op_album_add(self, data: Dict[str, Any]) -> tuple:
+        """{album, items: [stored]} — дописать записи в альбом."""
+        bad = self._bad_fields(data, strings=("album",), lists=("items",))
+        if bad:
+            return bad
+        name = self._safe_name(data.get("album") or "").strip()
+        items = data.get("items") or []
+        items = [self._safe_name(str(x)) for x in items]
+        added = self.albums.add_items(name, items)
+        if added is None:
+            return {"error": "album not found"}, 404
+        with self.index.locked():
+            self.stats.album_add(name, items)
+        return {"ok": True, "added": added}, 200
+
+    @staticmethod
+    def _change_events(records: List[tuple]) -> List[Dict[str, Any]]:
+        """Записи ленты MediaIndex → по событию на версию: {version, added, updated, removed}."""
+        events: List[Dict[str, Any]] = []
+        for version, kind, stored, entry in records:
+            if not events or events[-1]["version"] != version:
+                events.append({"version": version, "added": [], "updated": [], "removed": []})
+            events[-1][kind].append(stored if kind == "removed" else entry)
+        return events
+
+    # каскад операций над файлами в альбомы; вызывать в транзакции индекса
+    def _album_forget(self, stored: str) -> None:
+        self.albums.forget(stored)
+        self.stats.drop_member(stored)
+
+    def _album_rename(self, old: str, new: str) -> None:
+        self.albums.rename_item(old, new)
+        self.stats.move_member(old, new)
+
+    @staticmethod
+    def _keep_rank(it: Dict[str, Any]) -> tuple:
+        """Какую из почти одинаковых картинок предлагать оставить: больше пикселей, затем больше файл и тегов."""
+        return (int(it.get("width") or 0) * int(it.get("height") or 0), int(it.get("size") or 0),
+                len(it.get("tags") or []))
+
+    def _scan_media_dir(self) -> Dict[str, tuple]:
+        """
+        Один проход os.scandir по media: {fname: (inode, size, mtime_ns)}.
+        На POSIX inode берётся из записи каталога, stat — один на файл.
+        Блобы из каталогов-шардов попадают сюда же под путём "ab/cd/<имя>".
+        """
+        found: Dict[str, tuple] = {}
+        shards: List[str] = []
+        service = self.SERVICE_FILES
+        with os.scandir(self.MEDIA_DIR) as it:
+            for entry in it:
+                name = entry.name
+                if name in service or name[0] == "." or name.endswith(".tmp"):
+                    continue
+                try:
+                    if not entry.is_file(follow_symlinks=False):
+                        if _SHARD_RE.fullmatch(name) and entry.is_dir(follow_symlinks=False):
+                            shards.append(name)
+                        continue
+                    st = entry.stat(follow_symlinks=False)
+                    found[name] = (entry.inode(), st.st_size, st.st_mtime_ns)
+                except OSError:
+                    continue
+        found.update(self._scan_shards(shards))
+        return found
+
+    def _scan_shards(self, tops: List[str]) -> Dict[str, tuple]:
+        """Файлы в media/<top>/<xx>/ для каждого top: {"top/xx/имя": отпечаток}; верхние шарды — параллельно."""
+
+        def scan(top: str) -> Dict[str, tuple]:
+            found: Dict[str, tuple] = {}
+            try:
+                with os.scandir(os.path.join(self.MEDIA_DIR, top)) as it:
+                    subs = [e.name for e in it if _SHARD_RE.fullmatch(e.name) and e.is_dir(follow_symlinks=False)]
+            except OSError:
+                return found
+            for sub in subs:
+                try:
+                    with os.scandir(os.path.join(self.MEDIA_DIR, top, sub)) as it:
+                        for entry in it:
+                            if entry.name.endswith(".tmp") or not entry.is_file(follow_symlinks=False):
+                                continue
+                            st = entry.stat(follow_symlinks=False)
+                            found[f"{top}/{sub}/{entry.name}"] = (entry.inode(), st.st_size, st.st_mtime_ns)
+                except OSError:
+                    continue
+            return found
+
+        found: Dict[str, tuple] = {}
+        if not tops:
+            return found
+        with ThreadPoolExecutor(max_workers=min(16, len(tops)), thread_name_prefix="MediaWalk") as pool:
+            for part in pool.map(scan, tops):
+                found.update(part)
+        return found
+
+    def _load_fingerprints(self) -> Dict[str, tuple]:
+        try:
+            with open(self.SCAN_CACHE_PATH, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return {k: tuple(v) for k, v in (data.get("files") or {}).items()}
+        except Exception:
+            return {}
+
+    def _on_fs_changes(self, names: Optional[set]) -> None:
+        """Пачка событий MediaWatcher → точечный перескан (или полный, если имён нет)."""
+        counts = self._rescan(names)
+        if counts["added"] or counts["updated"] or counts["removed"] or counts["renamed"]:
+            self.app.logger.info(f"watcher[{self.watcher.backend if self.watcher else '-'}]: {counts}")
+
+    def _stat_names(self, names) -> Dict[str, tuple]:
+        """Отпечатки (inode, size, mtime_ns) только для перечисленных файлов media."""
+        found: Dict[str, tuple] = {}
+        for name in names:
+            if self._is_service_file(name):
+                continue
+            try:
+                st = os.stat(os.path.join(self.MEDIA_DIR, name), follow_symlinks=False)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                found[name] = (st.st_ino, st.st_size, st.st_mtime_ns)
+        return found
+
+    def _rescan(self, names: Optional[set] = None) -> Dict[str, Any]:
+        """
+        Инкрементальный перескан media: сравнивает снимок os.scandir с кэшем
+        отпечатков (inode, size, mtime_ns). Новые файлы добавляются, исчезнувшие
+        удаляются, изменённые обновляются; переименованные снаружи (тот же inode
+        и размер) сохраняют id/теги. Все правки — одна транзакция индекса.
+        names — проверить только эти файлы (пачка событий MediaWatcher).
+        """
+        t0 = time.monotonic()
+        with self._scan_lock:
+            if self._fingerprints is None:
+                self._fingerprints = self._load_fingerprints()
+            cache = self._fingerprints
+            disk = self._scan_media_dir() if names is None else self._stat_names(names)
+            counts = {"added": 0, "updated": 0, "removed": 0, "renamed": 0, "unchanged": 0}
+
+            with self.index.transaction() as tx:
+                known = tx.keys()
+                refs = self.blobs.refs
+                if names is None:
+                    vanished = {k for k in set(known) - disk.keys() - self.blobs.keys
+                                if not k.startswith(self.EXT_PREFIX)}
+                    lost_blobs = refs.keys() - disk.keys()
+                    # кандидаты — только файлы с другим отпечатком или без записи (операции над множествами, без цикла по 50k)
+                    touched = disk.keys() - known
+                    if disk != cache:
+                        touched |= {fname for fname, _ in disk.items() - cache.items()}
+                else:
+                    vanished = {n for n in names if n not in disk and n in known and n not in self.blobs.keys}
+                    lost_blobs = {n for n in names if n not in disk and n in refs}
+                    touched = {n for n, fp in disk.items() if n not in known or cache.get(n) != fp}
+                # блобы — не отдельные записи, их описывают ссылающиеся на них записи;
+                # осиротевший файл в шарде — тоже не запись
+                touched -= refs.keys()
+                touched = {k for k in touched if "/" not in k}
+                # файл мог появиться уже после снимка диска (загрузка между scandir и транзакцией)
+                vanished = {k for k in vanished if not os.path.lexists(os.path.join(self.MEDIA_DIR, k))}
+                for blob in lost_blobs:
+                    if not os.path.lexists(os.path.join(self.MEDIA_DIR, blob)):
+                        vanished |= refs[blob]
+                by_inode = {(cache[st][0], cache[st][1]): st for st in vanished if st in cache}
+                counts["unchanged"] = len(disk) - len(touched)
+
+                for fname in sorted(touched):
+                    fp = disk[fname]
+                    it = tx.get(fname)
+                    if it is not None:
+                        mtime = datetime.fromtimestamp(fp[2] / 1e9).isoformat(timespec="seconds")
+                        if it.get("size") == fp[1] and it.get("mtime") == mtime:
+                            counts["unchanged"] += 1
+                            continue
+                        it = dict(it)
+                        it["size"] = fp[1]
+                        it["mtime"] = mtime
+                        tx.put(self._set_dimensions(it, os.path.join(self.MEDIA_DIR, fname)))
+                        counts["updated"] += 1
+                        continue
+
+                    try:
+                        st = os.stat(os.path.join(self.MEDIA_DIR, fname))
+                    except OSError:
+                        continue
+                    src = by_inode.pop((fp[0], fp[1]), None)
+                    if src is not None and src in vanished:
+                        # переименован вне сервера: та же запись под новым именем
+                        vanished.discard(src)
+                        old = tx.get(src)
+                        fresh = self._make_entry(fname, st)
+                        it = dict(old)
+                        for key in ("stored", "url", "size", "mtime", "mime", "kind"):
+                            it[key] = fresh[key]
+                        for key in ("width", "height", "orientation"):
+                            if key in fresh:
+                                it[key] = fresh[key]
+                        if old.get("name") == src:
+                            it["name"] = fname
+                        tx.rename(src, it)
+                        self._album_rename(src, fname)
+                        counts["renamed"] += 1
+                    else:
+                        tx.put(self._make_entry(fname, st))
+                        counts["added"] += 1
+
+                for st in vanished:
+                    tx.delete(st)
+                    self._album_forget(st)
+                    counts["removed"] += 1
+
+            if names is not None:
+                merged = {k: v for k, v in cache.items() if k not in names}
+                merged.update(disk)
+                disk = merged
+            if disk != cache:
+                self._fingerprints = disk
+                try:
+                    self._atomic_write_json(self.SCAN_CACHE_PATH, {"files": {k: list(v) for k, v in disk.items()}})
+                except Exception as e:
+                    self.app.logger.warning(f"scan cache save failed: {e}")
+
+        if counts["added"] or counts["updated"]:
+            self._maybe_evict()
+        counts["total"] = len(self.index.snapshot().by_stored)
+        counts["ms"] = round((time.monotonic() - t0) * 1000, 1)
+        return counts
+
+    # ------------------- шарды блобов -------------------
+
+    def _move_blob(self, src_rel: str, dst_rel: str) -> bool:
+        """Переносит файл media/src_rel в media/dst_rel (тем же rename — inode и mtime сохраняются). → файл на месте."""
+        src = os.path.join(self.MEDIA_DIR, src_rel)
+        dst = os.path.join(self.MEDIA_DIR, dst_rel)
+        if not os.path.isfile(src):
+            return os.path.isfile(dst)  # перенос уже был, а до журнала не дошло
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if os.path.isfile(dst):
+            os.remove(src)  # то же содержимое уже лежит в шарде
+        else:
+            os.replace(src, dst)
+        return True
+
+    def _migrate_blobs(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Онлайн-перенос media в шарды (см. _blob_name) без остановки сервера.
+        Плоские блобы "<sha256><ext>" переносятся пачками по MIGRATE_BATCH: rename файла
+        и поле blob его записей меняются в одной транзакции, /media/<stored> всё время
+        находит файл через индекс. Файлы под своим именем (старые загрузки, подброшенные
+        в media) хэшируются вне блокировки и становятся блобами, если за это время не
+        менялись. Пока идут отдачи /media, между файлами делается пауза.
+        """
+        stop = self._migrate_stop
+        snap = self.index.snapshot()
+        flat_blobs = sorted({it["blob"] for it in snap.files if it.get("blob") and "/" not in it["blob"]})
+        legacy = sorted(st for st, it in snap.by_stored.items()
+                        if not it.get("blob") and not it.get("path") and "/" not in st)
+        job.update(state="running", blobs=len(flat_blobs), files=len(legacy), moved=0, converted=0, skipped=0)
+
+        def pause() -> None:
+            if self._streams > 0:
+                stop.wait(MetadataExtractor.BUSY_PAUSE)
+
+        for i in range(0, len(flat_blobs), self.MIGRATE_BATCH):
+            if stop.is_set():
+                job["state"] = "stopped"
+                return job
+            pause()
+            with self.index.transaction() as tx:
+                for blob in flat_blobs[i:i + self.MIGRATE_BATCH]:
+                    entries = [tx.get(st) for st in sorted(self.blobs.refs.get(blob, ()))]
+                    stem, ext = os.path.splitext(blob)
+                    sha = next((it["sha256"] for it in entries if it.get("sha256")), stem)
+                    if not entries or not re.fullmatch(r"[0-9a-f]{64}", sha):
+                        job["skipped"] += 1
+                        continue
+                    new_blob = _blob_name(sha, ext)
+                    try:
+                        if not self._move_blob(blob, new_blob):
+                            job["skipped"] += 1
+                            continue
+                    except OSError as e:
+                        self.app.logger.warning(f"blob move failed for {blob}: {e}")
+                        job["skipped"] += 1
+                        continue
+                    for it in entries:
+                        it = dict(it)
+                        it["blob"] = new_blob
+                        tx.put(it)
+                    job["moved"] += 1
+
+        for i in range(0, len(legacy), self.MIGRATE_BATCH):
+            hashed: Dict[str, tuple] = {}
+            for stored in legacy[i:i + self.MIGRATE_BATCH]:
+                if stop.is_set():
+                    job["state"] = "stopped"
+                    return job
+                pause()
+                path = os.path.join(self.MEDIA_DIR, stored)
+                try:
+                    st = os.stat(path)
+                    h = hashlib.sha256()
+                    with open(path, "rb") as f:
+                        for chunk in iter(lambda: f.read(self.HASH_CHUNK), b""):
+                            h.update(chunk)
+                except OSError:
+                    job["skipped"] += 1
+                    continue
+                hashed[stored] = (h.hexdigest(), (st.st_ino, st.st_size, st.st_mtime_ns))
+            with self.index.transaction() as tx:
+                for stored, (sha, fp) in hashed.items():
+                    it = tx.get(stored)
+                    try:
+                        st = os.stat(os.path.join(self.MEDIA_DIR, stored))
+                    except OSError:
+                        st = None
+                    if it is None or it.get("blob") or it.get("path") or st is None \
+                            or (st.st_ino, st.st_size, st.st_mtime_ns) != fp:
+                        job["skipped"] += 1  # удалён или изменён, пока хэшировали, — до следующего прохода
+                        continue
+                    blob = self.blobs.by_sha.get(sha) or _blob_name(sha, os.path.splitext(stored)[1])
+                    try:
+                        if not self._move_blob(stored, blob):
+                            job["skipped"] += 1
+                            continue
+                    except OSError as e:
+                        self.app.logger.warning(f"blob move failed for {stored}: {e}")
+                        job["skipped"] += 1
+                        continue
+                    it = dict(it)
+                    it["blob"] = blob
+                    it["sha256"] = sha
+                    tx.put(it)
+                    job["converted"] += 1
+
+        job["state"] = "done"
+        return job
 
-    Добавлено:
-      OPTIONS /api/*            → 204 для всех preflight
-      POST    /api/meta         → {stored, name?, tags?} правка метаданных
-      POST    /api/rename       → {stored, new_name} переименование файла на диске
-      POST    /api/delete       → {stored} удалить файл и запись индекса
-      POST    /api/clear        → {wipe:bool} очистить индекс; wipe=True — удалить файлы
-      POST    /api/rescan       → перескан медиа-каталога, бережно мержит index
-      GET     /api/stats        → суммарная статистика (по типам, объём, кол-во)
-      GET     /api/file/<stored>→ мета по одному файлу (или 404)
+    def _start_migration(self) -> Dict[str, Any]:
+        """Запускает _migrate_blobs в фоне; пока проход идёт, возвращает его задачу."""
+        with self._migrate_lock:
+            job = self._migration
+            if job is not None and job.get("state") in ("queued", "running"):
+                return job
+            job = self._migration = {"state": "queued", "started": self._now_iso()}
 
-    Все ответы — JSON; индекс сохраняется как {"files":[...]}.
-    """
+        def run():
+            try:
+                self._migrate_blobs(job)
+            except Exception as e:
+                job.update(state="error", error=str(e))
+                self.app.logger.warning(f"blob migration failed: {e}")
+            job["finished"] = self._now_iso()
 
-    def __init__(self, host: str = "127.0.0.1", port: int = 7000, root_dir: Optional[str] = None):
-        self.host = host
-        self.port = port
-        self.ROOT = os.path.abspath(root_dir or os.path.dirname(__file__))
-        self.MEDIA_DIR = os.path.join(self.ROOT, "media")
-        self.INDEX_PATH = os.path.join(self.MEDIA_DIR, "index.json")
-        os.makedirs(self.MEDIA_DIR, exist_ok=True)
-        mimetypes.init()
-        self.app = Flask(__name__)
-        self._configure_routes()
+        self._migrate_thread = threading.Thread(target=run, name="MediaMigrate", daemon=True)
+        self._migrate_thread.start()
+        return job
 
-    # ------------------- helpers -------------------
+    # ------------------- квота -------------------
+
+    def _load_config(self) -> Dict[str, Any]:
+        try:
+            with open(self.CONFIG_PATH, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except Exception:
+            return {}
 
     @staticmethod
-    def _now_iso() -> str:
-        return datetime.fromtimestamp(time.time()).isoformat(timespec="seconds")
+    def _config_quota(cfg: Dict[str, Any]) -> int:
+        try:
+            return max(0, int(cfg.get("quota_bytes") or 0))
+        except (TypeError, ValueError):
+            return 0
+
+    def _last_access(self, stored: str, it: Dict[str, Any]) -> float:
+        """
+        Последнее обращение через /media, а если его не было — когда запись добавлена
+        (created). mtime файла — только у записей без created: повторная загрузка
+        ссылается на старый блоб и иначе сразу попала бы под вытеснение.
+        """
+        last = self.access.get(stored)
+        if last is not None:
+            return last
+        try:
+            return datetime.fromisoformat(it.get("created") or it.get("mtime") or "").timestamp()
+        except ValueError:
+            return 0.0
+
+    def _eviction_plan(self, quota: int) -> tuple:
+        """
+        Что вытеснить, чтобы место в media (LibraryStats.local_bytes) ушло под quota;
+        вызывать под index.locked(). → (занято, [{items, name, size, last_access}]).
+        Единица — блоб со всеми ссылающимися на него записями (или файл без блоба):
+        годится, только если у всех её записей нет тегов и pinned и к ней не обращались
+        EVICT_GRACE секунд. Порядок — по давности последнего обращения (LRU).
+        """
+        used = self.stats.local_bytes
+        if not quota or used <= quota:
+            return used, []
+        units: Dict[str, list] = {}
+        for stored, it in self.index.snapshot().by_stored.items():
+            if not it.get("path"):
+                units.setdefault(it.get("blob") or stored, []).append((stored, it))
+        fresh = time.time() - self.EVICT_GRACE
+        ranked = []
+        for key, members in units.items():
+            if any(it.get("pinned") or FacetIndex._tags_of(it) for _, it in members):
+                continue
+            last = max(self._last_access(st, it) for st, it in members)
+            if last < fresh:
+                ranked.append((last, key, members))
+        ranked.sort(key=lambda u: (u[0], u[1]))
+        plan, freed = [], 0
+        for last, _key, members in ranked:
+            if used - freed <= quota:
+                break
+            size = int(members[0][1].get("size") or 0)
+            plan.append({"items": [st for st, _ in members], "name": members[0][1].get("name"), "size": size,
+                         "last_access": datetime.fromtimestamp(last).isoformat(timespec="seconds")})
+            freed += size
+        return used, plan
+
+    def _evict(self, quota: int) -> Dict[str, Any]:
+        """Вытесняет по _eviction_plan одной транзакцией (удаление — как /api/delete)."""
+        with self._evict_lock, self.index.transaction() as tx:
+            used, plan = self._eviction_plan(quota)
+            for unit in plan:
+                for stored in unit["items"]:
+                    self._op_delete(tx, {"stored": stored})
+        freed = sum(u["size"] for u in plan)
+        if plan:
+            self.app.logger.info(f"quota {quota}: evicted {sum(len(u['items']) for u in plan)} files, freed {freed} bytes")
+        return {"quota_bytes": quota, "used_bytes": used - freed, "freed": freed, "evicted": plan}
+
+    def _maybe_evict(self) -> None:
+        """Квота превышена — вытеснение в фоне; сама проверка O(1)."""
+        quota = self.quota_bytes
+        if not quota or self.stats.local_bytes <= quota or self._evict_lock.locked():
+            return
+
+        def run():
+            try:
+                self._evict(quota)
+            except Exception as e:
+                self.app.logger.warning(f"eviction failed: {e}")
+
+        threading.Thread(target=run, name="MediaEvict", daemon=True).start()
+
+    # ------------------- import-dir -------------------
 
     @staticmethod
-    def _safe_name(name: str) -> str:
-        # Сохраняем расширение; чистим опасные символы
-        name = (name or "file").replace("\\", "_").replace("/", "_")
-        table = str.maketrans({c: "_" for c in '<>:"|?*'})
-        name = name.translate(table).strip()
-        return name or "file"
+    def _walk_tree(root: str, workers: int = 8, progress=None) -> Dict[str, tuple]:
+        """
+        Параллельный обход дерева: каждая папка — отдельная задача os.scandir
+        в пуле потоков (scandir/stat отпускают GIL, на HDD/сети это заметно).
+        Возвращает {относительный posix-путь: (inode, size, mtime_ns)}.
+        """
+        found: Dict[str, tuple] = {}
+
+        def scan_dir(rel: str) -> tuple:
+            files, subdirs = [], []
+            with os.scandir(os.path.join(root, rel) if rel else root) as it:
+                for entry in it:
+                    if entry.name.startswith("."):
+                        continue
+                    child = f"{rel}/{entry.name}" if rel else entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(child)
+                        elif entry.is_file(follow_symlinks=False):
+                            st = entry.stat(follow_symlinks=False)
+                            files.append((child, (entry.inode(), st.st_size, st.st_mtime_ns)))
+                    except OSError:
+                        continue
+            return files, subdirs
+
+        dirs_done = 0
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="MediaWalk") as pool:
+            pending = {pool.submit(scan_dir, "")}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    dirs_done += 1
+                    try:
+                        files, subdirs = fut.result()
+                    except OSError:
+                        continue
+                    found.update(files)
+                    for sub in subdirs:
+                        pending.add(pool.submit(scan_dir, sub))
+                if progress:
+                    progress(dirs_done, len(found))
+        return found
+
+    def _load_roots(self) -> List[Dict[str, Any]]:
+        try:
+            with open(self.ROOTS_PATH, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return data.get("roots", []) if isinstance(data, dict) else []
+        except Exception:
+            return []
+
+    def _import_dir(self, path: str, include_all: bool = False, job: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Индексирует внешнюю папку на месте: записи ссылаются на оригинальные файлы
+        (path), /media/<stored> отдаёт их напрямую. Повторный импорт того же корня
+        идемпотентен: id/теги сохраняются, изменённые файлы обновляются, исчезнувшие
+        удаляются. Правки идут пачками по IMPORT_BATCH, чтобы не держать индекс.
+        """
+        job = job if job is not None else {}
+        root = os.path.abspath(os.path.expanduser(path))
+        if not os.path.isdir(root):
+            raise FileNotFoundError(f"not a directory: {path}")
+        media = os.path.abspath(self.MEDIA_DIR)
+        try:
+            nested = os.path.commonpath([root, media]) in (root, media)
+        except ValueError:  # разные диски (Windows)
+            nested = False
+        if nested:
+            raise ValueError("media dir itself can not be imported (use /api/rescan)")
+
+        root_id = hashlib.sha1(os.path.normcase(root).encode("utf-8")).hexdigest()[:10]
+        prefix = f"{self.EXT_PREFIX}{root_id}/"
+
+        def progress(dirs: int, files: int) -> None:
+            job.update(state="scanning", dirs=dirs, scanned=files)
+
+        found = self._walk_tree(root, workers=min(16, (os.cpu_count() or 2) * 2), progress=progress)
+        if not include_all:
+            found = {rel: fp for rel, fp in found.items() if self._kind_by_ext(rel) != "file"}
+        job.update(state="indexing", scanned=len(found), indexed=0)
+
+        counts = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0}
+        rels = sorted(found)
+        for i in range(0, len(rels), self.IMPORT_BATCH):
+            with self.index.transaction() as tx:
+                for rel in rels[i:i + self.IMPORT_BATCH]:
+                    ino, size, mtime_ns = found[rel]
+                    stored = prefix + rel
+                    mtime = datetime.fromtimestamp(mtime_ns / 1e9).isoformat(timespec="seconds")
+                    it = tx.get(stored)
+                    if it is not None:
+                        if it.get("size") == size and it.get("mtime") == mtime:
+                            counts["unchanged"] += 1
+                            continue
+                        it = dict(it)
+                        it["size"], it["mtime"] = size, mtime
+                        counts["updated"] += 1
+                    else:
+                        it = {
+                            "id": uuid.uuid4().hex[:12],
+                            "name": rel.rsplit("/", 1)[-1],
+                            "stored": stored,
+                            "url": f"/media/{stored}",
+                            "size": size,
+                            "mtime": mtime,
+                            "mime": self._mime_of(rel),
+                            "kind": self._kind_by_ext(rel),
+                            "tags": [],
+                            "path": os.path.join(root, *rel.split("/")),
+                            "root": root_id,
+                        }
+                        counts["added"] += 1
+                    tx.put(self._set_dimensions(it, it["path"]))
+            job["indexed"] = min(len(rels), i + self.IMPORT_BATCH)
+
+        seen = {prefix + rel for rel in rels}
+        with self.index.transaction() as tx:
+            for stored in [k for k in tx.keys() if k.startswith(prefix) and k not in seen]:
+                tx.delete(stored)
+                counts["removed"] += 1
+
+        with self._roots_lock:
+            roots = [r for r in self._load_roots() if r.get("id") != root_id]
+            roots.append({"id": root_id, "path": root, "updated": self._now_iso(), "indexed": len(rels)})
+            self._atomic_write_json(self.ROOTS_PATH, {"roots": roots})
+
+        job.update(state="done", indexed=len(rels), root=root_id, **counts)
+        return {"indexed": len(rels), "root": root_id, **counts}
+
+    def _start_import_job(self, path: str, include_all: bool) -> Dict[str, Any]:
+        job = {"id": uuid.uuid4().hex[:12], "path": path, "state": "queued", "started": self._now_iso()}
+        self._jobs[job["id"]] = job
+        # держим только последние задания
+        for old in list(self._jobs)[:-32]:
+            if self._jobs[old].get("state") in ("done", "error"):
+                self._jobs.pop(old, None)
+
+        def run():
+            try:
+                self._import_dir(path, include_all, job)
+            except Exception as e:
+                job.update(state="error", error=str(e))
+                self.app.logger.warning(f"import-dir failed for {path}: {e}")
+            job["finished"] = self._now_iso()
+
+        threading.Thread(target=run, name="MediaImport", daemon=True).start()
+        return job
+
+    def _sendfile_socket(self):
+        """
+        Сокет соединения для MediaStream или None. Только werkzeug-сервер без TLS:
+        у других серверов свой wsgi.file_wrapper, а через TLS sendfile всё равно не работает.
+        """
+        if not self.USE_SENDFILE or not hasattr(os, "sendfile"):
+            return None
+        sock = request.environ.get("werkzeug.socket")
+        if sock is None or request.environ.get("wsgi.url_scheme") == "https":
+            return None
+        return sock
+
+    # запросы с большим числом диапазонов отдаются целиком (RFC 7233 §6.1)
+    MAX_RANGES = 64
 
     @staticmethod
-    def _kind_by_ext(filename: str) -> str:
-        ext = (os.path.splitext(filename)[1] or "").lower().lstrip(".")
-        if ext in ("mp3", "wav", "flac", "ogg", "m4a", "aac"): return "audio"
-        if ext in ("mp4", "webm", "mkv", "avi", "mov", "m4v"): return "video"
-        if ext in ("jpg", "jpeg", "png", "gif", "bmp", "webp", "tiff", "svg"): return "images"
-        if ext in ("pdf", "doc", "docx", "xls", "xlsx", "ppt", "pptx", "txt", "md", "epub", "rtf", "csv"): return "docs"
-        return "file"
+    def _parse_ranges(header: str, size: int) -> Optional[List[tuple]]:
+        """
+        Range: bytes=a-b, a-, -n (RFC 7233) → отсортированные непересекающиеся
+        [(start, end)) с end не включительно. None — заголовок некорректен
+        (игнорируется, отдаём весь файл), [] — ни один диапазон не выполним (416).
+        """
+        unit, _, spec = (header or "").partition("=")
+        if unit.strip().lower() != "bytes" or not spec.strip():
+            return None
+        ranges: List[tuple] = []
+        for part in spec.split(","):
+            part = part.strip()
+            if not part:
+                continue
+            first, dash, last = part.partition("-")
+            first, last = first.strip(), last.strip()
+            if not dash or not (first.isdigit() or (not first and last.isdigit())) or (last and not last.isdigit()):
+                return None
+            if not first:
+                n = int(last)  # суффикс: последние n байт
+                if n > 0 and size > 0:
+                    ranges.append((max(0, size - n), size))
+                continue
+            start = int(first)
+            end = int(last) + 1 if last else size
+            if last and end <= start:
+                return None
+            if start < size:
+                ranges.append((start, min(end, size)))
+        ranges.sort()
+        merged: List[tuple] = []
+        for start, end in ranges:
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
 
-    def _mime_of(self, filename: str) -> str:
-        return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    # ------------------- chunked uploads -------------------
 
-    def _atomic_write_json(self, path: str, data: Any) -> None:
-        tmp = path + ".tmp"
-        with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        os.replace(tmp, path)
+    _UPLOAD_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+    _CONTENT_RANGE_RE = re.compile(r"^bytes (\d+)-(\d+)/(\d+|\*)$")
 
-    # ------------------- index IO -------------------
+    def _upload_paths(self, upload_id: str) -> Optional[tuple]:
+        """(путь .part, путь .json) сессии или None для недопустимого id."""
+        if not self._UPLOAD_ID_RE.match(upload_id or ""):
+            return None
+        base = os.path.join(self.UPLOADS_DIR, upload_id)
+        return base + ".part", base + ".json"
+
+    def _upload_lock(self, upload_id: str) -> threading.Lock:
+        with self._upload_locks_guard:
+            return self._upload_locks.setdefault(upload_id, threading.Lock())
 
-    def _load_index(self) -> List[Dict[str, Any]]:
+    def _load_upload(self, upload_id: str) -> Optional[Dict[str, Any]]:
+        paths = self._upload_paths(upload_id)
+        if paths is None or not os.path.isfile(paths[0]):
+            return None
         try:
-            with open(self.INDEX_PATH, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            if isinstance(data, dict): return data.get("files", []) or []
-            if isinstance(data, list): return data
+            with open(paths[1], "r", encoding="utf-8") as f:
+                return json.load(f)
         except Exception:
-            pass
-        return []
-
-    def _save_index(self, files: List[Dict[str, Any]]) -> None:
-        self._atomic_write_json(self.INDEX_PATH, {"files": files})
-
-    def _merge_index(self, new_items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        existing = self._load_index()
-        by_stored = {it.get("stored") or it.get("url"): it for it in existing}
-        for it in new_items:
-            key = it.get("stored") or it.get("url")
-            if key not in by_stored:
-                existing.append(it)
-        return existing
-
-    def _scan_media_dir(self) -> List[Dict[str, Any]]:
-        """Сканирует /media и собирает новый список мета."""
-        items: List[Dict[str, Any]] = []
-        for fname in os.listdir(self.MEDIA_DIR):
-            ap = os.path.join(self.MEDIA_DIR, fname)
-            if not os.path.isfile(ap): continue
-            st = os.stat(ap)
-            items.append({
-                "id": uuid.uuid4().hex[:12],
-                "name": fname,
-                "stored": fname,
-                "url": f"/media/{fname}",
-                "size": st.st_size,
-                "mtime": datetime.fromtimestamp(st.st_mtime).isoformat(timespec="seconds"),
-                "mime": self._mime_of(fname),
-                "kind": self._kind_by_ext(fname),
-                "tags": []
-            })
-        return items
+            return None
+
+    def _drop_upload(self, upload_id: str) -> None:
+        for path in self._upload_paths(upload_id) or ():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        with self._upload_locks_guard:
+            self._upload_locks.pop(upload_id, None)
+
+    def _purge_uploads(self) -> None:
+        """Удаляет брошенные сессии старше UPLOAD_TTL (по времени последнего куска)."""
+        if not os.path.isdir(self.UPLOADS_DIR):
+            return
+        cutoff = time.time() - self.UPLOAD_TTL
+        for fname in os.listdir(self.UPLOADS_DIR):
+            path = os.path.join(self.UPLOADS_DIR, fname)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+            except OSError:
+                continue
+
+    @staticmethod
+    def _merge_range(ranges: List[list], start: int, end: int) -> List[list]:
+        """Добавляет [start, end) к отсортированному списку непересекающихся диапазонов."""
+        out: List[list] = []
+        for a, b in ranges:
+            if b < start or a > end:
+                out.append([a, b])
+            else:
+                start, end = min(a, start), max(b, end)
+        out.append([start, end])
+        out.sort()
+        return out
+
+    @staticmethod
+    def _subtract_range(ranges: List[list], start: int, end: int) -> List[list]:
+        """Убирает [start, end) из списка диапазонов."""
+        out: List[list] = []
+        for a, b in ranges:
+            if a < start:
+                out.append([a, min(b, start)])
+            if b > end:
+                out.append([max(a, end), b])
+        return out
+
+    def _create_upload(self, name: str, size: int, sha256: Optional[str]) -> Dict[str, Any]:
+        os.makedirs(self.UPLOADS_DIR, exist_ok=True)
+        upload_id = uuid.uuid4().hex
+        part_path, meta_path = self._upload_paths(upload_id)
+        # файл сразу полного размера: куски пишутся по своим смещениям в любом порядке
+        with open(part_path, "wb") as f:
+            f.truncate(size)
+        session = {"id": upload_id, "name": self._safe_name(name), "size": size,
+                   "sha256": sha256, "created": self._now_iso(), "received": []}
+        self._atomic_write_json(meta_path, session)
+        return session
+
+    def _write_chunk(self, upload_id: str, start: int, end: int, stream, chunk_sha: Optional[str]) -> tuple:
+        """
+        Пишет тело запроса в .part по смещению start (end — не включая) и
+        отмечает диапазон принятым. → (session, None) или (None, (ошибка, код)).
+        """
+        part_path, meta_path = self._upload_paths(upload_id)
+        h = hashlib.sha256() if chunk_sha else None
+        written = 0
+        try:
+            f = open(part_path, "r+b")
+        except FileNotFoundError:  # сессию отменили или уже завершили
+            return None, ("not found", 404)
+        with f:
+            f.seek(start)
+            while written < end - start:
+                buf = stream.read(min(self.HASH_CHUNK, end - start - written))
+                if not buf:
+                    break
+                f.write(buf)
+                if h is not None:
+                    h.update(buf)
+                written += len(buf)
+        err = None
+        if written != end - start:
+            err = ("incomplete chunk", 400)
+        elif h is not None and h.hexdigest() != chunk_sha.lower():
+            err = ("chunk checksum mismatch", 422)
+        with self._upload_lock(upload_id):
+            session = self._load_upload(upload_id)
+            if session is None:
+                return None, ("not found", 404)
+            if err:
+                # байты уже легли поверх [start, end) — этот участок придётся прислать заново
+                session["received"] = self._subtract_range(session["received"], start, end)
+            else:
+                session["received"] = self._merge_range(session["received"], start, end)
+            self._atomic_write_json(meta_path, session)
+        return (None, err) if err else (session, None)
+
+    def _complete_upload(self, upload_id: str) -> tuple:
+        """Проверяет полноту и SHA-256 и передаёт файл в _ingest_file. → (item, None) или (None, (ошибка, код))."""
+        with self._upload_lock(upload_id):
+            session = self._load_upload(upload_id)
+            if session is None:
+                return None, ("not found", 404)
+            if session["received"] != [[0, session["size"]]] and session["size"] > 0:
+                return None, ("upload incomplete", 409)
+            part_path, _ = self._upload_paths(upload_id)
+            with open(part_path, "rb") as f:
+                h = hashlib.sha256()
+                for buf in iter(lambda: f.read(self.HASH_CHUNK), b""):
+                    h.update(buf)
+            sha256 = h.hexdigest()
+            if session.get("sha256") and session["sha256"].lower() != sha256:
+                return None, ("checksum mismatch", 422)
+            item = self._ingest_file(part_path, session["name"], sha256)
+            self._drop_upload(upload_id)
+        return item, None
 
     # ------------------- routes -------------------
 
@@ -133,11 +4117,12 @@ class SalemMediaServer:
 
         @app.after_request
         def add_headers(resp):
+            # маршруты со своей политикой кэширования (/media, иконки) её и оставляют
             resp.headers["Access-Control-Allow-Origin"] = "*"
-            resp.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
-            resp.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
-            resp.headers["Accept-Ranges"] = "bytes"
-            resp.headers["Cache-Control"] = "no-store"
+            resp.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS"
+            resp.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization, Content-Range, X-Chunk-SHA256"
+            resp.headers.setdefault("Accept-Ranges", "bytes")
+            resp.headers.setdefault("Cache-Control", "no-store")
             return resp
 
         # Универсальный OPTIONS для CORS
@@ -196,56 +4181,118 @@ class SalemMediaServer:
         # ---- Files listing ----
         @app.route("/api/files", methods=["GET"])
         def api_files():
-            files = self._load_index()
-            q = (request.args.get("q") or "").strip().lower()
+            q = (request.args.get("q") or "").strip()
             kind = (request.args.get("kind") or "").strip().lower()
-            sort = (request.args.get("sort") or "name").lower()  # name|date|size
-            order = (request.args.get("order") or "asc").lower() # asc|desc
+            sort = (request.args.get("sort") or ("relevance" if q else "name")).lower()  # name|date|size|relevance
+            order = (request.args.get("order") or ("desc" if sort == "relevance" else "asc")).lower() # asc|desc
             limit = int(request.args.get("limit", "0") or 0)
             offset = int(request.args.get("offset", "0") or 0)
+            cursor = (request.args.get("cursor") or "").strip()
+            if sort not in SortedOrderings.KEYS and sort != "relevance":
+                sort = "date"
+            sort_key = "date" if sort == "relevance" else sort  # relevance без q — как date
 
-            if q:
-                files = [f for f in files if q in (f.get("name") or "").lower() or any(q in (t or "").lower() for t in f.get("tags", []))]
-            if kind:
-                files = [f for f in files if (f.get("kind") or "").lower() == kind]
-
-            def key_name(x): return (x.get("name") or "").lower()
-            def key_date(x): return x.get("mtime") or ""
-            def key_size(x): return int(x.get("size") or 0)
+            after = None
+            if cursor:
+                try:
+                    c_sort, c_order, c_key = _decode_cursor(cursor)
+                    if c_sort != sort or c_order != order:
+                        raise ValueError("cursor does not match sort/order")
+                    after = tuple(c_key)
+                except Exception:
+                    return jsonify({"error": "bad cursor"}), 400
 
-            keyfn = key_name if sort == "name" else key_size if sort == "size" else key_date
-            files = sorted(files, key=keyfn, reverse=(order=="desc"))
+            tags, tag_mode = self._tag_args()
+            # всё — из живых индексов под блокировкой писателя, без среза: страница стоит O(limit)
+            get = self.index.get
+            with self.index.locked():
+                selected, scores = self._select_files(q, kind, tags, tag_mode)
+                if selected is not None:
+                    hits = [it for it in map(get, selected) if it is not None]
+                    if sort == "relevance" and scores is not None:
+                        # (−релевантность, имя, stored): «desc» = самые релевантные первыми
+                        rows = sorted((-scores[_entry_key(f)], (f.get("name") or "").lower(), _entry_key(f))
+                                      for f in hits)
+                        reverse = order != "desc"
+                    else:
+                        rows = sorted(SortedOrderings.row_of(sort_key, f) for f in hits)
+                        reverse = order == "desc"
+                else:
+                    # без поиска и тегов — готовый порядок, страница это срез
+                    rows = self.orderings.rows(sort_key, kind)
+                    reverse = order == "desc"
+                page, more = _page(rows, reverse, limit, offset, after)
+                files = [get(row[-1]) for row in page]
+                total = len(rows)
+                # версия снята под той же блокировкой, что и выборка: /api/changes?since=version догонит ровно с неё
+                version = self.index.version
 
-            total = len(files)
+            out = {"files": files, "total": total, "version": version}
             if limit > 0:
-                files = files[offset: offset+limit]
-
-            return jsonify({"files": files, "total": total})
+                out["next_cursor"] = _encode_cursor([sort, order, list(page[-1])]) if (more and page) else None
+            return jsonify(out)
         
+        @app.route("/api/facets", methods=["GET"])
+        def api_facets():
+            """
+            Счётчики фасетов для текущего запроса (те же q/kind/tag/tag_mode, что у /api/files).
+            ?top=N — только N самых частых тегов.
+            """
+            q = (request.args.get("q") or "").strip()
+            kind = (request.args.get("kind") or "").strip().lower()
+            tags, tag_mode = self._tag_args()
+            top = int(request.args.get("top", "0") or 0)
+
+            with self.index.locked():
+                selected, _ = self._select_files(q, kind, tags, tag_mode)
+                if selected is None and kind:
+                    selected = self.facets.by_kind.get(kind, set())
+                if selected is None:
+                    # вся библиотека — размеры множеств, без прохода по записям
+                    tag_counts = {t: len(m) for t, m in self.facets.by_tag.items()}
+                    kind_counts = {k: len(m) for k, m in self.facets.by_kind.items()}
+                    total = len(self.index.snapshot().by_stored)
+                else:
+                    snap = self.index.snapshot()
+                    tag_counts, kind_counts = {}, {}
+                    for st in selected:
+                        it = snap.by_stored.get(st)
+                        if it is None:
+                            continue
+                        k = (it.get("kind") or "file").lower()
+                        kind_counts[k] = kind_counts.get(k, 0) + 1
+                        for t in FacetIndex._tags_of(it):
+                            tag_counts[t] = tag_counts.get(t, 0) + 1
+                    total = len(selected)
+
+            tag_counts = {t: n for t, n in tag_counts.items() if n}
+            if top > 0:
+                tag_counts = dict(sorted(tag_counts.items(), key=lambda kv: (-kv[1], kv[0]))[:top])
+            return jsonify({"ok": True, "total": total, "kinds": kind_counts, "tags": tag_counts})
+
          # ---------- UI Config ----------
         @app.route("/api/config", methods=["GET", "POST"])
         def api_config():
-            cfg_path = os.path.join(self.MEDIA_DIR, "config.json")
-
             if request.method == "GET":
-                try:
-                    with open(cfg_path, "r", encoding="utf-8") as f:
-                        data = json.load(f)
-                    if not isinstance(data, dict):
-                        data = {}
-                except Exception:
-                    data = {}
-                return jsonify({"ok": True, "config": data})
+                return jsonify({"ok": True, "config": self._load_config()})
 
-            # POST — сохранить конфиг
+            # POST — сохранить конфиг; переданные ключи дополняют сохранённые
+            # (клиент шлёт только свои настройки и не должен стирать quota_bytes)
             data = request.get_json(silent=True) or {}
-            allowed = {"apiBase", "theme", "useServer", "autoplay"}
-            cfg = {k: data.get(k) for k in allowed if k in data}
+            allowed = {"apiBase", "theme", "useServer", "autoplay", "quota_bytes"}
+            if "quota_bytes" in data:
+                q = data["quota_bytes"]
+                if q is not None and (isinstance(q, bool) or not isinstance(q, int) or q < 0):
+                    return jsonify({"error": "quota_bytes must be a non-negative integer"}), 400
+            cfg = self._load_config()
+            cfg.update({k: data.get(k) for k in allowed if k in data})
             try:
-                self._atomic_write_json(cfg_path, cfg)
+                self._atomic_write_json(self.CONFIG_PATH, cfg)
             except Exception as e:
                 return jsonify({"error": f"save failed: {e}"}), 500
-            return jsonify({"ok": True})  # ← ЭТОГО НЕ ХВАТАЛО
+            self.quota_bytes = self._config_quota(cfg)
+            self._maybe_evict()
+            return jsonify({"ok": True})
 
 
         # ---- Upload ----
@@ -260,39 +4307,208 @@ class SalemMediaServer:
 
             saved_items: List[Dict[str, Any]] = []
             for file in uploaded:
-                orig_name = self._safe_name(file.filename or "file")
-                uid = uuid.uuid4().hex[:8]
-                base, ext = os.path.splitext(orig_name)
-                stored_name = self._safe_name(f"{uid}_{base}{ext}")
-                path = os.path.join(self.MEDIA_DIR, stored_name)
-                file.save(path)
-
-                st = os.stat(path)
-                item = {
-                    "id": uuid.uuid4().hex[:12],
-                    "name": orig_name,
-                    "stored": stored_name,
-                    "url": f"/media/{stored_name}",
-                    "size": st.st_size,
-                    "mtime": datetime.fromtimestamp(st.st_mtime).isoformat(timespec="seconds"),
-                    "mime": self._mime_of(stored_name),
-                    "kind": self._kind_by_ext(stored_name),
-                    "tags": []
-                }
-                saved_items.append(item)
+                # пишем во временный файл (перескан его не подхватит), хэш считаем по ходу записи
+                tmp_path = os.path.join(self.MEDIA_DIR, f".upload-{uuid.uuid4().hex}.tmp")
+                try:
+                    sha256, _size = self._save_hashed(file.stream, tmp_path)
+                    saved_items.append(self._ingest_file(tmp_path, file.filename or "file", sha256))
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
 
-            merged = self._merge_index(saved_items)
-            self._save_index(merged)
             return jsonify({"ok": True, "files": saved_items})
 
+        # ---- Resumable chunked uploads ----
+        @app.route("/api/uploads", methods=["POST"])
+        def api_uploads_create():
+            """
+            Сессия докачиваемой загрузки. Body JSON: {name, size, sha256?}
+            Дальше — PUT кусков в любом порядке (можно параллельно), GET — что уже
+            принято, POST .../complete — сборка. Сессия переживает перезапуск сервера.
+            """
+            data = request.get_json(silent=True) or {}
+            try:
+                size = int(data.get("size"))
+            except (TypeError, ValueError):
+                return jsonify({"error": "size is required"}), 400
+            if size < 0:
+                return jsonify({"error": "bad size"}), 400
+            sha256 = data.get("sha256")
+            if sha256 is not None and not re.fullmatch(r"[0-9a-fA-F]{64}", str(sha256)):
+                return jsonify({"error": "bad sha256"}), 400
+            session = self._create_upload(data.get("name") or "file", size, sha256)
+            return jsonify({"ok": True, "chunk_size": self.UPLOAD_CHUNK, **session})
+
+        @app.route("/api/uploads/<upload_id>", methods=["GET", "PUT", "DELETE"])
+        def api_upload_session(upload_id: str):
+            session = self._load_upload(upload_id)
+            if session is None:
+                return jsonify({"error": "not found"}), 404
+
+            if request.method == "DELETE":
+                with self._upload_lock(upload_id):
+                    self._drop_upload(upload_id)
+                return jsonify({"ok": True})
+
+            if request.method == "PUT":
+                m = self._CONTENT_RANGE_RE.match(request.headers.get("Content-Range", "").strip())
+                if not m:
+                    return jsonify({"error": "Content-Range required"}), 400
+                start, last = int(m.group(1)), int(m.group(2))
+                if last < start or last >= session["size"] or m.group(3) not in ("*", str(session["size"])):
+                    return jsonify({"error": "range not satisfiable"}), 416
+                session, err = self._write_chunk(upload_id, start, last + 1, request.stream,
+                                                 request.headers.get("X-Chunk-SHA256"))
+                if err:
+                    return jsonify({"error": err[0]}), err[1]
+
+            received = sum(b - a for a, b in session["received"])
+            return jsonify({"ok": True, "id": upload_id, "name": session["name"], "size": session["size"],
+                            "received": session["received"], "received_bytes": received,
+                            "complete": received == session["size"]})
+
+        @app.route("/api/uploads/<upload_id>/complete", methods=["POST"])
+        def api_upload_complete(upload_id: str):
+            item, err = self._complete_upload(upload_id)
+            if err:
+                return jsonify({"error": err[0]}), err[1]
+            return jsonify({"ok": True, "file": item})
+
+        # ---- Thumbnails ----
+        @app.route("/api/thumb/<path:stored>", methods=["GET"])
+        def api_thumb(stored: str):
+            """Превью изображения или обложки трека: w/h — рамка (по умолчанию THUMB_SIZE), fmt=jpg|png|webp."""
+            stored = stored.replace("\\", "/")
+            it = self.index.get(stored)
+            if it is None:
+                return jsonify({"error": "not found"}), 404
+            if it.get("kind") != "images" and not it.get("cover"):
+                return jsonify({"error": "no thumbnail for this kind"}), 415
+            if not self.thumbs.available:
+                return jsonify({"error": "thumbnailer unavailable"}), 503
+            try:
+                w = int(request.args.get("w") or self.THUMB_SIZE)
+                h = int(request.args.get("h") or w)
+            except ValueError:
+                return jsonify({"error": "bad size"}), 400
+            w = max(16, min(w, self.THUMB_MAX_SIDE))
+            h = max(16, min(h, self.THUMB_MAX_SIDE))
+            fmt = (request.args.get("fmt") or "jpg").lower().replace("jpeg", "jpg")
+            if fmt not in ThumbCache.FORMATS:
+                return jsonify({"error": "bad fmt"}), 400
+
+            path = self._thumb_for(it, w, h, fmt)
+            if path is None:
+                return jsonify({"error": "cannot decode image"}), 422
+            resp = send_file(path, mimetype=ThumbCache.FORMATS[fmt][1], conditional=True)
+            resp.headers["Cache-Control"] = "public, max-age=300"
+            return resp
+
+        # ---- Waveform peaks ----
+        @app.route("/api/peaks/<path:stored>", methods=["GET"])
+        def api_peaks(stored: str):
+            """Пики волны для скраббера: ?buckets=N (по умолчанию 1000, не больше WaveformPeaks.BASE)."""
+            stored = stored.replace("\\", "/")
+            it = self.index.get(stored)
+            if it is None:
+                return jsonify({"error": "not found"}), 404
+            if it.get("kind") not in ("audio", "video"):
+                return jsonify({"error": "no waveform for this kind"}), 415
+            try:
+                buckets = int(request.args.get("buckets") or 1000)
+            except ValueError:
+                return jsonify({"error": "bad buckets"}), 400
+            buckets = max(1, min(buckets, WaveformPeaks.BASE))
+            src, content = self._content_key(it)
+            if src is None:
+                return jsonify({"error": "not found"}), 404
+            if not self.peaks.can_decode(src):
+                return jsonify({"error": "no decoder for this format"}), 415
+            peaks = self.peaks.get(src, content, buckets)
+            if peaks is None:
+                return jsonify({"error": "cannot decode audio"}), 422
+            resp = jsonify({"ok": True, **peaks})
+            resp.headers["Cache-Control"] = "public, max-age=300"
+            return resp
+
+        # ---- Near-duplicate images ----
+        @app.route("/api/duplicates", methods=["GET"])
+        def api_duplicates():
+            """
+            Группы почти одинаковых картинок: ?threshold=0..4 — сколько бит dHash могут
+            отличаться (по умолчанию DUP_THRESHOLD), album=<имя> — только среди картинок альбома,
+            limit/offset — страница групп. В каждой группе keep — что предлагается оставить.
+            pending — сколько картинок ещё ждут расчёта хэша.
+            """
+            try:
+                threshold = int(request.args.get("threshold") or self.DUP_THRESHOLD)
+                limit = int(request.args.get("limit", "0") or 0)
+                offset = int(request.args.get("offset", "0") or 0)
+            except ValueError:
+                return jsonify({"error": "bad number"}), 400
+            if not 0 <= threshold <= ImageHashes.MAX_THRESHOLD:
+                return jsonify({"error": f"threshold must be 0..{ImageHashes.MAX_THRESHOLD}"}), 400
+            within = None
+            album_name = (request.args.get("album") or "").strip()
+            if album_name:
+                album_name = self._safe_name(album_name)
+                found = self.albums.items(album_name)
+                if found is None:
+                    return jsonify({"error": "album not found"}), 404
+                within = set(found[1])
+
+            self.phashes.want()
+            with self.index.locked():
+                groups = self.phashes.clusters(threshold, within)
+                snap = self.index.snapshot()
+            total = len(groups)
+            groups = groups[max(0, offset):]
+            if limit > 0:
+                groups = groups[:limit]
+            clusters = []
+            for group in groups:
+                items = [snap.by_stored[st] for st in group if st in snap.by_stored]
+                clusters.append({"keep": max(items, key=self._keep_rank)["stored"], "items": items})
+            return jsonify({"ok": True, "threshold": threshold, "total": total, "clusters": clusters,
+                            "pending": self.phashes.pending})
+
+        @app.route("/api/duplicates/resolve", methods=["POST"])
+        def api_duplicates_resolve():
+            """
+            Разбор группы дубликатов. Body JSON: { keep: "a.jpg", remove: ["b.jpg", ...] }
+            Лишние записи удаляются как через /api/delete (общий блоб — по последней ссылке),
+            а в альбомах заменяются на keep, чтобы альбом не потерял снимок.
+            """
+            data = request.get_json(silent=True) or {}
+            keep = (data.get("keep") or "").strip()
+            remove = data.get("remove") or []
+            if not keep or not isinstance(remove, list) or not all(isinstance(x, str) for x in remove):
+                return jsonify({"error": "keep and remove (list of stored) are required"}), 400
+            if self.index.get(keep) is None:
+                return jsonify({"error": "not found"}), 404
+            remove = [st for st in dict.fromkeys(remove) if st != keep]
+
+            # удалённые → keep на месте первого из них, без повторов
+            changed = self.albums.replace_items(set(remove), keep)
+            with self.index.locked():
+                for name in changed:
+                    self.stats.album_remove(name, remove)
+                    self.stats.album_add(name, [keep])
+
+            results = []
+            with self.index.transaction() as tx:
+                for st in remove:
+                    body, status = self._op_delete(tx, {"stored": st})
+                    results.append({"stored": st, "status": status, **body})
+            return jsonify({"ok": True, "keep": keep, "albums": changed, "results": results})
+
         # ---- Single file meta ----
         @app.route("/api/file/<path:stored>", methods=["GET"])
         def api_file(stored: str):
             stored = stored.replace("\\", "/")
-            files = self._load_index()
-            for it in files:
-                if it.get("stored") == stored:
-                    return jsonify({"file": it})
+            it = self.index.get(stored)
+            if it is not None:
+                return jsonify({"file": it})
             return jsonify({"error": "not found"}), 404
 
         # ---- Update meta (name/tags) ----
@@ -305,48 +4521,9 @@ class SalemMediaServer:
             Body JSON: { stored: "xxxx.ext", tags?: [..], props?: {..} }
             """
             data = request.get_json(silent=True) or {}
-            stored = (data.get("stored") or "").strip()
-            if not stored:
-                return jsonify({"error": "stored is required"}), 400
-
-            files = self._load_index()
-            updated = False
-            for it in files:
-                if it.get("stored") == stored or it.get("url") == f"/media/{stored}":
-                    if isinstance(data.get("tags"), list):
-                        # ограничим длину и приведём к строкам
-                        it["tags"] = [str(t)[:128] for t in data["tags"]][:128]
-                    if isinstance(data.get("props"), dict):
-                        # лёгкая нормализация ключей/значений
-                        it["props"] = {str(k)[:64]: (v if isinstance(v, (int, float, bool)) else str(v)[:1024])
-                                       for k, v in data["props"].items()}
-                    updated = True
-                    break
-
-            # если в индексе нет, но файл на диске есть — создадим запись
-            if not updated:
-                path = os.path.join(self.MEDIA_DIR, stored)
-                if os.path.isfile(path):
-                    st = os.stat(path)
-                    files.append({
-                        "id": uuid.uuid4().hex[:12],
-                        "name": os.path.basename(stored),
-                        "stored": stored,
-                        "url": f"/media/{stored}",
-                        "size": st.st_size,
-                        "mtime": datetime.fromtimestamp(st.st_mtime).isoformat(timespec="seconds"),
-                        "mime": self._mime_of(stored),
-                        "kind": self._kind_by_ext(stored),
-                        "tags": [str(t) for t in (data.get("tags") or [])],
-                        "props": data.get("props") or {},
-                    })
-                    updated = True
-
-            if not updated:
-                return jsonify({"error": "not found"}), 404
-
-            self._save_index(files)
-            return jsonify({"ok": True})
+            with self.index.transaction() as tx:
+                body, status = self._op_meta(tx, data)
+            return jsonify(body), status
 
         @app.route("/api/delete", methods=["POST"])
         def api_delete():
@@ -355,58 +4532,55 @@ class SalemMediaServer:
             Body JSON: { stored: "xxxx.ext" } или { url: "/media/xxxx.ext" }
             """
             data = request.get_json(silent=True) or {}
-            stored = data.get("stored")
-            url = data.get("url")
-            if (not stored) and url:
-                if url.startswith("/media/"): stored = url.split("/media/", 1)[1]
-                else: return jsonify({"error":"bad url"}), 400
-            if not stored:
-                return jsonify({"error":"stored is required"}), 400
-
-            # защита от traversal
-            stored = stored.replace("\\", "/")
-            if ".." in stored:
-                return jsonify({"error":"forbidden"}), 403
-
-            path = os.path.join(self.MEDIA_DIR, stored)
-            files = self._load_index()
-            before = len(files)
-            files = [it for it in files if it.get("stored") != stored and it.get("url") != f"/media/{stored}"]
-
-            # удаляем с диска молча, даже если нет в индексе
-            try:
-                if os.path.isfile(path):
-                    os.remove(path)
-            except Exception as e:
-                # не валим запрос, просто сообщим
-                self.app.logger.warning(f"delete failed for {path}: {e}")
-
-            self._save_index(files)
-            return jsonify({"ok": True, "removed_from_index": before - len(files)})
+            with self.index.transaction() as tx:
+                body, status = self._op_delete(tx, data)
+            return jsonify(body), status
 
         @app.route("/api/clear", methods=["POST"])
         def api_clear():
             """
-            Полная очистка каталога media (кроме index.json) и индекса.
+            Полная очистка каталога media (кроме служебных файлов) и индекса.
             Body JSON: { wipe: true } — простая защита от случайных кликов.
             """
             data = request.get_json(silent=True) or {}
             if not data.get("wipe"):
                 return jsonify({"error":"confirm wipe=true"}), 400
 
-            # удаляем все файлы из media, кроме index.json
+            # удаляем все файлы из media, кроме служебных (индекс, альбомы, конфиг), и блобы в шардах
+            shards = []
             for fname in os.listdir(self.MEDIA_DIR):
-                if fname == os.path.basename(self.INDEX_PATH):
+                if self._is_service_file(fname):
                     continue
                 fpath = os.path.join(self.MEDIA_DIR, fname)
                 try:
                     if os.path.isfile(fpath):
                         os.remove(fpath)
+                    elif _SHARD_RE.fullmatch(fname) and os.path.isdir(fpath):
+                        shards.append(fname)
                 except Exception as e:
                     self.app.logger.warning(f"clear skip {fpath}: {e}")
+            for rel in self._scan_shards(shards):
+                fpath = os.path.join(self.MEDIA_DIR, rel)
+                try:
+                    os.remove(fpath)
+                except OSError as e:
+                    self.app.logger.warning(f"clear skip {fpath}: {e}")
+            for top in shards:
+                # пустые шарды — следом; чужие файлы в них остаются вместе с каталогом
+                for sub in os.listdir(os.path.join(self.MEDIA_DIR, top)):
+                    try:
+                        os.rmdir(os.path.join(self.MEDIA_DIR, top, sub))
+                    except OSError:
+                        pass
+                try:
+                    os.rmdir(os.path.join(self.MEDIA_DIR, top))
+                except OSError:
+                    pass
 
-            # чистим индекс
-            self._save_index([])
+            # чистим индекс (и список внешних корней — их записи уходят вместе с индексом)
+            self.index.clear()
+            with self._roots_lock:
+                self._atomic_write_json(self.ROOTS_PATH, {"roots": []})
             return jsonify({"ok": True})
 
         @app.route("/api/rename", methods=["POST"])
@@ -417,78 +4591,198 @@ class SalemMediaServer:
             Если new_stored не задан — сгенерируем безопасное на основе new_name или old.
             """
             data = request.get_json(silent=True) or {}
-            stored_old = (data.get("stored") or "").strip()
-            if not stored_old:
-                return jsonify({"error":"stored is required"}), 400
-
-            new_stored = (data.get("new_stored") or "").strip()
-            new_name = (data.get("new_name") or "").strip()
-
-            # нормализуем
-            if not new_stored:
-                base_old, ext = os.path.splitext(stored_old)
-                base = self._safe_name(new_name or base_old)
-                # не теряем расширение
-                if ext and not base.endswith(ext):
-                    new_stored = f"{base}{ext}"
-                else:
-                    new_stored = base
+            # переименование на диске и в индексе — под блокировкой писателя индекса
+            with self.index.transaction() as tx:
+                body, status = self._op_rename(tx, data)
+            return jsonify(body), status
 
-            # защита от traversal
-            for v in (stored_old, new_stored):
-                if ".." in v or "/" in v or "\\" in v:
-                    return jsonify({"error":"bad name"}), 400
+        @app.route("/api/batch", methods=["POST"])
+        def api_batch():
+            """
+            Пачка операций одной транзакцией индекса: одна строка журнала и один сброс
+            вместо запроса на каждый файл.
+            Body JSON: { ops: [{op: "delete"|"meta"|"rename"|"album_add", ...поля как у отдельного маршрута}] }
+            album_add: {album, items: [stored]}.
+            Операции выполняются по порядку и независимы: ошибка одной не отменяет остальные
+            (и не превращает ответ в 500 — уже применённые операции зафиксированы).
+            Ответ: {ok, applied, results: [{status, ok, error?, ...}]} — в порядке ops.
+            """
+            data = request.get_json(silent=True)
+            ops = data.get("ops") if isinstance(data, dict) else data
+            if not isinstance(ops, list) or not ops:
+                return jsonify({"error": "ops must be a non-empty list"}), 400
+            if len(ops) > self.BATCH_MAX:
+                return jsonify({"error": f"too many ops (max {self.BATCH_MAX})"}), 413
 
-            src = os.path.join(self.MEDIA_DIR, stored_old)
-            dst = os.path.join(self.MEDIA_DIR, new_stored)
-            if not os.path.isfile(src):
-                return jsonify({"error":"not found"}), 404
-            if os.path.exists(dst):
-                # добавим уникальный хвост
-                uid = uuid.uuid4().hex[:6]
-                base, ext = os.path.splitext(new_stored)
-                new_stored = f"{base}_{uid}{ext}"
-                dst = os.path.join(self.MEDIA_DIR, new_stored)
+            handlers = {"delete": self._op_delete, "meta": self._op_meta, "rename": self._op_rename}
+            results = []
+            with self.index.transaction() as tx:
+                for item in ops:
+                    op = str(item.get("op") or "").lower() if isinstance(item, dict) else ""
+                    try:
+                        if op == "album_add":
+                            body, status = self._op_album_add(item)
+                        elif op in handlers:
+                            body, status = handlers[op](tx, item)
+                        else:
+                            body, status = {"error": "unknown op (use delete|meta|rename|album_add)"}, 400
+                    except OSError as e:
+                        body, status = {"error": str(e)}, 500
+                    except Exception as e:
+                        self.app.logger.warning(f"batch op {op or '?'} failed: {e!r}")
+                        body, status = {"error": f"{type(e).__name__}: {e}"}, 500
+                    results.append({"status": status, "ok": status == 200, **body})
+            applied = sum(1 for r in results if r["status"] == 200)
+            return jsonify({"ok": applied == len(results), "applied": applied, "results": results})
 
-            os.rename(src, dst)
+        @app.route("/api/events", methods=["GET"])
+        def api_events():
+            """
+            Лента изменений индекса (Server-Sent Events) — клиент патчит сетку вместо
+            повторного /api/files. События:
+              hello  — {version} при подключении без Last-Event-ID;
+              change — id: версия, data: {version, added: [записи], updated: [записи], removed: [stored]};
+              resync — {version}: пропущенное уже не восстановить (очистка индекса, перезапуск,
+                       слишком давно) — перечитать список целиком.
+            При обрыве браузер переподключается сам и шлёт Last-Event-ID (или ?since=N);
+            без изменений раз в EVENTS_HEARTBEAT секунд уходит комментарий-пинг.
+            """
+            raw = request.headers.get("Last-Event-ID") or request.args.get("since") or ""
+            since = int(raw) if raw.strip().isdigit() else None
 
-            # обновляем индекс
-            files = self._load_index()
-            for it in files:
-                if it.get("stored") == stored_old or it.get("url") == f"/media/{stored_old}":
-                    it["stored"] = new_stored
-                    it["url"] = f"/media/{new_stored}"
-                    if new_name:
-                        it["name"] = new_name
-                    # обновим mime/kind/mtime/size
-                    st = os.stat(dst)
-                    it["size"] = st.st_size
-                    it["mtime"] = datetime.fromtimestamp(st.st_mtime).isoformat(timespec="seconds")
-                    it["mime"] = self._mime_of(new_stored)
-                    it["kind"] = self._kind_by_ext(new_stored)
-                    break
-            self._save_index(files)
-            return jsonify({"ok": True, "stored": new_stored, "url": f"/media/{new_stored}"})
+            def stream():
+                last = self.index.version if since is None else since
+                yield f"retry: {self.EVENTS_RETRY_MS}\n\n"
+                if since is None:
+                    yield f"id: {last}\nevent: hello\ndata: {json.dumps({'version': last})}\n\n"
+                while True:
+                    current, records = self.index.changes_since(last)
+                    if records is None:
+                        yield f"id: {current}\nevent: resync\ndata: {json.dumps({'version': current})}\n\n"
+                    else:
+                        for event in self._change_events(records):
+                            yield f"id: {event['version']}\nevent: change\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+                    last = current
+                    if not self.index.wait_changes(last, self.EVENTS_HEARTBEAT):
+                        if self.index.closed:
+                            return
+                        yield ": ping\n\n"
+
+            resp = Response(stream(), mimetype="text/event-stream")
+            resp.headers["Cache-Control"] = "no-cache"
+            resp.headers["X-Accel-Buffering"] = "no"
+            return resp
+
+        @app.route("/api/changes", methods=["GET"])
+        def api_changes():
+            """
+            Дельта для клиента с кэшированным списком: ?since=N (версия из /api/files или
+            прошлого ответа) → {version, changes: [{version, added, updated, removed}]}.
+            Если лента промежуток уже не покрывает — {resync: true, version}: нужен полный /api/files.
+            """
+            raw = (request.args.get("since") or "").strip()
+            if not raw.isdigit():
+                return jsonify({"error": "since required"}), 400
+            current, records = self.index.changes_since(int(raw))
+            if records is None:
+                return jsonify({"resync": True, "version": current})
+            return jsonify({"version": current, "changes": self._change_events(records)})
+
+        @app.route("/api/import-dir", methods=["GET", "POST"])
+        def api_import_dir():
+            """
+            Индексация внешней папки без копирования в media.
+            POST {path, async?: bool, all?: bool} → {ok, indexed, added, updated, removed, unchanged, root}
+              async=true — сразу {ok, job}, прогресс в GET /api/import-dir/<job>;
+              all=true — индексировать и файлы неизвестных типов.
+            GET → {roots, jobs}
+            """
+            if request.method == "GET":
+                return jsonify({"ok": True, "roots": self._load_roots(), "jobs": list(self._jobs.values())})
+
+            data = request.get_json(silent=True) or {}
+            path = (data.get("path") or "").strip()
+            if not path:
+                return jsonify({"error": "path is required"}), 400
+            if not os.path.isdir(os.path.expanduser(path)):
+                return jsonify({"error": "not a directory"}), 404
+            include_all = bool(data.get("all"))
+            if data.get("async"):
+                job = self._start_import_job(path, include_all)
+                return jsonify({"ok": True, "job": job["id"]}), 202
+            try:
+                result = self._import_dir(path, include_all)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            except OSError as e:
+                return jsonify({"error": f"import failed: {e}"}), 500
+            return jsonify({"ok": True, **result})
+
+        @app.route("/api/import-dir/<job_id>", methods=["GET"])
+        def api_import_job(job_id: str):
+            job = self._jobs.get(job_id)
+            if job is None:
+                return jsonify({"error": "not found"}), 404
+            return jsonify({"ok": True, "job": job})
+
+        @app.route("/api/storage/migrate", methods=["GET", "POST"])
+        def api_storage_migrate():
+            """
+            Перенос файлов media в шарды "ab/cd/<sha256><ext>" — сам запускается при старте.
+            GET → {ok, job} с прогрессом последнего прохода; POST — ещё один проход
+            (подобрать файлы, подброшенные в media после старта) → 202.
+            """
+            if request.method == "GET":
+                return jsonify({"ok": True, "job": self._migration})
+            return jsonify({"ok": True, "job": self._start_migration()}), 202
+
+        @app.route("/api/quota", methods=["GET", "POST"])
+        def api_quota():
+            """
+            Квота на media (quota_bytes из /api/config).
+            GET — пробный прогон: {quota_bytes, used_bytes, would_free, evict: [{items, name, size, last_access}]}
+                  без удаления; ?quota=N — «что если» для другой квоты.
+            POST — вытеснить сейчас → {quota_bytes, used_bytes, freed, evicted}.
+            """
+            if request.method == "POST":
+                return jsonify({"ok": True, **self._evict(self.quota_bytes)})
+            raw = (request.args.get("quota") or "").strip()
+            quota = int(raw) if raw.isdigit() else self.quota_bytes
+            with self.index.locked():
+                used, plan = self._eviction_plan(quota)
+            return jsonify({"ok": True, "quota_bytes": quota, "used_bytes": used,
+                            "would_free": sum(u["size"] for u in plan), "evict": plan})
+
+        @app.route("/api/rescan", methods=["POST"])
+        def api_rescan():
+            """
+            Инкрементальный перескан каталога media (см. _rescan).
+            Ответ: {ok, added, updated, removed, renamed, unchanged, total, ms}
+            """
+            return jsonify({"ok": True, **self._rescan()})
 
         @app.route("/api/stats", methods=["GET"])
         def api_stats():
             """
-            Небольшая сводка по библиотеке.
+            Небольшая сводка по библиотеке — готовые суммы LibraryStats, без прохода по индексу.
+            ?albums=1 — ещё {альбом: {count, size}} по файлам альбомов, найденным в индексе.
             """
-            files = self._load_index()
-            total = len(files)
-            by_kind = {}
-            total_size = 0
-            for it in files:
-                k = it.get("kind") or "file"
-                by_kind[k] = by_kind.get(k, 0) + 1
-                total_size += int(it.get("size") or 0)
-            return jsonify({
-                "ok": True,
-                "total": total,
-                "by_kind": by_kind,
-                "total_size": total_size
-            })
+            st = self.stats
+            with self.index.locked():
+                out = {
+                    "ok": True,
+                    "total": st.count,
+                    "by_kind": {k: v[0] for k, v in st.kinds.items()},
+                    "size_by_kind": {k: v[1] for k, v in st.kinds.items()},
+                    "total_size": st.bytes,
+                    "local_size": st.local_bytes,  # занято в самой media: блобы без повторов, без внешних файлов
+                    "tags": dict(st.tags),
+                    "newest_mtime": st.newest(),
+                    "version": self.index.version,
+                }
+                if (request.args.get("albums") or "0") in ("1", "true", "yes"):
+                    out["albums"] = {name: st.album(name) for name in st.albums}
+            return jsonify(out)
 
 
         # ---- Media with Range (seek) ----
@@ -497,86 +4791,129 @@ class SalemMediaServer:
             fname = fname.replace("\\", "/")
             if ".." in fname:
                 return jsonify({"error": "forbidden"}), 403
+            if self.index.get(fname) is None and self._is_service_path(fname):
+                return jsonify({"error": "not found"}), 404
 
-            abs_path = os.path.abspath(os.path.join(self.MEDIA_DIR, fname))
-            if not abs_path.startswith(self.MEDIA_DIR):
+            abs_path = self._entry_path(fname)
+            if abs_path is None:
                 return jsonify({"error": "forbidden"}), 403
             if not os.path.isfile(abs_path):
                 return jsonify({"error": "not found"}), 404
+            self.access.touch(fname)
 
-            file_size = os.path.getsize(abs_path)
-            range_header = request.headers.get("Range")
+            st = os.stat(abs_path)
+            size = st.st_size
             mime = self._mime_of(abs_path)
+            sock = self._sendfile_socket()
+            # сильный валидатор: тот же inode, размер и mtime — те же байты
+            etag = f'"{st.st_ino:x}-{size:x}-{st.st_mtime_ns:x}"'
+            last_modified = int(st.st_mtime)
+            validators = {"ETag": etag, "Last-Modified": http_date(last_modified),
+                          "Cache-Control": "no-cache"}
+
+            # If-None-Match (слабое сравнение), без него — If-Modified-Since → 304
+            inm = request.headers.get("If-None-Match")
+            if inm is not None:
+                if parse_etags(inm).contains_weak(etag.strip('"')):
+                    return Response(status=304, headers=validators)
+            else:
+                ims = parse_date(request.headers.get("If-Modified-Since"))
+                if ims is not None and last_modified <= int(ims.timestamp()):
+                    return Response(status=304, headers=validators)
 
-            if not range_header:
-                return send_file(abs_path, mimetype=mime, as_attachment=False, conditional=True)
+            ranges = None
+            range_header = request.headers.get("Range")
+            if range_header and request.method in ("GET", "HEAD"):
+                # If-Range: диапазон только если у клиента та же версия файла, иначе — весь файл
+                if_range = (request.headers.get("If-Range") or "").strip()
+                if if_range.startswith('"'):
+                    fresh = if_range == etag
+                elif if_range:
+                    ir_date = parse_date(if_range)
+                    fresh = not if_range.startswith("W/") and ir_date is not None \
+                        and int(ir_date.timestamp()) == last_modified
+                else:
+                    fresh = True
+                if fresh:
+                    ranges = self._parse_ranges(range_header, size)
+                    if ranges is not None and len(ranges) > self.MAX_RANGES:
+                        ranges = None
 
-            # Partial content
-            try:
-                units, rng = range_header.split("=")
-                if units.strip() != "bytes":
-                    raise ValueError
-                start_s, end_s = (rng.split("-") + [""])[:2]
-                start = int(start_s) if start_s else 0
-                end = int(end_s) if end_s else file_size - 1
-                end = min(end, file_size - 1)
-                if start < 0 or start > end:
-                    raise ValueError
-            except Exception:
-                return Response(status=416)
-
-            length = end - start + 1
-
-            def generate():
-                with open(abs_path, "rb") as f:
-                    f.seek(start)
-                    remaining = length
-                    chunk = 8192 * 16
-                    while remaining > 0:
-                        data = f.read(min(chunk, remaining))
-                        if not data:
-                            break
-                        yield data
-                        remaining -= len(data)
-
-            rv = Response(generate(), status=206, mimetype=mime, direct_passthrough=True)
-            rv.headers.add("Content-Range", f"bytes {start}-{end}/{file_size}")
-            rv.headers.add("Content-Length", str(length))
+            if ranges is None:
+                rv = Response(self._media_stream(abs_path, 0, size, sock), status=200, mimetype=mime,
+                              headers=validators, direct_passthrough=True)
+                rv.headers["Content-Length"] = str(size)
+                return rv
+
+            if not ranges:
+                return Response(status=416, headers={"Content-Range": f"bytes */{size}", **validators})
+
+            if len(ranges) == 1:
+                start, end = ranges[0]
+                rv = Response(self._media_stream(abs_path, start, end - start, sock), status=206, mimetype=mime,
+                              headers=validators, direct_passthrough=True)
+                rv.headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+                rv.headers["Content-Length"] = str(end - start)
+                return rv
+
+            # несколько диапазонов — multipart/byteranges
+            boundary = uuid.uuid4().hex
+            parts = []
+            for i, (start, end) in enumerate(ranges):
+                head = (f"--{boundary}\r\nContent-Type: {mime}\r\n"
+                        f"Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n").encode("latin-1")
+                parts.append(((b"\r\n" if i else b"") + head, start, end - start))
+            tail = f"\r\n--{boundary}--\r\n".encode("latin-1")
+            length = sum(len(h) + n for h, _, n in parts) + len(tail)
+            rv = Response(self._media_stream(abs_path, sock=sock, parts=parts, tail=tail), status=206,
+                          content_type=f"multipart/byteranges; boundary={boundary}",
+                          headers=validators, direct_passthrough=True)
+            rv.headers["Content-Length"] = str(length)
             return rv
         
-        # ---- Albums (collections) ----
-        # Храним альбомы в media/albums.json  формат: {"albums":[{"name":..., "created":..., "updated":..., "items":[stored,...], "tags":[...]}]}
-        @app.route("/api/albums", methods=["GET", "POST"])
-        def api_albums():
-            albums_path = os.path.join(self.MEDIA_DIR, "albums.json")
+        # ---- ZIP export ----
+        @app.route("/api/albums/<string:name>/export.zip", methods=["GET"])
+        def api_album_export(name: str):
+            name = self._safe_name(name).strip()
+            found = self.albums.items(name)
+            if found is None:
+                return jsonify({"error": "not found"}), 404
+            return self._export_response(found[1], f"{name}.zip")
 
-            def load_albums():
+        @app.route("/api/export", methods=["POST"])
+        def api_export():
+            """
+            ZIP из выбранных файлов. Body JSON: { items: ["a.jpg", ...], name?: "архив" }
+            или обычная форма (items — JSON-список строкой), чтобы браузер сам писал файл на диск.
+            """
+            data = request.get_json(silent=True)
+            if data is None:
+                data = {"name": request.form.get("name")}
                 try:
-                    with open(albums_path, "r", encoding="utf-8") as f:
-                        data = json.load(f)
-                    if isinstance(data, dict):
-                        return data.get("albums", []) or []
-                    if isinstance(data, list):
-                        return data
-                except Exception:
-                    pass
-                return []
-
-            def save_albums(albums):
-                self._atomic_write_json(albums_path, {"albums": albums})
+                    data["items"] = json.loads(request.form.get("items") or "[]")
+                except ValueError:
+                    return jsonify({"error": "items must be a list of stored strings"}), 400
+            items = data.get("items") or []
+            if not isinstance(items, list) or not items or not all(isinstance(x, str) for x in items):
+                return jsonify({"error": "items must be a list of stored strings"}), 400
+            name = self._safe_name(data.get("name") or "export")
+            if not name.lower().endswith(".zip"):
+                name += ".zip"
+            return self._export_response([x.replace("\\", "/") for x in items], name)
 
+        # ---- Albums (collections) ----
+        # Храним альбомы в media/albums.db (AlbumStore): albums + album_items(album, pos, stored)
+        # Формат ответа прежний: {"name":..., "created":..., "updated":..., "items":[stored,...], "tags":[...]}
+        @app.route("/api/albums", methods=["GET", "POST"])
+        def api_albums():
             if request.method == "GET":
-                albums = load_albums()
-                # resolve=1 → прикладываем развёрнутые метаданные по items из index.json
+                with self.index.locked():
+                    albums = [dict(a, stats=self.stats.album(a["name"])) for a in self.albums.list()]
+                # resolve=1 → прикладываем развёрнутые метаданные по items из индекса
                 if (request.args.get("resolve") or "0") in ("1", "true", "yes"):
-                    index = {it.get("stored"): it for it in self._load_index()}
-                    resolved = []
+                    index = self.index.snapshot().by_stored
                     for a in albums:
-                        meta_items = [index.get(st) for st in a.get("items", []) if st in index]
-                        a2 = dict(a)
-                        a2["items_meta"] = meta_items
-                        resolved.append(a2)
-                    return jsonify({"albums": resolved})
+                        a["items_meta"] = [index[st] for st in a["items"] if st in index]
                 return jsonify({"albums": albums})
 
             # POST → создать новый альбом
@@ -591,97 +4928,99 @@ class SalemMediaServer:
             if not isinstance(tags, list):
                 return jsonify({"error": "tags must be a list"}), 400
 
-            albums = load_albums()
-            if any(a.get("name") == name for a in albums):
+            items = [self._safe_name(x) for x in items]
+            if not self.albums.create(name, items, [str(t)[:128] for t in tags]):
                 return jsonify({"error": "album already exists"}), 409
-
-            now = self._now_iso()
-            albums.append({
-                "name": name,
-                "created": now,
-                "updated": now,
-                "items": [self._safe_name(x) for x in items],
-                "tags": [str(t)[:128] for t in tags]
-            })
-            save_albums(albums)
+            with self.index.locked():
+                self.stats.album_add(name, items)
             return jsonify({"ok": True, "album": name})
 
         @app.route("/api/albums/<string:name>", methods=["GET", "PATCH", "DELETE"])
         def api_album_name(name: str):
-            albums_path = os.path.join(self.MEDIA_DIR, "albums.json")
-
-            def load_albums():
-                try:
-                    with open(albums_path, "r", encoding="utf-8") as f:
-                        data = json.load(f)
-                    if isinstance(data, dict):
-                        return data.get("albums", []) or []
-                    if isinstance(data, list):
-                        return data
-                except Exception:
-                    pass
-                return []
-
-            def save_albums(albums):
-                self._atomic_write_json(albums_path, {"albums": albums})
-
             name = self._safe_name(name).strip()
-            albums = load_albums()
-            idx = next((i for i, a in enumerate(albums) if a.get("name") == name), -1)
-            if idx < 0:
+            album = self.albums.get(name)
+            if album is None:
                 return jsonify({"error": "not found"}), 404
 
             if request.method == "GET":
-                album = dict(albums[idx])
-                # resolve=1 → прикладываем развёрнутые метаданные по items из index.json
+                # ?limit=&offset= — страница элементов по порядку альбома (индекс album_items(album, pos))
+                try:
+                    limit = int(request.args.get("limit", "0") or 0)
+                    offset = int(request.args.get("offset", "0") or 0)
+                except ValueError:
+                    return jsonify({"error": "bad number"}), 400
+                found = self.albums.items(name, limit, offset)
+                if found is None:
+                    return jsonify({"error": "not found"}), 404
+                album["items_total"], album["items"] = found
+                with self.index.locked():
+                    album["stats"] = self.stats.album(name)
+                # resolve=1 → метаданные только для элементов страницы: поиск по stored в индексе
                 if (request.args.get("resolve") or "0") in ("1", "true", "yes"):
-                    index = {it.get("stored"): it for it in self._load_index()}
-                    album["items_meta"] = [index.get(st) for st in album.get("items", []) if st in index]
+                    index = self.index.snapshot().by_stored
+                    album["items_meta"] = [index[st] for st in album["items"] if st in index]
                 return jsonify({"album": album})
 
+            # альбом могут удалить или переименовать параллельно с этим запросом:
+            # None из AlbumStore на любом шаге ниже — 404, а не TypeError
+            def gone():
+                return jsonify({"error": "not found"}), 404
+
             if request.method == "DELETE":
-                albums.pop(idx)
-                save_albums(albums)
+                found = self.albums.items(name)
+                if found is None or not self.albums.drop(name):
+                    return gone()
+                with self.index.locked():
+                    self.stats.album_drop(name, found[1])
                 return jsonify({"ok": True})
 
             # PATCH → операции над альбомом
             data = request.get_json(silent=True) or {}
             op = (data.get("op") or "").lower().strip()
-            album = albums[idx]
-
-            if op == "add":
-                # добавить items: ["stored1", ...]
-                items = data.get("items") or []
-                if not isinstance(items, list):
-                    return jsonify({"error": "items must be list"}), 400
-                sset = set(album.get("items", []))
-                for st in items:
-                    sset.add(self._safe_name(str(st)))
-                album["items"] = list(sset)
-
-            elif op == "remove":
-                # убрать items
-                items = data.get("items") or []
-                if not isinstance(items, list):
-                    return jsonify({"error": "items must be list"}), 400
-                rm = {self._safe_name(str(st)) for st in items}
-                album["items"] = [x for x in album.get("items", []) if x not in rm]
 
-            elif op == "set":
-                # заменить полный список items
+            if op in ("add", "remove", "set"):
+                # add — дописать items, remove — убрать, set — заменить полный список
                 items = data.get("items") or []
                 if not isinstance(items, list):
                     return jsonify({"error": "items must be list"}), 400
-                album["items"] = [self._safe_name(str(st)) for st in items]
+                items = [self._safe_name(str(st)) for st in items]
+                old = items
+                if op == "set":
+                    found = self.albums.items(name)
+                    if found is None:
+                        return gone()
+                    old = found[1]
+                if op == "add":
+                    ok = self.albums.add_items(name, items) is not None
+                elif op == "remove":
+                    ok = self.albums.remove_items(name, items)
+                else:
+                    ok = self.albums.set_items(name, items)
+                if not ok:
+                    return gone()
+                with self.index.locked():
+                    if op != "add":
+                        self.stats.album_remove(name, old)
+                    if op != "remove":
+                        self.stats.album_add(name, items)
 
             elif op == "rename":
                 # переименовать альбом
                 new_name = self._safe_name(data.get("new_name") or "").strip()
                 if not new_name:
                     return jsonify({"error": "new_name required"}), 400
-                if any(a.get("name") == new_name for a in albums if a is not album):
+                renamed = self.albums.rename(name, new_name)
+                if renamed is None:
+                    return gone()
+                if not renamed:
                     return jsonify({"error": "album with new_name already exists"}), 409
-                album["name"] = new_name
+                found = self.albums.items(new_name)
+                with self.index.locked():
+                    if found is not None:
+                        self.stats.album_rename(name, new_name, found[1])
+                    else:
+                        # альбом уже снова изменили — суммы пересобираются целиком
+                        self.stats.set_albums(self.albums.list())
                 name = new_name  # для возвращаемого значения
 
             elif op == "tags":
@@ -689,17 +5028,20 @@ class SalemMediaServer:
                 tags = data.get("tags") or []
                 if not isinstance(tags, list):
                     return jsonify({"error": "tags must be list"}), 400
-                album["tags"] = [str(t)[:128] for t in tags]
+                if not self.albums.set_tags(name, [str(t)[:128] for t in tags]):
+                    return gone()
 
             else:
                 return jsonify({"error": "unknown op (use add|remove|set|rename|tags)"}), 400
 
-            album["updated"] = self._now_iso()
-            albums[idx] = album
-            save_albums(albums)
+            album = self.albums.get(name)
+            found = self.albums.items(name)
+            if album is None or found is None:
+                return gone()
+            album["items"] = found[1]
             return jsonify({"ok": True, "album": album})
-        
-        
+
+
 
     # --------------- integration ---------------
 
@@ -707,13 +5049,39 @@ class SalemMediaServer:
     def wsgi(self):
         return self.app
 
+    def close(self) -> None:
+        """
+        Остановка фоновых потоков, финальный сброс индекса и закрытие баз (вызывается и
+        через atexit). Повторный вызов ничего не делает — экземпляр после close() не используется.
+        """
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+        atexit.unregister(self.close)
+        if self.watcher is not None:
+            self.watcher.stop()
+        self._migrate_stop.set()
+        if self._migrate_thread is not None:
+            self._migrate_thread.join(timeout=5.0)
+        self.access.close()
+        self.metadata.stop()
+        self.phashes.stop()
+        self.thumbs.close()
+        self.index.close()
+        self.albums.close()
+
     def run(self, debug: bool = False):
         print(f"📡 SalemMediaServer @ http://{self.host}:{self.port}  (root={self.ROOT})")
-        self.app.run(self.host, self.port, debug=debug, threaded=True)
+        try:
+            self.app.run(self.host, self.port, debug=debug, threaded=True)
+        finally:
+            self.close()
 
         
 
 
 
 if __name__ == "__main__":
-    SalemMediaServer().run(debug=False)
+    multiprocessing.freeze_support()
+    SalemMediaServer(worker_processes=True).run(debug=False)
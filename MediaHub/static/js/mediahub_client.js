@@ -8,6 +8,8 @@ const fileInput = document.getElementById('fileInput');
 const folderInput = document.getElementById('folderInput');
 const viewer = document.getElementById('viewer');
 const statusEl = document.getElementById('status');
+const PAGE_SIZE = 200;
+let listParams = null, nextCursor = null, loadingMore = false;
 
 btnRefresh.onclick = loadList;
 kindSel.onchange = loadList;
@@ -15,11 +17,11 @@ qInput.oninput = debounce(loadList, 300);
 
 fileInput.onchange = async () => {
   if(!fileInput.files.length) return;
-  await uploadFiles(fileInput.files); fileInput.value = ""; loadList();
+  await uploadFiles(fileInput.files); fileInput.value = ""; if(!live) loadList();
 };
 folderInput.onchange = async () => {
   if(!folderInput.files.length) return;
-  await uploadFiles(folderInput.files); folderInput.value = ""; loadList();
+  await uploadFiles(folderInput.files); folderInput.value = ""; if(!live) loadList();
 };
 
 document.getElementById('btnImportDir').onclick = async () => {
@@ -30,7 +32,7 @@ document.getElementById('btnImportDir').onclick = async () => {
     body: JSON.stringify({path})
   });
   const j = await r.json();
-  if(j.ok){ status(`Индексировано: ${j.indexed}`); loadList(); }
+  if(j.ok){ status(`Индексировано: ${j.indexed}`); if(!live) loadList(); }
   else { status(j.error || 'Ошибка импорта'); }
 };
 
@@ -49,18 +51,43 @@ async function loadList(){
   const params = new URLSearchParams();
   if(kindSel.value) params.set('kind', kindSel.value);
   if(qInput.value.trim()) params.set('q', qInput.value.trim());
+  params.set('limit', PAGE_SIZE);
+  listParams = params; nextCursor = null;
   const r = await fetch(API + '/api/files?' + params.toString());
   if(!r.ok){ status('Не удалось загрузить список'); return; }
   const j = await r.json();
-  renderGrid(j.items || []);
-  status('Найдено: ' + (j.items?.length || 0));
+  renderGrid(j.files || j.items || []);
+  nextCursor = j.next_cursor || null;
+  status('Найдено: ' + (j.total ?? (j.files?.length || 0)));
 }
 
-function renderGrid(items){
-  grid.innerHTML = '';
-  for(const it of items){
+// следующая страница по keyset-курсору — сервер отдаёт её за O(limit)
+async function loadMore(){
+  if(!nextCursor || loadingMore || !listParams) return;
+  loadingMore = true;
+  try{
+    const params = new URLSearchParams(listParams);
+    params.set('cursor', nextCursor);
+    const r = await fetch(API + '/api/files?' + params.toString());
+    if(!r.ok) return;
+    const j = await r.json();
+    renderGrid(j.files || [], true);
+    nextCursor = j.next_cursor || null;
+  } finally { loadingMore = false; }
+}
+window.addEventListener('scroll', () => {
+  if(window.innerHeight + window.scrollY >= document.body.offsetHeight - 600) loadMore();
+});
+
+function renderGrid(items, append = false){
+  if(!append) grid.innerHTML = '';
+  for(const it of items) grid.appendChild(makeCard(it));
+}
+
+function makeCard(it){
     const card = document.createElement('div');
     card.className = 'card';
+    card.dataset.stored = it.stored || '';
     const thumb = document.createElement('div');
     thumb.className = 'thumb';
     if(it.kind === 'image'){
@@ -80,7 +107,34 @@ function renderGrid(items){
                       <div class="sub">${(it.size/1048576).toFixed(2)} MB · ${it.kind}</div>`;
     card.appendChild(thumb); card.appendChild(meta);
     card.onclick = () => openItem(it);
-    grid.appendChild(card);
+    return card;
+}
+
+// лента изменений сервера (SSE /api/events): сетка патчится на месте вместо loadList()
+// после каждого действия; видны и правки из других вкладок и фонового перескана
+let live = false;
+function watchEvents(){
+  if(!window.EventSource) return;
+  const es = new EventSource(API + '/api/events');
+  es.onopen = () => { live = true; };
+  es.onerror = () => { live = false; };  // браузер переподключится сам и пришлёт Last-Event-ID
+  es.addEventListener('change', e => patchGrid(JSON.parse(e.data)));
+  es.addEventListener('resync', () => loadList());
+}
+
+function cardOf(stored){ return grid.querySelector(`.card[data-stored="${CSS.escape(stored)}"]`); }
+
+function patchGrid(d){
+  for(const stored of d.removed || []) cardOf(stored)?.remove();
+  for(const it of d.updated || []){
+    const old = cardOf(it.stored);
+    if(old) old.replaceWith(makeCard(it));
+  }
+  // новые — в начало, если подходят под выбранный тип; при поиске порядок и отбор решает сервер
+  const kind = kindSel.value, q = qInput.value.trim();
+  for(const it of d.added || []){
+    if(q || (kind && it.kind !== kind) || cardOf(it.stored)) continue;
+    grid.prepend(makeCard(it));
   }
 }
 
@@ -105,4 +159,5 @@ function openItem(it){
 
 function status(t){ statusEl.textContent = t || ''; }
 function debounce(fn, ms){ let t; return (...a)=>{ clearTimeout(t); t = setTimeout(()=>fn(...a), ms); }; }
-loadList();
\ No newline at end of file
+loadList();
+watchEvents();
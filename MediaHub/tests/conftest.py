@@ -0,0 +1,23 @@
+# MediaHub/tests/conftest.py
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mediahub_server  # noqa: E402
+
+
+@pytest.fixture
+def server(tmp_path):
+    """Сервер на временном каталоге, без слежения за ФС; close() — в конце теста."""
+    srv = mediahub_server.SalemMediaServer(root_dir=str(tmp_path), watch=False)
+    yield srv
+    srv.close()
+
+
+@pytest.fixture
+def client(server):
+    return server.app.test_client()
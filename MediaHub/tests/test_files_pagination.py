@@ -0,0 +1,99 @@
+# MediaHub/tests/test_files_pagination.py
+# -*- coding: utf-8 -*-
+import pytest
+
+N = 50
+
+
+def _item(i):
+    name = "File%02d.txt" % (i * 37 % N)
+    return {"stored": "s%02d_%s" % (i, name), "name": name, "kind": "image" if i % 3 else "video",
+            "mtime": "2024-01-01T00:00:%02d" % (i % 7), "size": i % 5, "url": "/media/s%02d" % i}
+
+
+@pytest.fixture
+def filled(server, client):
+    for i in range(N):
+        server.index.put(_item(i))
+    return client
+
+
+def _expected(sort, order, kind=""):
+    key = {"name": lambda it: it["name"].lower(), "size": lambda it: it["size"], "date": lambda it: it["mtime"]}[sort]
+    items = [_item(i) for i in range(N) if not kind or _item(i)["kind"] == kind]
+    rows = sorted((key(it), it["stored"]) for it in items)
+    return [stored for _, stored in (rows[::-1] if order == "desc" else rows)]
+
+
+def _walk(client, limit, **params):
+    seen, cursor = [], None
+    while True:
+        args = dict(params, limit=limit)
+        if cursor:
+            args["cursor"] = cursor
+        r = client.get("/api/files", query_string=args)
+        assert r.status_code == 200
+        body = r.get_json()
+        assert len(body["files"]) <= limit
+        seen.extend(f["stored"] for f in body["files"])
+        cursor = body["next_cursor"]
+        if not cursor:
+            return seen, body
+
+
+@pytest.mark.parametrize("sort", ["name", "size", "date"])
+@pytest.mark.parametrize("order", ["asc", "desc"])
+def test_cursor_walk_covers_everything_once(filled, sort, order):
+    seen, last = _walk(filled, 7, sort=sort, order=order)
+    assert seen == _expected(sort, order)
+    assert last["total"] == N
+
+
+def test_cursor_walk_with_kind_filter(filled):
+    seen, last = _walk(filled, 4, sort="size", order="asc", kind="video")
+    assert seen == _expected("size", "asc", kind="video")
+    assert last["total"] == len(seen)
+
+
+def test_offset_pages_match_cursor_pages(filled):
+    by_offset = []
+    for offset in range(0, N, 9):
+        r = filled.get("/api/files", query_string={"sort": "name", "limit": 9, "offset": offset})
+        by_offset.extend(f["stored"] for f in r.get_json()["files"])
+    assert by_offset == _expected("name", "asc")
+
+
+def test_cursor_is_stable_under_inserts_and_deletes(server, filled):
+    r = filled.get("/api/files", query_string={"sort": "name", "limit": 10})
+    body = r.get_json()
+    first = [f["stored"] for f in body["files"]]
+    # перед курсором: вставка и удаление не должны сдвинуть следующую страницу
+    server.index.put({"stored": "aaa.txt", "name": "aaa.txt", "kind": "other", "mtime": "", "size": 0})
+    server.index.delete(first[0])
+    # после курсора: новая запись появится на своём месте
+    server.index.put({"stored": "zzz.txt", "name": "zzz.txt", "kind": "other", "mtime": "", "size": 0})
+
+    rest, _ = _walk(filled, 10, sort="name", cursor=body["next_cursor"])
+    expected = _expected("name", "asc")
+    assert first + rest == expected + ["zzz.txt"]
+
+
+def test_cursor_from_other_sort_is_rejected(filled):
+    r = filled.get("/api/files", query_string={"sort": "name", "limit": 5})
+    cursor = r.get_json()["next_cursor"]
+    for args in ({"sort": "size"}, {"sort": "name", "order": "desc"}):
+        r = filled.get("/api/files", query_string=dict(args, limit=5, cursor=cursor))
+        assert r.status_code == 400
+        assert r.get_json() == {"error": "bad cursor"}
+
+
+@pytest.mark.parametrize("cursor", ["garbage", "e30", "!!!"])
+def test_garbage_cursor_is_rejected(filled, cursor):
+    r = filled.get("/api/files", query_string={"sort": "name", "limit": 5, "cursor": cursor})
+    assert r.status_code == 400
+
+
+def test_last_page_has_no_cursor(filled):
+    r = filled.get("/api/files", query_string={"sort": "name", "limit": N})
+    body = r.get_json()
+    assert len(body["files"]) == N and body["next_cursor"] is None
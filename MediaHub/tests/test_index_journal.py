@@ -0,0 +1,159 @@
+# MediaHub/tests/test_index_journal.py
+# -*- coding: utf-8 -*-
+import json
+import sqlite3
+
+from mediahub_server import MediaCatalog, MediaIndex
+
+
+def _item(stored, size=1):
+    return {"stored": stored, "name": stored, "kind": "other", "mtime": 0, "size": size,
+            "url": "/media/" + stored}
+
+
+def _open(tmp_path, store_cls=MediaCatalog):
+    store = store_cls(str(tmp_path / "catalog.db"))
+    idx = MediaIndex(store, str(tmp_path / "index.journal"), flush_interval=3600)
+    # фоновый сброс не нужен: всё, что не сброшено явно, живёт только в журнале
+    idx._closed.set()
+    idx._dirty.set()
+    idx._flusher.join(timeout=5)
+    return idx, store
+
+
+def _crash(idx, store):
+    """Процесс упал: ни сброса, ни close() — на диске только журнал и прежняя БД."""
+    idx._journal.close()
+    store.close()
+
+
+def _stored(files):
+    return sorted(it["stored"] for it in files)
+
+
+def _journal_lines(tmp_path):
+    with open(tmp_path / "index.journal", encoding="utf-8") as f:
+        return f.read().splitlines()
+
+
+class FlakyCatalog(MediaCatalog):
+    """Каталог, запись в который падает, пока failing=True."""
+
+    failing = True
+
+    def write(self, version, ops, files=None):
+        if FlakyCatalog.failing:
+            raise sqlite3.OperationalError("database is locked")
+        super().write(version, ops, files)
+
+
+def test_committed_transactions_survive_crash(tmp_path):
+    idx, store = _open(tmp_path)
+    idx.put(_item("a.txt"))
+    idx.put(_item("b.txt"))
+    with idx.transaction() as tx:
+        tx.rename("a.txt", _item("c.txt"))
+        tx.delete("b.txt")
+    idx.put(_item("d.txt"))
+    assert len(_journal_lines(tmp_path)) == 4
+    _crash(idx, store)
+
+    on_disk = MediaCatalog(str(tmp_path / "catalog.db"))
+    assert on_disk.load() == (0, [])
+    on_disk.close()
+    idx, store = _open(tmp_path)
+    assert idx.version == 4
+    assert _stored(idx.snapshot().files) == ["c.txt", "d.txt"]
+    # доигранное сразу уходит в БД, журнал пуст
+    version, files = store.load()
+    assert version == 4 and _stored(files) == ["c.txt", "d.txt"]
+    assert _journal_lines(tmp_path) == []
+    _crash(idx, store)
+
+
+def test_torn_last_line_is_ignored(tmp_path):
+    idx, store = _open(tmp_path)
+    idx.put(_item("a.txt"))
+    _crash(idx, store)
+    with open(tmp_path / "index.journal", "a", encoding="utf-8") as f:
+        f.write('{"v": 2, "ops": [["put", "b.txt"')
+
+    idx, store = _open(tmp_path)
+    assert idx.version == 1
+    assert _stored(idx.snapshot().files) == ["a.txt"]
+    # новая транзакция после обрыва не теряется при следующем падении
+    idx.put(_item("c.txt"))
+    _crash(idx, store)
+    idx, store = _open(tmp_path)
+    assert _stored(idx.snapshot().files) == ["a.txt", "c.txt"]
+    _crash(idx, store)
+
+
+def test_replay_keeps_journal_when_store_fails(tmp_path):
+    idx, store = _open(tmp_path)
+    idx.put(_item("a.txt"))
+    idx.put(_item("b.txt"))
+    _crash(idx, store)
+
+    FlakyCatalog.failing = True
+    try:
+        idx, store = _open(tmp_path, FlakyCatalog)
+        assert _stored(idx.snapshot().files) == ["a.txt", "b.txt"]
+        assert len(_journal_lines(tmp_path)) == 2
+        idx.put(_item("c.txt"))
+        assert not idx.flush()
+        _crash(idx, store)
+
+        # второе падение подряд: всё по-прежнему восстанавливается из журнала
+        idx, store = _open(tmp_path, FlakyCatalog)
+        assert _stored(idx.snapshot().files) == ["a.txt", "b.txt", "c.txt"]
+        FlakyCatalog.failing = False
+        assert idx.flush()
+    finally:
+        FlakyCatalog.failing = True
+    assert _journal_lines(tmp_path) == []
+    version, files = store.load()
+    assert version == 3 and _stored(files) == ["a.txt", "b.txt", "c.txt"]
+    _crash(idx, store)
+
+
+def test_flush_compacts_journal(tmp_path):
+    idx, store = _open(tmp_path)
+    idx.put(_item("a.txt"))
+    assert idx.flush()
+    idx.put(_item("b.txt"))
+    lines = _journal_lines(tmp_path)
+    assert [json.loads(line)["v"] for line in lines] == [2]
+    _crash(idx, store)
+
+    idx, store = _open(tmp_path)
+    assert _stored(idx.snapshot().files) == ["a.txt", "b.txt"]
+    _crash(idx, store)
+
+
+def test_clear_is_replayed(tmp_path):
+    idx, store = _open(tmp_path)
+    idx.put(_item("a.txt"))
+    assert idx.flush()
+    idx.clear()
+    idx.put(_item("b.txt"))
+    _crash(idx, store)
+
+    idx, store = _open(tmp_path)
+    assert _stored(idx.snapshot().files) == ["b.txt"]
+    _crash(idx, store)
+
+
+def test_snapshot_is_isolated_from_later_writes(tmp_path):
+    idx, store = _open(tmp_path)
+    idx.put(_item("a.txt", size=1))
+    before = idx.snapshot()
+    idx.put(_item("a.txt", size=2))
+    idx.put(_item("b.txt"))
+    idx.delete("a.txt")
+    after = idx.snapshot()
+
+    assert before.version == 1 and after.version == 4
+    assert _stored(before.files) == ["a.txt"] and before.by_stored["a.txt"]["size"] == 1
+    assert "a.txt" not in after.by_stored and _stored(after.files) == ["b.txt"]
+    _crash(idx, store)
@@ -0,0 +1,103 @@
+# MediaHub/tests/test_media_ranges.py
+# -*- coding: utf-8 -*-
+import io
+import re
+
+import pytest
+
+DATA = bytes(range(256)) * 40
+SIZE = len(DATA)
+
+
+@pytest.fixture
+def media(client):
+    r = client.post("/api/upload", data={"files": (io.BytesIO(DATA), "clip.bin")},
+                    content_type="multipart/form-data")
+    assert r.status_code == 200
+    return "/media/" + r.get_json()["files"][0]["stored"]
+
+
+def test_full_response_has_validators(client, media):
+    r = client.get(media)
+    assert r.status_code == 200
+    assert r.data == DATA
+    assert r.headers["Accept-Ranges"] == "bytes"
+    assert r.headers["ETag"] and r.headers["Last-Modified"]
+
+
+@pytest.mark.parametrize("spec, start, end", [
+    ("bytes=0-99", 0, 100),
+    ("bytes=100-", 100, SIZE),
+    ("bytes=-100", SIZE - 100, SIZE),
+    ("bytes=10000-99999", 10000, SIZE),
+    ("bytes=0-9,5-14", 0, 15),  # пересекающиеся диапазоны склеиваются
+])
+def test_single_range(client, media, spec, start, end):
+    r = client.get(media, headers={"Range": spec})
+    assert r.status_code == 206
+    assert r.headers["Content-Range"] == "bytes %d-%d/%d" % (start, end - 1, SIZE)
+    assert int(r.headers["Content-Length"]) == end - start
+    assert r.data == DATA[start:end]
+
+
+def test_multiple_ranges(client, media):
+    r = client.get(media, headers={"Range": "bytes=0-9,200-209,-5"})
+    assert r.status_code == 206
+    m = re.match(r"multipart/byteranges; boundary=(\S+)", r.headers["Content-Type"])
+    assert m
+    assert int(r.headers["Content-Length"]) == len(r.data)
+    parts = r.data.split(b"--" + m.group(1).encode())
+    assert parts[-1].strip() == b"--"
+    got = []
+    for part in parts[1:-1]:
+        head, _, body = part.partition(b"\r\n\r\n")
+        rng = re.search(rb"Content-Range: bytes (\d+)-(\d+)/(\d+)", head)
+        start, end = int(rng.group(1)), int(rng.group(2)) + 1
+        assert int(rng.group(3)) == SIZE
+        assert body[:-2] == DATA[start:end]
+        got.append((start, end))
+    assert got == [(0, 10), (200, 210), (SIZE - 5, SIZE)]
+
+
+@pytest.mark.parametrize("spec", ["bytes=%d-" % SIZE, "bytes=99999-100000", "bytes=-0"])
+def test_unsatisfiable_range(client, media, spec):
+    r = client.get(media, headers={"Range": spec})
+    assert r.status_code == 416
+    assert r.headers["Content-Range"] == "bytes */%d" % SIZE
+
+
+@pytest.mark.parametrize("spec", ["bytes=abc", "items=0-9", "bytes=9-0"])
+def test_malformed_range_is_ignored(client, media, spec):
+    r = client.get(media, headers={"Range": spec})
+    assert r.status_code == 200
+    assert r.data == DATA
+
+
+def test_if_range(client, media):
+    head = client.get(media).headers
+    etag, modified = head["ETag"], head["Last-Modified"]
+
+    r = client.get(media, headers={"Range": "bytes=0-9", "If-Range": etag})
+    assert r.status_code == 206 and r.data == DATA[:10]
+    r = client.get(media, headers={"Range": "bytes=0-9", "If-Range": modified})
+    assert r.status_code == 206 and r.data == DATA[:10]
+
+    # файл сменился (или валидатор слабый) — диапазон не применяется, отдаётся весь файл
+    for stale in ('"0-0-0"', "W/" + etag, "Thu, 01 Jan 1970 00:00:00 GMT"):
+        r = client.get(media, headers={"Range": "bytes=0-9", "If-Range": stale})
+        assert r.status_code == 200 and r.data == DATA
+
+
+def test_if_none_match(client, media):
+    etag = client.get(media).headers["ETag"]
+    r = client.get(media, headers={"If-None-Match": etag})
+    assert r.status_code == 304
+    assert r.data == b""
+    r = client.get(media, headers={"If-None-Match": '"0-0-0"'})
+    assert r.status_code == 200
+
+
+@pytest.mark.parametrize("path", ["catalog.db", "albums.db", "index.journal", ".uploads"])
+def test_service_files_are_not_served(client, media, path):
+    r = client.get("/media/" + path, headers={"Range": "bytes=0-9"})
+    assert r.status_code == 404
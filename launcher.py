@@ -2,7 +2,7 @@
 from __future__ import annotations
 from PyQt5.QtWidgets import QApplication, QWidget, QLabel, QVBoxLayout, QProgressBar, QDialog, QFormLayout, QPushButton
 from PyQt5.QtCore import Qt, QTimer, QCoreApplication, QElapsedTimer, QUrl, QThread, pyqtSignal, QSize
-import os, sys, socket, shutil, time, json, ctypes, threading, logging, logging.handlers, traceback, subprocess, inspect, hashlib, warnings
+import os, sys, socket, shutil, time, json, ctypes, threading, logging, logging.handlers, traceback, subprocess, inspect, hashlib, warnings, multiprocessing
 from pathlib import Path
 from datetime import datetime
 
@@ -905,7 +905,7 @@ class _QuietWSGI(WSGIRequestHandler):
         except Exception: pass
 class FlaskThread(threading.Thread):
     def __init__(self, wsgi_app, host, port):
-        super().__init__(daemon=True); self.httpd = make_server(host, port, wsgi_app, request_handler=_QuietWSGI)
+        super().__init__(daemon=True); self.httpd = make_server(host, port, wsgi_app, threaded=True, request_handler=_QuietWSGI)
     def run(self): addr = self.httpd.server_address; pline(f"[WSGI] up at http://{addr[0]}:{addr[1]}"); self.httpd.serve_forever()
     def shutdown(self):
         try: self.httpd.shutdown()
@@ -927,6 +927,7 @@ class BootWorker(QThread):
         super().__init__(); self.HOST, self.PORT = host, port; self.MEDIA_HOST, self.MEDIA_PORT = media_host, media_port
         self.HEALTH_URL, self.MEDIA_HEALTH_URL = health_url, media_health_url; self.HOME_URL = home_url
         self.main_srv: FlaskThread | None = None; self.media_srv: FlaskThread | None = None
+        self.media_app = None  # SalemMediaServer держит журнал индекса, базы и фоновые потоки — перед перезапуском close()
         self._stop = threading.Event(); self._watchdog_interval = 3.0
     def run(self):
         import requests
@@ -934,7 +935,7 @@ class BootWorker(QThread):
             if SalemServer and not self._in_use(self.HOST, self.PORT):
                 self.progress.emit("Запуск основного сервиса…"); app = SalemServer(); self.main_srv = FlaskThread(getattr(app, "wsgi", app), self.HOST, self.PORT); self.main_srv.start()
             if SalemMediaServer and not self._in_use(self.MEDIA_HOST, self.MEDIA_PORT):
-                self.progress.emit("Запуск медиа‑сервиса…"); app = SalemMediaServer(); self.media_srv = FlaskThread(getattr(app, "wsgi", app), self.MEDIA_HOST, self.MEDIA_PORT); self.media_srv.start()
+                self.progress.emit("Запуск медиа‑сервиса…"); self._start_media()
             self.progress.emit("Ожидание готовности API…"); main_ok  = self._wait(self.HEALTH_URL, 25); media_ok = self._wait(self.MEDIA_HEALTH_URL, 15)
             try: requests.get(self.HOME_URL, timeout=2)
             except Exception: pass
@@ -952,20 +953,34 @@ class BootWorker(QThread):
                         logging.getLogger("watchdog").exception("[WD] main restart failed: %s", e)
                 if SalemMediaServer and not self._alive(self.MEDIA_HEALTH_URL):
                     logging.getLogger("watchdog").warning("[WD] media API down; restarting…")
+                    self._stop_media()
                     try:
-                        if self.media_srv: self.media_srv.shutdown()
-                    except Exception: pass
-                    try:
-                        app = SalemMediaServer(); self.media_srv = FlaskThread(getattr(app, "wsgi", app), self.MEDIA_HOST, self.MEDIA_PORT); self.media_srv.start()
+                        self._start_media()
                     except Exception as e:
                         logging.getLogger("watchdog").exception("[WD] media restart failed: %s", e)
         except Exception as e:
             logging.getLogger("launcher").exception("BootWorker error: %s", e); self.done.emit(False, False)
     def stop(self):
         self._stop.set()
-        for srv in (self.main_srv, self.media_srv):
-            try: srv.shutdown()
-            except Exception: pass
+        try: self.main_srv.shutdown()
+        except Exception: pass
+        self._stop_media()
+    def _start_media(self):
+        app = SalemMediaServer()
+        try: srv = FlaskThread(getattr(app, "wsgi", app), self.MEDIA_HOST, self.MEDIA_PORT)
+        except Exception:
+            app.close(); raise
+        self.media_app, self.media_srv = app, srv; srv.start()
+    def _stop_media(self):
+        # старый экземпляр закрывается до создания нового: два индекса на одном журнале и двойные фоновые потоки недопустимы
+        try:
+            if self.media_srv: self.media_srv.shutdown()
+        except Exception: pass
+        try:
+            if self.media_app is not None and hasattr(self.media_app, "close"): self.media_app.close()
+        except Exception as e:
+            logging.getLogger("watchdog").warning("[WD] media close failed: %s", e)
+        self.media_app = None
     @staticmethod
     def _in_use(host, port, timeout=0.5):
         with socket.socket() as s:
@@ -1089,6 +1104,7 @@ def _looks_like_gl_crash(text: str) -> bool:
     return any(t in text_l for t in tokens)
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     try:
         rc = main(); sys.exit(rc)
     except Exception as e:
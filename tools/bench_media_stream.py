@@ -0,0 +1,99 @@
+# tools/bench_media_stream.py
+"""
+Замер отдачи /media медиасервера: пропускная способность и CPU сервера на поток,
+с sendfile (MediaStream через werkzeug.socket) и без него (чтение кусками в Python).
+
+Сервер поднимается в этом процессе (werkzeug make_server, threaded), клиенты —
+отдельными процессами, поэтому getrusage(RUSAGE_SELF) считает только сервер.
+
+  python tools/bench_media_stream.py --size-mb 512 --streams 4 --rounds 3
+"""
+from __future__ import annotations
+import os, sys, time, socket, argparse, tempfile, threading, resource
+from multiprocessing import Pool
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "MediaHub"))
+
+from werkzeug.serving import make_server, WSGIRequestHandler  # noqa: E402
+import mediahub_server  # noqa: E402
+
+
+def log(msg: str):
+    print(f"[bench] {msg}", flush=True)
+
+
+class _Quiet(WSGIRequestHandler):
+    def log_request(self, *a, **k):
+        pass
+
+
+def fetch(args) -> int:
+    """Один клиент: GET с Range, тело читается и выбрасывается. → принято байт."""
+    host, port, path, start, end = args
+    s = socket.create_connection((host, port))
+    s.sendall(f"GET {path} HTTP/1.1\r\nHost: {host}\r\nRange: bytes={start}-{end}\r\n"
+              f"Connection: close\r\n\r\n".encode())
+    buf = bytearray(1 << 20)
+    total = 0
+    while True:
+        n = s.recv_into(buf)
+        if not n:
+            break
+        total += n
+    s.close()
+    return total
+
+
+def run_mode(srv, host, port, url, size, streams, rounds, sendfile: bool) -> dict:
+    srv.USE_SENDFILE = sendfile
+    jobs = [(host, port, url, 0, size - 1)] * streams
+    with Pool(streams) as pool:
+        pool.map(fetch, jobs[:1])  # прогрев page cache
+        ru0, t0 = resource.getrusage(resource.RUSAGE_SELF), time.perf_counter()
+        got = 0
+        for _ in range(rounds):
+            got += sum(pool.map(fetch, jobs))
+        wall = time.perf_counter() - t0
+        ru1 = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (ru1.ru_utime - ru0.ru_utime) + (ru1.ru_stime - ru0.ru_stime)
+    mb = got / 1048576
+    return {
+        "mode": "sendfile" if sendfile else "python",
+        "MB/s total": round(mb / wall, 1),
+        "MB/s per stream": round(mb / wall / streams, 1),
+        "CPU s per GB": round(cpu / (mb / 1024), 3),
+        "CPU % of a core": round(100 * cpu / wall, 1),
+    }
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Benchmark /media streaming of MediaHub server.")
+    ap.add_argument("--size-mb", type=int, default=256, help="Test file size in MB")
+    ap.add_argument("--streams", type=int, default=4, help="Parallel client connections")
+    ap.add_argument("--rounds", type=int, default=3, help="Requests per stream")
+    return ap.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    root = tempfile.mkdtemp(prefix="mh_bench_")
+    srv = mediahub_server.SalemMediaServer(root_dir=root, watch=False)
+    fname = "bench.bin"
+    size = args.size_mb * 1048576
+    with open(os.path.join(srv.MEDIA_DIR, fname), "wb") as f:
+        block = os.urandom(1 << 20)
+        for _ in range(args.size_mb):
+            f.write(block)
+
+    host = "127.0.0.1"
+    httpd = make_server(host, 0, srv.wsgi, threaded=True, request_handler=_Quiet)
+    port = httpd.server_port
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    log(f"file={args.size_mb} MB streams={args.streams} rounds={args.rounds} port={port}")
+
+    for use_sendfile in (False, True):
+        log(run_mode(srv, host, port, f"/media/{fname}", size, args.streams, args.rounds, use_sendfile))
+
+    httpd.shutdown()
+    srv.close()